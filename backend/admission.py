@@ -0,0 +1,267 @@
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Any, Optional
+import asyncio
+import math
+import threading
+import time
+
+
+class AdmissionRejected(Exception):
+    """Raised when a model call can't get a slot, because too many calls are in flight and the wait queue is full or too slow"""
+    def __init__(self, message: str, retry_after: int):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    """Holds up to `burst` tokens and refills at `rate` tokens per second. Not thread safe, RateLimiter locks around it"""
+    def __init__(self, rate: float, burst: float, now: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = now
+
+
+    def take(self, now: float) -> float:
+        """Takes a token. Returns 0 if there was one, or the number of seconds until there will be"""
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+
+class RateLimiter:
+    """
+    Per-client token bucket rate limits. Each client can send `burst` requests at once, and `rate` per second after that.
+
+    Only the `max_clients` most recently seen clients are tracked. A client that was forgotten starts again with a full
+    bucket, which is what it would have had anyway after being idle that long.
+    """
+    def __init__(self, rate: float, burst: float, max_clients: int, proxy_hops: int = 1):
+        """
+        Args:
+            rate (float): Requests per second each client may send on average. 0 disables the limits.
+            burst (float): Requests a client may send at once.
+            max_clients (int): Number of clients whose buckets are kept.
+            proxy_hops (int): Number of proxies in front of the app that append the address they got a request from to X-Forwarded-For.
+        """
+        self.rate = rate
+        self.burst = max(1.0, burst)
+        self.max_clients = max_clients
+        self.proxy_hops = proxy_hops
+        self.buckets: OrderedDict[str, TokenBucket] = OrderedDict()
+        self.lock = threading.Lock()
+        self.allowed = 0
+        self.limited = 0
+
+
+    def client_key(self, forwarded_for: str, remote_addr: str) -> str:
+        """
+        Gets the address of the client that sent a request. Clients can put anything in X-Forwarded-For, so only the
+        addresses appended by our own proxies are trusted, and the client is the one the outermost proxy saw.
+        """
+        addresses = [address.strip() for address in (forwarded_for or "").split(",") if address.strip()]
+        if self.proxy_hops and len(addresses) >= self.proxy_hops:
+            return addresses[-self.proxy_hops]
+        return remote_addr or "unknown"
+
+
+    def acquire(self, client: str) -> float:
+        """
+        Counts a request from the client against its limit.
+
+        Returns:
+            (float) 0 if the request is allowed, or the number of seconds until the client may send another one
+        """
+        if self.rate <= 0:
+            return 0.0
+
+        now = time.monotonic()
+        with self.lock:
+            bucket = self.buckets.get(client)
+            if bucket is None:
+                bucket = TokenBucket(self.rate, self.burst, now)
+                self.buckets[client] = bucket
+                if len(self.buckets) > self.max_clients:
+                    self.buckets.popitem(last=False)
+            else:
+                self.buckets.move_to_end(client)
+
+            wait = bucket.take(now)
+            if wait:
+                self.limited += 1
+            else:
+                self.allowed += 1
+            return wait
+
+
+    def stats(self) -> Dict[str, Any]:
+        with self.lock:
+            return {"clients": len(self.buckets), "allowed": self.allowed, "limited": self.limited}
+
+
+class AdmissionController:
+    """
+    Caps the number of model calls in flight, so a burst of requests waits its turn instead of slowing every call down.
+
+    Interactive calls that find every slot taken wait in a bounded queue, and are rejected right away when the queue is
+    full or after waiting `max_wait` seconds, so a client gets a fast 429 with a Retry-After estimate instead of a slow
+    answer. Background calls (summaries) only get a slot while no interactive call is waiting, and never hold more than
+    `max_background` slots, so they can't push a user's message into the queue. They wait as long as it takes.
+    """
+    INTERACTIVE = "interactive"
+    BACKGROUND = "background"
+
+    def __init__(self, max_concurrent: int, max_queue: int, max_wait: float, max_background: int):
+        """
+        Args:
+            max_concurrent (int): Number of model calls that may be in flight at once.
+            max_queue (int): Number of interactive calls that may wait for a slot. Any more are rejected right away.
+            max_wait (float): Number of seconds an interactive call waits for a slot before it's rejected.
+            max_background (int): Number of slots background calls may hold at once.
+        """
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.max_background = max(1, min(max_background, max_concurrent))
+        self.condition = threading.Condition()
+        self.in_flight = {self.INTERACTIVE: 0, self.BACKGROUND: 0}
+        self.waiting = {self.INTERACTIVE: 0, self.BACKGROUND: 0}
+        self.admitted = {self.INTERACTIVE: 0, self.BACKGROUND: 0}
+        self.rejected = 0
+        self.queued = 0
+        self.average_hold = 1.0 # seconds a slot is held, as a moving average, for the Retry-After estimate
+        # async requests wait for a slot on these threads, one per queued request, so waiting never blocks the event loop
+        self.waiters = ThreadPoolExecutor(max_workers=max(1, max_queue), thread_name_prefix="admission")
+
+
+    def acquire(self, priority: str = INTERACTIVE) -> "Slot":
+        """
+        Waits for a slot. Release it with the returned slot's release(), or use it as a context manager.
+
+        Raises:
+            AdmissionRejected: if an interactive call can't get a slot in time
+        """
+        with self.condition:
+            if self.__can_admit(priority, queued=False):
+                return self.__admit(priority)
+
+            if priority == self.INTERACTIVE and self.waiting[priority] >= self.max_queue:
+                self.rejected += 1
+                raise AdmissionRejected("Too many requests in flight, try again shortly", self.__retry_after())
+
+            self.waiting[priority] += 1
+            self.queued += 1
+            deadline = time.monotonic() + self.max_wait if priority == self.INTERACTIVE else None
+            try:
+                while not self.__can_admit(priority, queued=True):
+                    remaining = deadline - time.monotonic() if deadline else None
+                    if remaining is not None and remaining <= 0:
+                        self.rejected += 1
+                        raise AdmissionRejected("Timed out waiting for a free model slot, try again shortly", self.__retry_after())
+                    self.condition.wait(remaining)
+            finally:
+                self.waiting[priority] -= 1
+                if priority == self.INTERACTIVE and not self.waiting[priority]:
+                    # background calls may have been held back by this one
+                    self.condition.notify_all()
+            return self.__admit(priority)
+
+
+    def try_acquire(self, priority: str = INTERACTIVE) -> Optional["Slot"]:
+        """Takes a slot if one is free right now, without waiting. Returns None if there isn't one"""
+        with self.condition:
+            if self.__can_admit(priority, queued=False):
+                return self.__admit(priority)
+            return None
+
+
+    async def acquire_async(self, priority: str = INTERACTIVE) -> "Slot":
+        """Same as acquire, but waits off the event loop. A slot acquired after the caller was cancelled is released"""
+        slot = self.try_acquire(priority)
+        if slot:
+            return slot
+
+        future = asyncio.get_running_loop().run_in_executor(self.waiters, self.acquire, priority)
+        try:
+            return await asyncio.shield(future)
+        except asyncio.CancelledError:
+            future.add_done_callback(lambda done: done.exception() is None and done.result().release())
+            raise
+
+
+    def stats(self) -> Dict[str, Any]:
+        with self.condition:
+            return {
+                "maxConcurrent": self.max_concurrent,
+                "inFlight": dict(self.in_flight),
+                "waiting": dict(self.waiting),
+                "admitted": dict(self.admitted),
+                "queued": self.queued,
+                "rejected": self.rejected,
+                "averageHoldSeconds": round(self.average_hold, 3),
+            }
+
+
+    def retry_after(self) -> int:
+        """Estimated number of seconds until a rejected call could get a slot"""
+        with self.condition:
+            return self.__retry_after()
+
+
+    def _release(self, priority: str, held: float):
+        with self.condition:
+            self.in_flight[priority] -= 1
+            self.average_hold += 0.1 * (held - self.average_hold)
+            self.condition.notify_all()
+
+
+    def __can_admit(self, priority: str, queued: bool) -> bool:
+        """Checks if a call can take a slot now. New interactive calls don't skip ahead of queued ones. Must hold self.condition"""
+        if sum(self.in_flight.values()) >= self.max_concurrent:
+            return False
+        if priority == self.INTERACTIVE:
+            return queued or not self.waiting[self.INTERACTIVE]
+        return not self.waiting[self.INTERACTIVE] and self.in_flight[self.BACKGROUND] < self.max_background
+
+
+    def __admit(self, priority: str) -> "Slot":
+        """Must hold self.condition"""
+        self.in_flight[priority] += 1
+        self.admitted[priority] += 1
+        return Slot(self, priority)
+
+
+    def __retry_after(self) -> int:
+        """Time for the calls ahead in the queue to get through every slot. Must hold self.condition"""
+        ahead = self.waiting[self.INTERACTIVE] + 1
+        return max(1, math.ceil(self.average_hold * ahead / self.max_concurrent))
+
+
+class Slot:
+    """A model call's place in an AdmissionController. Releasing it more than once does nothing"""
+    def __init__(self, controller: AdmissionController, priority: str):
+        self.controller = controller
+        self.priority = priority
+        self.acquired = time.monotonic()
+        self.released = False
+        self.lock = threading.Lock()
+
+
+    def release(self):
+        with self.lock:
+            if self.released:
+                return
+            self.released = True
+        self.controller._release(self.priority, time.monotonic() - self.acquired)
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *exc_info):
+        self.release()
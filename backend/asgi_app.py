@@ -0,0 +1,310 @@
+from quart import Quart, Response, request, jsonify, make_response, g
+from quart.wrappers.response import DataBody
+from chat_handler import GeminiChatHandler
+from chat_schema import *
+from response_compression import compress_body, COMPRESSIBLE_TYPES
+import asyncio
+import json
+import time
+
+# Async variant of main.py. Serves the same /api/gemini/* routes, but model calls are awaited and storage I/O stays
+# off the event loop, so one process can hold many requests in flight while they wait on Gemini or GCS.
+# Run with an ASGI server, e.g. hypercorn asgi_app:app --bind 0.0.0.0:8080
+# To use every core, run several workers and set WEB_WORKERS to match, so they share chat changes with each other.
+# Only the gcs chat store can be shared by several workers:
+#   WEB_WORKERS=4 hypercorn asgi_app:app --bind 0.0.0.0:8080 --workers 4
+app = Quart(__name__)
+
+chat_handler = GeminiChatHandler()
+
+# routes that answer while the server is still starting
+STARTUP_ROUTES = {"liveness", "readiness", "get_metrics"}
+# routes that send messages to the model, and count against the client's rate limit
+RATE_LIMITED_ROUTES = {"handle_user_request", "handle_user_request_stream"}
+
+
+@app.before_request
+async def start_request_timer():
+    g.request_start = time.perf_counter()
+
+
+@app.before_request
+async def wait_for_startup():
+    # the handler loads chats and builds the models in the background, so requests that need them wait until it's done
+    if request.endpoint not in STARTUP_ROUTES and not await chat_handler.wait_until_ready_async():
+        return jsonify("Server is starting, try again shortly"), 503
+    if request.endpoint not in STARTUP_ROUTES:
+        await chat_handler.sync_workers_async()
+
+
+@app.before_request
+async def check_rate_limit():
+    if request.endpoint in RATE_LIMITED_ROUTES:
+        retry_after = chat_handler.check_rate_limit(request.headers.get("X-Forwarded-For", ""), request.remote_addr)
+        if retry_after:
+            return jsonify("Too many messages, slow down"), 429, {"Retry-After": str(retry_after)}
+
+
+@app.after_request
+async def record_request_time(response):
+    route = request.url_rule.rule if request.url_rule else "unmatched"
+    chat_handler.metrics.observe_request(route, request.method, response.status_code, time.perf_counter() - g.request_start)
+    return response
+
+
+@app.after_request
+async def flush_for_workers(response):
+    await chat_handler.flush_for_workers_async()
+    return response
+
+
+@app.after_request
+async def add_retry_after(response):
+    if response.status_code == 429 and "Retry-After" not in response.headers:
+        response.headers["Retry-After"] = str(chat_handler.get_retry_after())
+    return response
+
+
+@app.after_request
+async def compress_response(response):
+    # like main.py, streamed bodies are left alone, since reading them here would buffer the whole stream
+    if not isinstance(response.response, DataBody) or response.mimetype not in COMPRESSIBLE_TYPES or "Content-Encoding" in response.headers:
+        return response
+    response.vary.add("Accept-Encoding")
+    compressed = compress_body(await response.get_data(), response.mimetype, request.headers.get("Accept-Encoding", ""))
+    if compressed:
+        response.set_data(compressed[0])
+        response.headers["Content-Encoding"] = compressed[1]
+    return response
+
+
+@app.route("/api/gemini/request", methods=['POST'])
+async def handle_user_request():
+    data = await request.get_json()
+    user_input = data.get("prompt", "")
+    session_id = data.get("sessionId", "")
+
+    if not user_input:
+        return jsonify("Prompt is required"), 400
+
+    if not session_id:
+        return jsonify("Session ID is required"), 400
+
+    if not is_valid_session_id(session_id):
+        return jsonify("Invalid session ID"), 400
+
+    response, status_code = await chat_handler.send_message_async(session_id, user_input)
+    return jsonify(response), status_code
+
+
+@app.route("/api/gemini/request_stream", methods=['POST'])
+async def handle_user_request_stream():
+    """Streams the model's response back as server-sent events. See main.py for the event format"""
+    data = await request.get_json()
+    user_input = data.get("prompt", "")
+    session_id = data.get("sessionId", "")
+
+    if not user_input:
+        return jsonify("Prompt is required"), 400
+
+    if not session_id:
+        return jsonify("Session ID is required"), 400
+
+    if not is_valid_session_id(session_id):
+        return jsonify("Invalid session ID"), 400
+
+    response, status_code = await chat_handler.stream_message_async(session_id, user_input)
+    if status_code != 200:
+        return jsonify(response), status_code
+
+    async def event_stream():
+        try:
+            async for text in response:
+                yield f"data: {json.dumps(text, ensure_ascii=False)}\n\n".encode("utf-8")
+            yield b"event: done\ndata: \"\"\n\n"
+
+        except Exception as e:
+            yield f"event: error\ndata: {json.dumps(str(e))}\n\n".encode("utf-8")
+
+        finally:
+            # closing the reply generator is what rolls back the chat when the client disconnects mid-stream
+            await response.aclose()
+
+    headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    return Response(event_stream(), mimetype="text/event-stream", headers=headers)
+
+
+@app.route("/api/gemini/new_chat", methods=['POST'])
+async def start_new_chat():
+        data = await request.get_json(silent=True) or {}
+        session_id = data.get("sessionId", "")
+
+        if session_id and not is_valid_session_id(session_id):
+            return jsonify("Invalid session ID"), 400
+
+        response, status_code = await chat_handler.start_new_chat_async(session_id)
+        print("New Session ID: ", response)
+        return jsonify(response), status_code
+
+
+@app.route("/api/gemini/load_chat", methods=['GET', 'POST'])
+async def load_chat():
+    """See main.py"""
+    data = request.args if request.method == "GET" else await request.get_json()
+    session_id = data.get("sessionId", "")
+    limit = data.get("limit")
+    cursor = str(data.get("cursor", ""))
+
+    if not session_id:
+        return jsonify("Session ID is required"), 400
+
+    if not is_valid_session_id(session_id):
+        return jsonify("Invalid session ID"), 400
+
+    if limit is not None and (not str(limit).isdigit() or int(limit) < 1):
+        return jsonify("Limit must be a positive number"), 400
+    limit = int(limit) if limit is not None else None
+
+    if request.method == "GET":
+        # getting the tag may load the chat's history from the store, so it's done off the event loop
+        etag = await asyncio.to_thread(chat_handler.get_chat_etag, session_id, limit, cursor)
+        if etag and request.if_none_match.contains_weak(etag):
+            await chat_handler.prime_chat_async(session_id)
+            response = await make_response("", 304)
+            response.set_etag(etag, weak=True)
+            return response
+
+    response, status_code = await chat_handler.load_chat_async(session_id, limit, cursor)
+    response = await make_response(jsonify(response), status_code)
+    if request.method == "GET" and status_code == 200:
+        response.set_etag(etag, weak=True)
+        response.headers["Cache-Control"] = "private, no-cache"
+    return response
+
+
+@app.route("/api/gemini/current_session_id", methods=['GET'])
+async def get_current_session_id():
+    """Deprecated. See main.py"""
+    session_id = chat_handler.create_session_id()
+    return jsonify(session_id), 200
+
+
+@app.route("/api/gemini/all_chat_summaries", methods=['GET'])
+async def get_all_chat_summaries():
+    """
+    Returns the sessionId, summary and timestamp of chats, most recent first.
+    Pass "limit" to get a page of summaries, and the X-Next-Cursor header of the response as "cursor" to get the next page.
+    Responds with 304 if the If-None-Match header matches the current ETag.
+    """
+    limit = request.args.get("limit", type=int)
+    cursor = request.args.get("cursor", "")
+    
+    # the ETag is checked before building the page, so unchanged summaries cost nothing to serve
+    etag = chat_handler.get_chat_summaries_etag()
+    if request.if_none_match.contains_weak(etag):
+        response = await make_response("", 304)
+        response.set_etag(etag, weak=True)
+        return response
+    
+    chat_summaries, next_cursor = chat_handler.get_chat_summaries(limit, cursor)
+    
+    response = await make_response(jsonify(chat_summaries), 200)
+    response.set_etag(etag, weak=True)
+    if next_cursor:
+        response.headers["X-Next-Cursor"] = next_cursor
+    return response
+
+
+@app.route("/api/gemini/search", methods=['GET'])
+async def search_chats():
+    """See main.py"""
+    query = request.args.get("q", "")
+    limit = request.args.get("limit", 10, type=int)
+
+    # searching reads the stored copy of chats whose history isn't loaded, so it's done off the event loop
+    response, status_code = await asyncio.to_thread(chat_handler.search, query, limit)
+    return jsonify(response), status_code
+
+
+@app.route("/api/gemini/storage_stats", methods=['GET'])
+async def get_storage_stats():
+    """Returns how far behind the background writer is in saving chats"""
+    return jsonify(chat_handler.get_storage_stats()), 200
+
+
+@app.route("/api/gemini/token_stats", methods=['GET'])
+async def get_token_stats():
+    """Returns how many tokens were sent to the model, compared to sending every chat's full history"""
+    return jsonify(chat_handler.get_token_stats()), 200
+
+
+@app.route("/api/gemini/cache_stats", methods=['GET'])
+async def get_cache_stats():
+    """Returns the hit and miss counts of the response and summary caches"""
+    return jsonify(chat_handler.get_cache_stats()), 200
+
+
+@app.route("/api/gemini/model_stats", methods=['GET'])
+async def get_model_stats():
+    """Returns how often model calls were retried, hedged or timed out, and whether the circuit breaker is open"""
+    return jsonify(chat_handler.get_model_stats()), 200
+
+
+@app.route("/api/gemini/admission_stats", methods=['GET'])
+async def get_admission_stats():
+    """Returns how many messages were rate limited, and how many model calls are in flight, queued or were turned away"""
+    return jsonify(chat_handler.get_admission_stats()), 200
+
+
+@app.route("/healthz", methods=['GET'])
+async def liveness():
+    """See main.py"""
+    return jsonify("ok"), 200
+
+
+@app.route("/readyz", methods=['GET'])
+async def readiness():
+    """See main.py"""
+    response, status_code = chat_handler.get_readiness()
+    return jsonify(response), status_code
+
+
+@app.route("/metrics", methods=['GET'])
+async def get_metrics():
+    """See main.py"""
+    return Response(chat_handler.get_metrics(), mimetype="text/plain; version=0.0.4")
+
+
+@app.route("/api/gemini/delete_chats", methods=['DELETE'])
+async def delete_chats():
+    data = await request.get_json()
+    session_ids = data.get("sessionIds", [])
+    older_than = data.get("olderThan", "")
+    delete_all = data.get("all", False) is True
+
+    if not isinstance(session_ids, list):
+        return jsonify("sessionIds must be a list"), 400
+
+    if not isinstance(older_than, str):
+        return jsonify("olderThan must be an ISO 8601 time"), 400
+
+    if not session_ids and not older_than and not delete_all:
+        return jsonify("Session ID is required"), 400
+
+    if not all(is_valid_session_id(session_id) for session_id in session_ids):
+        return jsonify("Invalid session ID"), 400
+
+    response, status_code = await chat_handler.delete_chats_async(session_ids, older_than, delete_all)
+    return jsonify(response), status_code
+
+
+@app.route("/api/gemini/close", methods=['POST'])
+async def close_app():
+    """See main.py"""
+    print("closing handler")
+    response, status_code = chat_handler.close_handler()
+
+    if status_code != 200:
+        print(f"Something went wrong when closing the handler.\nError {status_code}: {response}")
+
+    return jsonify(response), status_code
@@ -0,0 +1,104 @@
+"""
+Helpers shared by the benchmark scripts: running the app against the fake model and in-memory store, serving it
+locally, and timing requests.
+"""
+import asyncio
+import json
+import logging
+import os
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+from typing import Optional, Tuple
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+
+
+def add_fake_arguments(parser):
+    """Adds the options of the fake model and the storage stand-in to an argument parser"""
+    parser.add_argument("--latency", type=float, default=0.5, help="fake model latency before the first token, in seconds")
+    parser.add_argument("--tokens-per-second", type=float, default=0, help="fake model generation rate. 0 replies instantly after the latency")
+    parser.add_argument("--failure-rate", type=float, default=0, help="fraction of fake model calls that fail")
+    parser.add_argument("--max-concurrent", type=int, default=0, help="model calls in flight at once. 0 keeps the app's default")
+    parser.add_argument("--storage-latency", type=float, default=0.2, help="latency of every call to the in-memory chat store, in seconds")
+
+
+def use_fakes(args):
+    """
+    Selects the fake model and the in-memory chat store. Must be called before the app modules are imported, since they
+    read their configuration from the environment on import.
+    """
+    os.environ["MODEL_PROVIDER"] = "fake"
+    os.environ["CHAT_STORE"] = "memory"
+    os.environ["FAKE_MODEL_LATENCY"] = str(args.latency)
+    os.environ["FAKE_MODEL_TOKENS_PER_SECOND"] = str(args.tokens_per_second)
+    os.environ["FAKE_MODEL_FAILURE_RATE"] = str(args.failure_rate)
+    os.environ["MEMORY_STORE_LATENCY"] = str(args.storage_latency)
+    # every request comes from the same address, so the per-client rate limit is off. The model slot cap stays on
+    os.environ["RATE_LIMIT_PER_MINUTE"] = "0"
+    if getattr(args, "max_concurrent", None):
+        os.environ["MAX_CONCURRENT_MODEL_CALLS"] = str(args.max_concurrent)
+    # the handler reads model_config.txt relative to the working directory
+    os.chdir(BACKEND_DIR)
+
+
+def serve_flask(port: int):
+    """Serves main.py on a background thread, with the same threading model as app.run()"""
+    from werkzeug.serving import make_server
+    import main
+
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+    server = make_server("127.0.0.1", port, main.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return main.chat_handler
+
+
+def serve_asgi(port: int):
+    """Serves asgi_app.py with hypercorn on a background thread"""
+    from hypercorn.asyncio import serve
+    from hypercorn.config import Config
+    import asgi_app
+
+    config = Config()
+    config.bind = [f"127.0.0.1:{port}"]
+    config.backlog = 2048
+    config.loglevel = "WARNING"
+    # a shutdown trigger that never fires stops hypercorn from installing signal handlers, which only work on the main thread
+    never = lambda: asyncio.Event().wait()
+    threading.Thread(target=lambda: asyncio.run(serve(asgi_app.app, config, shutdown_trigger=never)), daemon=True).start()
+    return asgi_app.chat_handler
+
+
+def send(port: int, method: str, path: str, body: Optional[dict] = None) -> Tuple[float, int]:
+    """Sends a request to the local app and reads the whole response. Returns (latency in seconds, status code)"""
+    data = json.dumps(body).encode("utf-8") if body is not None else None
+    req = urllib.request.Request(f"http://127.0.0.1:{port}{path}", data=data, method=method, headers={"Content-Type": "application/json"})
+
+    start = time.perf_counter()
+    try:
+        with urllib.request.urlopen(req, timeout=120) as response:
+            response.read()
+            status = response.status
+    except urllib.error.HTTPError as e:
+        e.read()
+        status = e.code
+    return time.perf_counter() - start, status
+
+
+def wait_until_up(port: int):
+    for _ in range(100):
+        try:
+            send(port, "GET", "/api/gemini/current_session_id")
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f"Server on port {port} did not start")
+
+
+def percentile(values, pct: float) -> float:
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
@@ -0,0 +1,62 @@
+"""
+Load benchmark comparing the Flask app (main.py) with the async app (asgi_app.py).
+
+Both apps are served locally against the fake model (MODEL_PROVIDER=fake) and the in-memory chat store
+(CHAT_STORE=memory), which sleep instead of calling Gemini and GCS. Every request uses its own session ID, so the
+numbers show how many model calls a single process can keep in flight at once. Past --max-concurrent calls, messages
+queue for a model slot and are turned away with a 429 once the queue is full, which the 429s column counts.
+See route_benchmark.py for every route.
+
+Usage:
+    python benchmarks/load_benchmark.py --latency 0.5 --concurrency 1 10 50 100 200
+"""
+import argparse
+import statistics
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from bench_utils import add_fake_arguments, use_fakes, serve_flask, serve_asgi, send, wait_until_up, percentile
+
+FLASK_PORT = 5055
+ASGI_PORT = 5056
+
+
+def send_request(port: int):
+    """Sends one message in a new chat. Returns (latency in seconds, status code)"""
+    # a unique prompt, so the reply never comes from the response cache
+    session_id = str(uuid.uuid4())
+    return send(port, "POST", "/api/gemini/request", {"prompt": f"motivate me {session_id}", "sessionId": session_id})
+
+
+def run_load(port: int, concurrency: int, rounds: int):
+    """Runs `rounds` requests per worker with `concurrency` workers. Returns (latencies, number of 429s, wall time)"""
+    total = concurrency * rounds
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(lambda _: send_request(port), range(total)))
+    return [latency for latency, _ in results], sum(1 for _, status in results if status == 429), time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    add_fake_arguments(parser)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 10, 50, 100, 200])
+    parser.add_argument("--rounds", type=int, default=3, help="requests sent by each concurrent client")
+    args = parser.parse_args()
+
+    use_fakes(args)
+    serve_flask(FLASK_PORT)
+    serve_asgi(ASGI_PORT)
+
+    print(f"{'app':<6} {'clients':>8} {'requests':>9} {'req/s':>8} {'p50 (s)':>8} {'p95 (s)':>8} {'max (s)':>8} {'429s':>6}")
+    for name, port in (("flask", FLASK_PORT), ("asgi", ASGI_PORT)):
+        wait_until_up(port)
+        for concurrency in args.concurrency:
+            latencies, rejected, elapsed = run_load(port, concurrency, args.rounds)
+            print(f"{name:<6} {concurrency:>8} {len(latencies):>9} {len(latencies) / elapsed:>8.1f} "
+                  f"{statistics.median(latencies):>8.3f} {percentile(latencies, 95):>8.3f} {max(latencies):>8.3f} {rejected:>6}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+"""
+End-to-end latency benchmark for every /api/gemini/* route.
+
+The app is served locally against the fake model (MODEL_PROVIDER=fake) and the in-memory chat store
+(CHAT_STORE=memory), so it runs offline and without an API key. For each history size, chats are seeded with that many
+turns, then every route is driven by a pool of concurrent clients. Each route reports its throughput and its p50, p95
+and p99 latency. Run it before and after a change to compare.
+
+Usage:
+    python benchmarks/route_benchmark.py --app flask --concurrency 1 10 50 --history-turns 0 20 200
+    python benchmarks/route_benchmark.py --app asgi --latency 1 --tokens-per-second 50 --failure-rate 0.05
+"""
+import argparse
+import statistics
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from bench_utils import add_fake_arguments, use_fakes, serve_flask, serve_asgi, send, wait_until_up, percentile
+
+PORTS = {"flask": 5057, "asgi": 5058}
+SUMMARY_PAGE_SIZE = 20
+HISTORY_PAGE_SIZE = 20 # messages per page for load_chat_page
+
+
+def seed_chats(handler, count: int, turns: int):
+    """Adds `count` chats with `turns` user/model turns each to the app's handler. Returns their session IDs"""
+    from chat_schema import Chat, Message
+
+    session_ids = []
+    for _ in range(count):
+        chat = Chat()
+        for turn in range(turns):
+            chat.add_message(Message(role="user", parts=[f"Turn {turn}: I need some motivation to keep going with my project."]))
+            chat.add_message(Message(role="model", parts=[f"Turn {turn}: You got this! Every small step counts, so keep going."]))
+        chat.set_summary("Seeded Chat")
+        handler.all_chats.add_chat(chat)
+        session_ids.append(chat.sessionId)
+    return session_ids
+
+
+def routes(handler, count: int, turns: int):
+    """
+    Returns (route name, function sending one request) for every route. Routes that change chats get their own seeded
+    chats, so one route's requests don't change what another route is measured on.
+    """
+    def seeded():
+        ids = iter(seed_chats(handler, count, turns))
+        return lambda: next(ids)
+
+    request_chat, stream_chat, new_chat, load_chat, page_chat, delete_chat = seeded(), seeded(), seeded(), seeded(), seeded(), seeded()
+
+    def prompt():
+        # a unique prompt, so first messages never come from the response cache
+        return f"motivate me {uuid.uuid4()}"
+
+    return [
+        ("request", lambda port: send(port, "POST", "/api/gemini/request", {"prompt": prompt(), "sessionId": request_chat()})),
+        ("request_stream", lambda port: send(port, "POST", "/api/gemini/request_stream", {"prompt": prompt(), "sessionId": stream_chat()})),
+        ("new_chat", lambda port: send(port, "POST", "/api/gemini/new_chat", {"sessionId": new_chat()})),
+        ("load_chat", lambda port: send(port, "POST", "/api/gemini/load_chat", {"sessionId": load_chat()})),
+        ("load_chat_page", lambda port: send(port, "GET", f"/api/gemini/load_chat?sessionId={page_chat()}&limit={HISTORY_PAGE_SIZE}")),
+        ("current_session_id", lambda port: send(port, "GET", "/api/gemini/current_session_id")),
+        ("all_chat_summaries", lambda port: send(port, "GET", f"/api/gemini/all_chat_summaries?limit={SUMMARY_PAGE_SIZE}")),
+        ("storage_stats", lambda port: send(port, "GET", "/api/gemini/storage_stats")),
+        ("token_stats", lambda port: send(port, "GET", "/api/gemini/token_stats")),
+        ("cache_stats", lambda port: send(port, "GET", "/api/gemini/cache_stats")),
+        ("search", lambda port: send(port, "GET", "/api/gemini/search?q=motivate+exam&limit=10")),
+        ("delete_chats", lambda port: send(port, "DELETE", "/api/gemini/delete_chats", {"sessionIds": [delete_chat()]})),
+        ("close", lambda port: send(port, "POST", "/api/gemini/close")),
+    ]
+
+
+def run_route(port: int, send_one, concurrency: int, total: int):
+    """Sends `total` requests with `concurrency` clients. Returns (latencies, number of error responses, wall time)"""
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(lambda _: send_one(port), range(total)))
+    elapsed = time.perf_counter() - start
+
+    latencies = [latency for latency, _ in results]
+    errors = sum(1 for _, status in results if status >= 400)
+    return latencies, errors, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    add_fake_arguments(parser)
+    parser.add_argument("--app", choices=["flask", "asgi", "both"], default="both")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 10, 50])
+    parser.add_argument("--history-turns", type=int, nargs="+", default=[0, 20, 200], help="turns in each seeded chat")
+    parser.add_argument("--rounds", type=int, default=3, help="requests sent by each concurrent client, per route")
+    parser.add_argument("--routes", nargs="+", help="only run these routes")
+    args = parser.parse_args()
+
+    use_fakes(args)
+    apps = ["flask", "asgi"] if args.app == "both" else [args.app]
+    handlers = {"flask": serve_flask, "asgi": serve_asgi}
+
+    print(f"{'app':<6} {'route':<19} {'turns':>6} {'clients':>8} {'requests':>9} {'errors':>7} {'req/s':>8} "
+          f"{'p50 (s)':>8} {'p95 (s)':>8} {'p99 (s)':>8}")
+    for app in apps:
+        port = PORTS[app]
+        handler = handlers[app](port)
+        wait_until_up(port)
+
+        for turns in args.history_turns:
+            for concurrency in args.concurrency:
+                total = concurrency * args.rounds
+                for route, send_one in routes(handler, total, turns):
+                    if args.routes and route not in args.routes:
+                        continue
+                    latencies, errors, elapsed = run_route(port, send_one, concurrency, total)
+                    print(f"{app:<6} {route:<19} {turns:>6} {concurrency:>8} {total:>9} {errors:>7} {total / elapsed:>8.1f} "
+                          f"{statistics.median(latencies):>8.3f} {percentile(latencies, 95):>8.3f} {percentile(latencies, 99):>8.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+"""
+Microbenchmarks of the schema layer: validating, dumping and serializing chats of different sizes.
+
+Each operation is repeated until it has run for about --seconds, and the mean time per call is reported in
+microseconds. "get_history (cold)" builds the model-ready history from scratch, "get_history (warm)" reuses the
+cached view, and "get_history (+1)" is a call after a single message was added.
+
+Usage:
+    python benchmarks/schema_benchmark.py --messages 10 100 1000 5000
+"""
+import argparse
+import time
+
+from bench_utils import BACKEND_DIR  # noqa: F401, puts the backend on the path
+from chat_schema import Chat, Message
+from chat_codec import encode_chat, decode_chat
+
+
+def make_chat(num_messages: int) -> Chat:
+    chat = Chat()
+    for i in range(num_messages):
+        if i % 2 == 0:
+            chat.add_message(Message(role="user", parts=[f"Message {i}: I have an exam tomorrow and I can't focus at all."]))
+        else:
+            chat.add_message(Message(role="model", parts=[f"Message {i}: You've prepared for this! Take a short break, breathe, and start with one small topic."]))
+    return chat
+
+
+def measure(func, seconds: float) -> float:
+    """Mean time of func in microseconds"""
+    calls = 0
+    start = time.perf_counter()
+    while True:
+        func()
+        calls += 1
+        elapsed = time.perf_counter() - start
+        if elapsed >= seconds:
+            return elapsed / calls * 1e6
+
+
+def operations(chat: Chat):
+    json_data = chat.model_dump_json()
+    gzip_data = encode_chat(chat, "gzip")
+
+    def cold_history():
+        chat._history_view = ([], None)
+        chat.get_history()
+
+    def add_one():
+        chat.add_message(Message(role="user", parts=["one more"]))
+        chat.get_history()
+        chat.pop_message()
+
+    return [
+        ("Message()", lambda: Message(role="user", parts=["hello"])),
+        ("model_validate_json", lambda: Chat.model_validate_json(json_data)),
+        ("model_dump", lambda: chat.model_dump()),
+        ("model_dump_json", lambda: chat.model_dump_json()),
+        ("get_history (cold)", cold_history),
+        ("get_history (warm)", lambda: chat.get_history()),
+        ("get_history (+1)", add_one),
+        ("encode gzip", lambda: encode_chat(chat, "gzip")),
+        ("decode gzip", lambda: decode_chat(gzip_data)),
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--messages", type=int, nargs="+", default=[10, 100, 1000, 5000], help="messages in each chat")
+    parser.add_argument("--seconds", type=float, default=0.5, help="time to spend on each measurement")
+    args = parser.parse_args()
+
+    print(f"{'operation':<22} " + " ".join(f"{f'{n} msgs (us)':>16}" for n in args.messages))
+    results = {}
+    for num_messages in args.messages:
+        for name, func in operations(make_chat(num_messages)):
+            results.setdefault(name, []).append(measure(func, args.seconds))
+
+    for name, times in results.items():
+        print(f"{name:<22} " + " ".join(f"{t:>16.1f}" for t in times))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+"""
+Cold start benchmark: how long a fresh process takes to import its dependencies, bind its port, become ready, and answer
+its first chat request.
+
+Every measurement runs in a new Python process, so nothing is cached in memory between runs. The app runs against the
+fake model (MODEL_PROVIDER=fake) and the in-memory chat store (CHAT_STORE=memory), with --storage-latency standing in for
+listing the chats in GCS. The import table shows what each heavy dependency costs on its own; with the real model,
+google.generativeai is imported by the background warm-up instead of before the port is bound.
+
+Usage:
+    python benchmarks/startup_benchmark.py --runs 5
+    python benchmarks/startup_benchmark.py --app asgi --storage-latency 1
+"""
+import argparse
+import os
+import subprocess
+import sys
+import time
+import uuid
+
+from bench_utils import BACKEND_DIR, add_fake_arguments, use_fakes, serve_flask, serve_asgi, send
+
+MODULES = ["flask", "pydantic", "google.generativeai", "google.cloud.storage", "main"]
+POLL_INTERVAL = 0.005
+
+
+def import_time(module: str) -> float:
+    """Seconds a fresh interpreter takes to import the module"""
+    code = f"import sys, time; sys.path.insert(0, {BACKEND_DIR!r}); start = time.perf_counter(); import {module}; print(time.perf_counter() - start)"
+    result = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, cwd=BACKEND_DIR)
+    if result.returncode:
+        return float("nan")
+    return float(result.stdout.strip().splitlines()[-1])
+
+
+def poll(port: int, method: str, path: str, body=None) -> float:
+    """Sends the request until it succeeds. Returns the time it succeeded at"""
+    while True:
+        try:
+            _, status = send(port, method, path, body)
+            if status < 400:
+                return time.perf_counter()
+        except OSError:
+            pass
+        time.sleep(POLL_INTERVAL)
+
+
+def cold_start(args, port: int):
+    """Starts the app in a new process. Returns the seconds until it was live, ready, and had answered a chat request"""
+    command = [sys.executable, os.path.abspath(__file__), "--serve", str(port), "--app", args.app,
+               "--latency", str(args.latency), "--storage-latency", str(args.storage_latency)]
+    start = time.perf_counter()
+    process = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        live = poll(port, "GET", "/healthz")
+        ready = poll(port, "GET", "/readyz")
+        replied = poll(port, "POST", "/api/gemini/request", {"prompt": "I need some motivation", "sessionId": str(uuid.uuid4())})
+    finally:
+        process.kill()
+        process.wait()
+    return live - start, ready - start, replied - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    add_fake_arguments(parser)
+    parser.add_argument("--app", choices=["flask", "asgi"], default="flask")
+    parser.add_argument("--runs", type=int, default=3, help="cold starts to measure")
+    parser.add_argument("--port", type=int, default=8110, help="first port to serve on. Each run uses the next one")
+    parser.add_argument("--serve", type=int, help=argparse.SUPPRESS) # used by the benchmark to start the app in a child process
+    args = parser.parse_args()
+    use_fakes(args)
+
+    if args.serve:
+        (serve_asgi if args.app == "asgi" else serve_flask)(args.serve)
+        while True:
+            time.sleep(60)
+
+    print(f"{'import':<24} {'seconds':>8}")
+    for module in MODULES:
+        print(f"{module:<24} {import_time(module):>8.3f}")
+
+    print(f"\n{'run':<6} {'live':>8} {'ready':>8} {'1st reply':>10}")
+    for run in range(args.runs):
+        live, ready, replied = cold_start(args, args.port + run)
+        print(f"{run + 1:<6} {live:>8.3f} {ready:>8.3f} {replied:>10.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+from chat_schema import Chat, Tombstone
+from typing import Optional
+import gzip
+import json
+
+# Formats chats can be stored in. "json" is minified JSON, which is also how chats were stored before compression was
+# added. The compressed formats hold the same JSON. A more compact layout without the repeated "role" and "parts" keys
+# was measured too, but it only saved a couple of percent once compressed, and parsing it in Python was about 3x slower
+# than letting pydantic parse the JSON directly.
+FORMATS = ("json", "gzip", "zstd")
+GZIP_MAGIC = b"\x1f\x8b"
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+GZIP_LEVEL = 3 # about 3x faster than the default of 6, for slightly bigger output
+ZSTD_LEVEL = 10
+CONTENT_TYPES = {"json": "application/json", "gzip": "application/gzip", "zstd": "application/zstd"}
+TOMBSTONE_PREFIX = b'{"deleted":' # tombstones are always stored as plain JSON starting with this key
+
+
+def check_format(format: str):
+    """Raises ValueError if chats can't be stored in the given format"""
+    if format not in FORMATS:
+        raise ValueError(f"Unknown chat format {format}. Expected one of {', '.join(FORMATS)}.")
+    if format == "zstd":
+        _import_zstandard()
+
+
+def encode_chat(chat: Chat, format: str) -> bytes:
+    """Serializes a chat in the given format"""
+    data = chat.model_dump_json().encode("utf-8")
+    if format == "json":
+        return data
+    if format == "zstd":
+        return _import_zstandard().ZstdCompressor(level=ZSTD_LEVEL).compress(data)
+    return gzip.compress(data, compresslevel=GZIP_LEVEL, mtime=0)
+
+
+def decode_chat(data: bytes) -> Chat:
+    """Parses a chat stored in any format. The format is detected from the data, so stores can hold a mix of formats"""
+    if data.startswith(GZIP_MAGIC):
+        data = gzip.decompress(data)
+    elif data.startswith(ZSTD_MAGIC):
+        data = _import_zstandard().ZstdDecompressor().decompress(data)
+    return Chat.model_validate_json(data)
+
+
+def encode_tombstone(tombstone: Tombstone) -> bytes:
+    """Serializes the tombstone that replaces a deleted chat in a shared store"""
+    return json.dumps({"deleted": tombstone.timestamp, "sessionId": tombstone.sessionId}, separators=(",", ":")).encode("utf-8")
+
+
+def decode_tombstone(data: bytes) -> Optional[Tombstone]:
+    """Parses a tombstone, or returns None if the data is a chat"""
+    if not data.startswith(TOMBSTONE_PREFIX):
+        return None
+    fields = json.loads(data)
+    return Tombstone(fields["sessionId"], fields["deleted"])
+
+
+def _import_zstandard():
+    try:
+        import zstandard
+    except ImportError:
+        raise ValueError("The zstd chat format needs the zstandard package. Install it with pip install zstandard.")
+    return zstandard
@@ -1,30 +1,306 @@
-import google.generativeai as genai
-from google.generativeai.types import HarmCategory, HarmBlockThreshold
 from dotenv import load_dotenv
 import os
 import json
+import math
+import asyncio
+import atexit
+import hashlib
+import threading
+import time
+import weakref
+from typing import Optional
 from chat_schema import *
+from chat_store import create_chat_store, TimedChatStore
+from session_pool import SessionPool
+from persistence_queue import WriteBehindQueue
+from summary_worker import SummaryWorker
+from context_policy import ContextPolicy, TokenStats
+from response_cache import ResponseCache, normalize_prompt, context_key
+from model_calls import ModelCaller, CircuitBreaker, CircuitOpenError, ModelTimeoutError
+from metrics import Metrics
+from shared_state import SharedJournal
+from admission import RateLimiter, AdmissionController, AdmissionRejected
 
 MODEL_NAME = "gemini-1.5-flash"
 CONFIG_FILE = "model_config.txt"
 GENERATE_SUMMARY_PROMPT_FILE = "summary_prompt.txt"
 BUCKET_NAME = "motivational-chatbot-history"
-CHAT_HISTORY_FILE = "history.json"
+CHAT_HISTORY_FILE = "history.json" # legacy layout with every chat in one file, only read when there are no per-chat objects yet
+CHAT_HISTORY_PREFIX = "chats/"
 SERVICE_ACCOUNT_KEY_FILE = "credentials/service-account-key.json"
-TIMEOUT_DURATION = 10 #seconds
+CHAT_STORE = os.getenv("CHAT_STORE", "gcs") # gcs, local, sqlite or memory
+MODEL_PROVIDER = os.getenv("MODEL_PROVIDER", "gemini") # gemini, or fake to run without an API key. See fake_model.py
+LOCAL_CHAT_DIR = "chats"
+SQLITE_CHAT_DB = "chats.db"
+CHAT_FORMAT = os.getenv("CHAT_FORMAT", "gzip") # json, gzip or zstd. Used by the gcs, local and memory stores, which read every format
+MEMORY_STORE_LATENCY = float(os.getenv("MEMORY_STORE_LATENCY", "0")) # seconds, to stand in for a remote store in benchmarks
+WEB_WORKERS = int(os.getenv("WEB_WORKERS", "1")) # processes serving the app. With more than one they share chat changes through SHARED_STATE_DB, and need the gcs store
+SHARED_STATE_DB = os.getenv("SHARED_STATE_DB", "shared_state.db")
+TIMEOUT_DURATION = 10 #seconds, for each attempt at a model call
+MODEL_RETRIES = 2
+RETRY_BACKOFF = 0.5 #seconds, doubled on every retry
+HEDGE_DELAY = 4 #seconds without a response before a second attempt is started. 0 disables hedging
+CIRCUIT_FAILURE_THRESHOLD = 5 # failed model calls in a row before calls start failing fast
+CIRCUIT_RESET_TIMEOUT = 30 #seconds
+MODEL_CALL_WORKERS = 256 # threads waiting on model calls for sync requests
+SUMMARY_PROMPT = "Summarize this conversation in less than 5 words. Don't use emojis or punctuation. Write the summary in title case."
+SUMMARY_BATCH_PROMPT = "Summarize each of these conversations in less than 5 words. Don't use emojis or punctuation. Write each summary in title case. Answer with the id and summary of every conversation."
+SUMMARY_WORKERS = 4 # threads generating summaries. Their model calls are capped by MAX_BACKGROUND_MODEL_CALLS too
+SUMMARY_BATCH_SIZE = 8 # chats summarized in one model request
+SUMMARY_BATCH_MAX_CHARS = 4000 # histories longer than this are summarized in a request of their own
+SUMMARY_BATCH_TOKENS_PER_CHAT = 30 # output tokens allowed for each chat in a batch, including its JSON
+SUMMARY_BATCH_SCHEMA = {
+    "type": "array",
+    "items": {
+        "type": "object",
+        "properties": {"id": {"type": "string"}, "summary": {"type": "string"}},
+        "required": ["id", "summary"],
+    },
+}
+MAX_LIVE_SESSIONS = 256
+SESSION_TTL = 30 * 60 #seconds
+MAX_LIVE_HISTORY_BYTES = 32 * 1024 * 1024
+FLUSH_INTERVAL = 2 #seconds
+SHARED_FLUSH_INTERVAL = 0 # with several workers, changes are saved right away so the next request sees them on any worker
+MAX_RESIDENT_HISTORIES = 1000
+HISTORY_IDLE_EVICTION = SESSION_TTL
+CONTEXT_TOKEN_BUDGET = 8000 # estimated tokens of history sent to the model before older turns are summarized
+CONTEXT_KEEP_LAST_TURNS = 10
+CONTEXT_SUMMARY_PROMPT = "Summarize this conversation so far in one short paragraph. Keep the names, facts, goals and feelings the user shared, so the conversation can continue from the summary."
+CONTEXT_SUMMARY_MAX_TOKENS = 300
+RESPONSE_CACHE_SIZE = 1000
+RESPONSE_CACHE_TTL = 24 * 60 * 60 #seconds
+RESPONSE_CACHE_VARIANTS = 5 # the chat model runs at temperature 2, so keep several answers to each common first prompt
+SUMMARY_CACHE_SIZE = 1000
+STARTUP_WAIT_TIMEOUT = 30 #seconds a request waits for the server to finish starting before it gets a 503
+SEARCH_INDEX_SAVE_INTERVAL = 60 #seconds. The index is saved whole, so it's saved less often than chats
+MAX_SEARCH_RESULTS = 50
+MAX_HISTORY_PAGE_SIZE = 500 # messages returned by one paginated load_chat
+# The rate limits and model call caps below are for the whole server. With several WEB_WORKERS, each worker enforces an
+# equal share of them, so a client whose messages all land on one worker gets that worker's share of its limit
+RATE_LIMIT_PER_MINUTE = float(os.getenv("RATE_LIMIT_PER_MINUTE", "20")) # messages each client may send per minute on average. 0 disables the limit
+RATE_LIMIT_BURST = 10 # messages a client may send at once
+RATE_LIMIT_CLIENTS = 10000 # clients whose limits are tracked, least recently seen forgotten first
+RATE_LIMIT_PROXY_HOPS = 1 # proxies in front of the app that append to X-Forwarded-For. Cloud Run adds one
+MAX_CONCURRENT_MODEL_CALLS = int(os.getenv("MAX_CONCURRENT_MODEL_CALLS", "64")) # kept under the upstream quota, so a burst queues here instead of slowing every call
+MAX_QUEUED_MODEL_CALLS = 128 # messages that may wait for a model slot. Any more get a 429 right away
+MAX_ADMISSION_WAIT = 5 #seconds a message waits for a model slot before it gets a 429
+MAX_BACKGROUND_MODEL_CALLS = 4 # slots summaries may hold at once. They only get one while no message is waiting
+GENERATION_CONFIG = {
+    "temperature": 2,
+    "top_p": 0.95,
+    "top_k": 40,
+    "max_output_tokens": 150,
+    "response_mime_type": "text/plain",
+}
+SUMMARY_GENERATION_CONFIG = {
+    "temperature": 0.5,
+    "max_output_tokens": 20,
+    "response_mime_type": "text/plain",
+}
 
 class GeminiChatHandler:
     def __init__(self):
-        self.config_api_key()
-        self.model = self.init_model()
-        self.chat_session = self.model.start_chat(history=[])
+        """
+        Sets up the handler without touching the network. The chats are loaded and the models are built by a background
+        warm-up, so the server can bind its port straight away. Requests wait for it with wait_until_ready.
+        """
+        # workers only share a store that refuses writes based on an outdated copy of a chat. The local and sqlite stores
+        # overwrite chats unconditionally, so a worker saving a stale copy would drop another worker's messages
+        if WEB_WORKERS > 1 and CHAT_STORE != "gcs":
+            raise ValueError(f"The {CHAT_STORE} chat store can't be shared by several workers. Use gcs, or set WEB_WORKERS=1.")
+        
+        self.metrics = Metrics()
+        self.ready = threading.Event()
+        self.warmed_up = threading.Event() # set when the warm-up ends, even if it failed
+        self.startup_error = ""
+        self.startup_seconds = 0.0
+        # importing and configuring the Gemini SDK takes most of a second, so the models are built on first use
+        self.model_lock = threading.Lock()
+        self._model = None
+        self._summary_model = None
+        
+        # every model call gets a deadline and retries, and calls fail fast while the model keeps failing
+        self.model_calls = ModelCaller(
+            breaker=CircuitBreaker(failure_threshold=CIRCUIT_FAILURE_THRESHOLD, reset_timeout=CIRCUIT_RESET_TIMEOUT),
+            timeout=TIMEOUT_DURATION,
+            max_retries=MODEL_RETRIES,
+            backoff=RETRY_BACKOFF,
+            hedge_delay=HEDGE_DELAY,
+            max_workers=MODEL_CALL_WORKERS
+        )
+        self.sessions = SessionPool(
+            start_session=lambda history: self.model.start_chat(history=history),
+            max_sessions=MAX_LIVE_SESSIONS,
+            ttl_seconds=SESSION_TTL,
+            max_history_bytes=MAX_LIVE_HISTORY_BYTES,
+            build_history=lambda chat: self.context.build_history(chat)
+        )
+        self.store = TimedChatStore(self.init_store(), self.metrics.time)
+        # with several worker processes, each one keeps its own copy of the chats and reloads the ones other workers changed.
+        # The journal is opened before the chats are loaded, so no change made in between is missed
+        self.journal = None
+        self.save_lock = threading.Lock() # lets requests wait for a save that's already running
+        if WEB_WORKERS > 1:
+            self.journal = SharedJournal(SHARED_STATE_DB)
         self.all_chats = ChatManager()
-        self.all_chats.load_chats(BUCKET_NAME, CHAT_HISTORY_FILE, SERVICE_ACCOUNT_KEY_FILE)
-        self.current_chat = Chat()
+        
+        # chats are saved in the background, and once more when the process exits. Chats replaced by a newer copy saved by
+        # another instance lose their live session, so the next message starts from the stored history
+        self.writer = WriteBehindQueue(flush=self.__save_chats, interval=SHARED_FLUSH_INTERVAL if self.journal else FLUSH_INTERVAL)
+        self.index_writer = WriteBehindQueue(flush=lambda: self.all_chats.save_search_index(self.store), interval=SEARCH_INDEX_SAVE_INTERVAL)
+        # exit handlers run last registered first, so the chats' final flush happens before the index's
+        atexit.register(self.index_writer.close)
+        atexit.register(self.writer.close)
+        
+        # summaries are generated in the background with their own model, so they never touch a live session
+        # short histories are summarized several to a request
+        self.summaries = SummaryWorker(
+            get_chat=self.all_chats.get_chat,
+            summarize=self.generate_summary,
+            on_summary=self.__on_summary,
+            num_workers=SUMMARY_WORKERS,
+            summarize_batch=self.generate_summaries,
+            batch_size=SUMMARY_BATCH_SIZE,
+            max_batch_chars=SUMMARY_BATCH_MAX_CHARS
+        )
+        
+        # long chats start their live sessions from a rolling summary plus their last turns, instead of the whole history
+        self.context = ContextPolicy(
+            token_budget=CONTEXT_TOKEN_BUDGET,
+            keep_last_turns=CONTEXT_KEEP_LAST_TURNS,
+            summarize=self.generate_context_summary,
+            on_summary=self.__on_summary
+        )
+        self.token_stats = TokenStats()
+        
+        # clients are rate limited before their message is handled, and model calls wait for one of a fixed number of
+        # slots, with messages from users going ahead of background summaries. The limits are for the whole server, and
+        # each worker process enforces its share of them, so several workers together stay under the upstream quota
+        self.rate_limits = RateLimiter(
+            rate=RATE_LIMIT_PER_MINUTE / 60 / WEB_WORKERS,
+            burst=RATE_LIMIT_BURST / WEB_WORKERS,
+            max_clients=RATE_LIMIT_CLIENTS,
+            proxy_hops=RATE_LIMIT_PROXY_HOPS
+        )
+        self.admission = AdmissionController(
+            max_concurrent=max(1, MAX_CONCURRENT_MODEL_CALLS // WEB_WORKERS),
+            max_queue=max(1, math.ceil(MAX_QUEUED_MODEL_CALLS / WEB_WORKERS)),
+            max_wait=MAX_ADMISSION_WAIT,
+            max_background=max(1, MAX_BACKGROUND_MODEL_CALLS // WEB_WORKERS)
+        )
+        
+        # first prompts of new chats and summaries of unchanged histories are answered from a cache. The keys include
+        # everything that shapes the model's answer, so editing the system instruction or config starts a fresh cache
+        self.responses = ResponseCache(
+            context=context_key(MODEL_NAME, self.read_system_instruction(), GENERATION_CONFIG),
+            max_entries=RESPONSE_CACHE_SIZE,
+            ttl_seconds=RESPONSE_CACHE_TTL,
+            variants=RESPONSE_CACHE_VARIANTS
+        )
+        self.summary_cache = ResponseCache(
+            context=context_key(MODEL_NAME, SUMMARY_PROMPT, SUMMARY_GENERATION_CONFIG),
+            max_entries=SUMMARY_CACHE_SIZE,
+            ttl_seconds=RESPONSE_CACHE_TTL
+        )
+        
+        self.started = time.perf_counter()
+        threading.Thread(target=self.__warm_up, name="warm-up", daemon=True).start()
+        
+        
+    @property
+    def model(self):
+        """The chat model, built on first use"""
+        if self._model is None:
+            self.__build_models()
+        return self._model
+    
+    
+    @property
+    def summary_model(self):
+        """The model used for summaries, built on first use"""
+        if self._summary_model is None:
+            self.__build_models()
+        return self._summary_model
+    
+    
+    def wait_until_ready(self, timeout: float = STARTUP_WAIT_TIMEOUT) -> bool:
+        """Waits for the warm-up to load the chats and build the models. Returns False if it failed or didn't finish in time"""
+        self.warmed_up.wait(timeout)
+        return self.ready.is_set()
+    
+    
+    async def wait_until_ready_async(self, timeout: float = STARTUP_WAIT_TIMEOUT) -> bool:
+        """Same as wait_until_ready, but waits off the event loop"""
+        if self.ready.is_set():
+            return True
+        return await asyncio.to_thread(self.wait_until_ready, timeout)
+    
+    
+    def sync_workers(self):
+        """Reloads the chats that other worker processes changed since the last call. Does nothing with a single worker"""
+        if not self.journal or not self.ready.is_set():
+            return
+        try:
+            changed, deleted = self.journal.poll()
+            if changed or deleted:
+                self.all_chats.refresh_chats(self.store, changed, deleted, on_replaced=self.sessions.evict)
+        except Exception as e:
+            print("Error syncing with other workers: ", e)
+    
+    
+    async def sync_workers_async(self):
+        """Same as sync_workers, but reloads chats off the event loop"""
+        if not self.journal or not self.ready.is_set():
+            return
+        try:
+            changed, deleted = self.journal.poll()
+            if changed or deleted:
+                await asyncio.to_thread(self.all_chats.refresh_chats, self.store, changed, deleted, self.sessions.evict)
+        except Exception as e:
+            print("Error syncing with other workers: ", e)
+    
+    
+    def flush_for_workers(self):
+        """
+        Saves pending changes right away when there are several workers, so a response isn't sent before every worker
+        can see the changes it made. Does nothing with a single worker
+        """
+        if not self.journal:
+            return
+        if self.writer.stats()["pending"]:
+            self.writer.flush()
+        else:
+            # the writer may be saving this request's changes already
+            with self.save_lock:
+                pass
+    
+    
+    async def flush_for_workers_async(self):
+        """Same as flush_for_workers, but saves off the event loop"""
+        if self.journal:
+            await asyncio.to_thread(self.flush_for_workers)
+    
+    
+    def get_readiness(self):
+        """
+        Reports whether the server can take requests, for a readiness or startup probe. Liveness is separate, since a
+        server that's still warming up is alive.
+        
+        Returns:
+            - (dict) ready flag, seconds the warm-up took, and the error that stopped it if it failed
+            - (int) status code. 503 until the server is ready
+        """
+        readiness = {"ready": self.ready.is_set(), "startupSeconds": self.startup_seconds, "error": self.startup_error}
+        return readiness, 200 if readiness["ready"] else 503
         
         
     @staticmethod
     def config_api_key():
+        if MODEL_PROVIDER == "fake":
+            return
+        
+        import google.generativeai as genai
         load_dotenv("credentials/.env")
         api_key = os.getenv("API_KEY")
         if api_key:
@@ -35,13 +311,12 @@ class GeminiChatHandler:
         
     @staticmethod
     def init_model():
-        generation_config = {
-            "temperature": 2,
-            "top_p": 0.95,
-            "top_k": 40,
-            "max_output_tokens": 150,
-            "response_mime_type": "text/plain",
-        }
+        if MODEL_PROVIDER == "fake":
+            from fake_model import FakeGenerativeModel
+            return FakeGenerativeModel(generation_config=GENERATION_CONFIG)
+        
+        import google.generativeai as genai
+        from google.generativeai.types import HarmCategory, HarmBlockThreshold
         safety_settings={
             HarmCategory.HARM_CATEGORY_HATE_SPEECH: HarmBlockThreshold.BLOCK_NONE,
             HarmCategory.HARM_CATEGORY_HARASSMENT: HarmBlockThreshold.BLOCK_NONE,
@@ -49,88 +324,276 @@ class GeminiChatHandler:
             HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT: HarmBlockThreshold.BLOCK_NONE,
         }
 
-        with open(CONFIG_FILE, "r") as file:
-            system_instruction = file.read()
-
         return genai.GenerativeModel(
             model_name=MODEL_NAME, 
-            system_instruction=system_instruction, 
-            generation_config=generation_config, 
+            system_instruction=GeminiChatHandler.read_system_instruction(), 
+            generation_config=GENERATION_CONFIG, 
             safety_settings=safety_settings
         )
         
         
-    def start_new_chat(self) -> tuple[str, int]:
+    @staticmethod
+    def init_summary_model():
+        """Creates the model used for summaries. It doesn't get the motivational system instruction, and keeps its answers short"""
+        if MODEL_PROVIDER == "fake":
+            from fake_model import FakeGenerativeModel
+            return FakeGenerativeModel(generation_config=SUMMARY_GENERATION_CONFIG)
+        
+        import google.generativeai as genai
+        return genai.GenerativeModel(model_name=MODEL_NAME, generation_config=SUMMARY_GENERATION_CONFIG)
+        
+        
+    @staticmethod
+    def read_system_instruction() -> str:
+        with open(CONFIG_FILE, "r") as file:
+            return file.read()
+        
+        
+    @staticmethod
+    def init_store():
+        """Creates the chat store selected by the CHAT_STORE environment variable"""
+        if CHAT_STORE == "local":
+            return create_chat_store("local", directory=LOCAL_CHAT_DIR, format=CHAT_FORMAT)
+        if CHAT_STORE == "sqlite":
+            return create_chat_store("sqlite", path=SQLITE_CHAT_DB)
+        if CHAT_STORE == "memory":
+            return create_chat_store("memory", latency=MEMORY_STORE_LATENCY, format=CHAT_FORMAT)
+        return create_chat_store(CHAT_STORE, bucket_name=BUCKET_NAME, prefix=CHAT_HISTORY_PREFIX, service_account_key_path=SERVICE_ACCOUNT_KEY_FILE, legacy_file_path=CHAT_HISTORY_FILE, format=CHAT_FORMAT)
+        
+        
+    def start_new_chat(self, session_id: str = "") -> tuple[str, int]:
         """
-        Starts a new chat and chat session. If the current chat has no history, nothing will be done and the current chat session ID will be returned.
-        If there is history, then a summary will be generated based on the given history and the current chat will be saved and added to all chats.
+        Starts a new chat. If the given chat has no history, nothing will be done and the given session ID will be returned.
+        If there is history, then the chat is queued to have its summary generated in the background.
+        
+        Args:
+            session_id (str): Session ID of the chat the client is leaving. Can be empty if the client has no chat yet.
         
         Returns: 
-            - (str) session ID
+            - (str) session ID of the new chat
             - (int) status code
         """
-        try:
-            # return current chat if history is empty
-            if not self.current_chat.history:
-                return self.current_chat.sessionId, 200
-            
-            # generate a summary for the current chat
-            response = self.chat_session.send_message("Summarize this conversation in less than 5 words. Don't use emojis or punctuation. Write the summary in title case.")
-            self.current_chat.set_summary(response.text.strip())
-            
-            # add current chat to all_chats and save to file
-            self.all_chats.add_chat(self.current_chat)
-            self.all_chats.save_chats(BUCKET_NAME, CHAT_HISTORY_FILE, SERVICE_ACCOUNT_KEY_FILE)
-            
-            # create new chat and session, and return its session ID
-            self.current_chat = Chat()
-            self.chat_session = self.model.start_chat(history=[])
-            return self.current_chat.sessionId, 200
+        if session_id and not is_valid_session_id(session_id):
+            return "Invalid session ID", 400
+        
+        chat = self.all_chats.get_chat(session_id) if session_id else None
+        
+        # return the given chat if history is empty
+        if session_id and (not chat or not chat.history):
+            return session_id, 200
+        
+        if chat and chat.is_summary_stale():
+            self.summaries.submit(session_id)
+        
+        # create new chat and return its session ID. The chat gets added to all_chats on its first message
+        return Chat().sessionId, 200
+        
+    
+    def generate_summary(self, history: List[Dict[str, Any]]) -> str:
+        """Generates a short title for the given chat history with a single stateless model call, unless the same history was summarized before"""
+        key = json.dumps(history, sort_keys=True)
+        summary = self.summary_cache.get(key)
+        if summary is None:
+            # only called by the summary worker, so it waits for a slot behind users' messages
+            with self.admission.acquire(AdmissionController.BACKGROUND), self.metrics.time("model", "summary"):
+                response = self.model_calls.call(lambda _: self.summary_model.generate_content(
+                    history + [{"role": "user", "parts": [SUMMARY_PROMPT]}],
+                    request_options={"timeout": TIMEOUT_DURATION}
+                ))
+            summary = response.text.strip()
+            self.summary_cache.put(key, summary)
+        return summary
+        
+    
+    def generate_summaries(self, histories: List[List[Dict[str, Any]]]) -> List[str]:
+        """
+        Generates short titles for several chat histories with one model call that answers in JSON. Histories that were
+        summarized before are answered from the cache, and ones the model's answer leaves out are summarized on their own.
+        
+        Args:
+            histories (List[List[Dict[str, Any]]]): Histories to summarize.
+        
+        Returns:
+            (List[str]) summary of each history, in the same order
+        """
+        keys = [json.dumps(history, sort_keys=True) for history in histories]
+        summaries = [self.summary_cache.get(key) for key in keys]
+        missing = [i for i, summary in enumerate(summaries) if summary is None]
+        
+        if len(missing) > 1:
+            conversations = [{"id": str(i), "conversation": "\n".join(f"{message['role']}: {' '.join(message['parts'])}" for message in histories[i])} for i in missing]
+            # only called by the summary worker, so it waits for a slot behind users' messages
+            with self.admission.acquire(AdmissionController.BACKGROUND), self.metrics.time("model", "summary_batch"):
+                response = self.model_calls.call(lambda _: self.summary_model.generate_content(
+                    [{"role": "user", "parts": [SUMMARY_BATCH_PROMPT + "\n\n" + json.dumps(conversations, ensure_ascii=False)]}],
+                    generation_config={
+                        "response_mime_type": "application/json",
+                        "response_schema": SUMMARY_BATCH_SCHEMA,
+                        "max_output_tokens": SUMMARY_BATCH_TOKENS_PER_CHAT * len(missing)
+                    },
+                    request_options={"timeout": TIMEOUT_DURATION}
+                ))
             
-        except Exception as e:
-            return str(e), 500
+            try:
+                answers = {str(item["id"]): str(item["summary"]).strip() for item in json.loads(response.text)}
+            except (ValueError, TypeError, KeyError) as e:
+                print("Batched summaries weren't valid JSON, summarizing the chats one at a time: ", e)
+                answers = {}
+            for i in missing:
+                if answers.get(str(i)):
+                    summaries[i] = answers[str(i)]
+                    self.summary_cache.put(keys[i], summaries[i])
+        
+        # anything the batch didn't answer, including a lone history, gets a call of its own
+        return [summary if summary is not None else self.generate_summary(history) for summary, history in zip(summaries, histories)]
+        
+    
+    def generate_context_summary(self, previous_summary: str, messages: List[Dict[str, Any]]) -> str:
+        """
+        Generates the summary that stands in for the older part of a long chat's history.
+        
+        Args:
+            previous_summary (str): Summary of the messages before the given ones. Can be empty.
+            messages (List[Dict[str, Any]]): Messages to add to the summary.
+        
+        Returns:
+            (str) summary of the previous summary and the given messages
+        """
+        history = messages
+        if previous_summary:
+            history = [{"role": "user", "parts": [f"Summary of our earlier conversation: {previous_summary}"]}] + messages
+        
+        with self.metrics.time("model", "context_summary"):
+            response = self.model_calls.call(lambda _: self.summary_model.generate_content(
+                history + [{"role": "user", "parts": [CONTEXT_SUMMARY_PROMPT]}],
+                generation_config={"max_output_tokens": CONTEXT_SUMMARY_MAX_TOKENS},
+                request_options={"timeout": TIMEOUT_DURATION}
+            ))
+        return response.text.strip()
         
     
-    def load_chat(self, session_id: str):
+    def load_chat(self, session_id: str, limit: Optional[int] = None, cursor: str = ""):
         """
-        Starts a new chat with the provided session ID. Loads the model with the session's history.
-        Returns a json object of the current chat if succeeds.
+        Loads the chat with the provided session ID and primes a live model session with its history. The session is
+        always started from the whole history, however many messages the client asked for.
+        
+        Args:
+            session_id (str): Session ID of the chat.
+            limit (int): Maximum number of messages to return, latest first, up to MAX_HISTORY_PAGE_SIZE. Returns the whole history if None.
+            cursor (str): "nextCursor" of the previous page, to get the messages before it.
+        
+        Returns:
+            - (dict) the chat. With a limit, "history" only has a page of messages, in order, and "totalMessages" and
+              "nextCursor" are added. "nextCursor" is an empty string once the first message was returned
+            - (int) status code. 404 if the chat doesn't exist, 400 if the cursor isn't valid
         """
         chat = self.all_chats.get_chat(session_id)
         
         if not chat:
-            self.current_chat = Chat(sessionId=session_id)
-            return "Session ID not found. Creating new Chat with the provided session ID", 404
+            return "Session ID not found. A new Chat will be created with the provided session ID on its first message", 404
         
         try:
-            # convert chat's history to json, start the model with the provided history, and set current chat to this
-            history = chat.get_history()
-            self.chat_session = self.model.start_chat(history=history)
-            self.current_chat = chat
+            self.prime_chat(session_id)
             
-            return self.current_chat.model_dump(), 200
+            with self.metrics.time("serialization", "load_chat"):
+                if limit is None:
+                    return chat.model_dump(), 200
+                
+                history = chat.get_history()
+                end = len(history)
+                if cursor:
+                    # the cursor is the position of the oldest message the client has. Histories are only appended to,
+                    # so it stays valid while newer messages are added
+                    if not cursor.isdigit():
+                        return f"Invalid cursor {cursor}", 400
+                    end = min(int(cursor), end)
+                start = max(0, end - max(1, min(limit, MAX_HISTORY_PAGE_SIZE)))
+                
+                page = chat.model_dump(exclude={"history"})
+                page["history"] = history[start:end]
+                page["totalMessages"] = len(history)
+                page["nextCursor"] = str(start) if start > 0 else ""
+                return page, 200
         
         except Exception as e:
             return str(e), 500
         
     
-    def delete_chats(self, session_ids: List[str]):
+    async def load_chat_async(self, session_id: str, limit: Optional[int] = None, cursor: str = ""):
+        """Same as load_chat, but loads the history and primes the model session off the event loop"""
+        return await asyncio.to_thread(self.load_chat, session_id, limit, cursor)
+        
+    
+    def prime_chat(self, session_id: str):
+        """
+        Starts the model with the chat's history, so the next message doesn't have to wait for it. Starting it may
+        summarize a long history, so it needs a model slot, but it's only a head start and is skipped when none is free
+        """
+        chat = self.all_chats.get_chat(session_id)
+        slot = self.admission.try_acquire() if chat else None
+        if slot:
+            with slot:
+                self.sessions.get(chat)
+        
+    
+    async def prime_chat_async(self, session_id: str):
+        """Same as prime_chat, but off the event loop"""
+        await asyncio.to_thread(self.prime_chat, session_id)
+        
+    
+    def get_chat_etag(self, session_id: str, limit: Optional[int] = None, cursor: str = "") -> str:
+        """
+        Gets an ETag for a load_chat response, without serializing the chat. It changes whenever the chat or its summary
+        changes. Returns an empty string if the chat doesn't exist
         """
-        Deletes chats based on the given session IDs
+        chat = self.all_chats.get_chat(session_id)
+        if not chat:
+            return ""
+        # a message that the model didn't answer is removed without changing the timestamp, so the history's length is part of the tag too
+        parts = [session_id, chat.timestamp, chat.summary, chat.summaryTimestamp, chat.contextSummaryUpto, len(chat.history), limit, cursor]
+        return hashlib.sha256("\0".join(str(part) for part in parts).encode("utf-8")).hexdigest()[:32]
+        
+    
+    def delete_chats(self, session_ids: List[str], older_than: str = "", delete_all: bool = False):
+        """
+        Deletes chats by session ID, by age, or all of them, in one pass. The deletes are saved to the store in one batch.
+
+        Args:
+            session_ids (List[str]): Session IDs of the chats to delete.
+            older_than (str): ISO 8601 time. Chats whose last message is before it are deleted too.
+            delete_all (bool): Delete every chat.
+
+        Returns:
+            - (dict) "deleted" and "notFound" lists of session IDs
+            - (int) status code. 404 if any of the given session IDs doesn't exist, 400 if older_than isn't a valid time
         """
+        try:
+            cutoff = datetime.fromisoformat(older_than) if older_than else None
+        except (TypeError, ValueError):
+            return f"Invalid time {older_than}", 400
+        
+        session_ids = list(session_ids)
+        if delete_all or cutoff:
+            session_ids += self.all_chats.find_chats(None if delete_all else cutoff)
+        
         chats_deleted = self.all_chats.delete_chats(session_ids)
-        self.all_chats.save_chats(BUCKET_NAME, CHAT_HISTORY_FILE, SERVICE_ACCOUNT_KEY_FILE)
+        for session_id in chats_deleted:
+            self.sessions.evict(session_id)
+        self.writer.notify()
         
-        if len(chats_deleted) != len(session_ids):
-            return chats_deleted, 404
-        else:
-            return chats_deleted, 200
+        deleted = set(chats_deleted)
+        not_found = [session_id for session_id in dict.fromkeys(session_ids) if session_id not in deleted]
+        return {"deleted": chats_deleted, "notFound": not_found}, 404 if not_found else 200
         
     
     
-    def send_message(self, message: str) -> tuple[str, int]:
+    def send_message(self, session_id: str, message: str) -> tuple[str, int]:
         """
-        Send a message to the model and get a response.
+        Send a message to the model in the given chat and get a response.
+        
+        Args:
+            session_id (str): Session ID of the chat to send the message in. The chat is created if it doesn't exist yet.
+            message (str): The user's message.
         
         Returns: 
             - (str) model's response string
@@ -139,79 +602,536 @@ class GeminiChatHandler:
         if not message: 
             return "Message cannot be empty", 400
         
+        if not is_valid_session_id(session_id):
+            return "Invalid session ID", 400
+        
         try:
-            # Add current chat to all_chats if it's not there already
-            chat = self.all_chats.get_chat(self.current_chat.sessionId)
-            if not chat:
-                self.all_chats.add_chat(self.current_chat)
-                chat = self.current_chat
+            # wait for a model slot before starting the live session too, since starting it may summarize a long history
+            with self.admission.acquire():
+                chat = self.__get_or_add_chat(session_id)
+                live = self.sessions.get(chat)
             
-            # add user message
-            user_message = Message(role="user", parts=[message])
-            chat.add_message(user_message)
+                # only one message can be in flight per chat, but different chats don't wait on each other
+                with live.lock:
+                    cold_start = not chat.history
+                
+                    # add user message
+                    user_message = self.__new_message("user", message)
+                    chat.add_message(user_message)
+                
+                    cleaned_text = self.__get_cached_reply(chat, live, message) if cold_start else None
+                    if cleaned_text is None:
+                        # send message to model
+                        try:
+                            with self.metrics.time("model", "send"):
+                                live.chat_session, response = self.model_calls.call(self.__send_attempt(chat, live, message))
+                        except Exception:
+                            self.__drop_unanswered(chat)
+                            raise
+                        cleaned_text = response.text.rstrip() # remove white space at the end, since gemini seems to add extra newlines
+                    
+                        # add model response
+                        self.__record_reply(chat, live, message, cleaned_text, response, cold_start)
             
-            # send message to model
-            response = self.chat_session.send_message(message)
-            cleaned_text = response.text.rstrip() # remove white space at the end, since gemini seems to add extra newlines
+            return cleaned_text, 200
+        
+        except Exception as e:
+            return str(e), self.__error_status(e)
+        
+    
+    def stream_message(self, session_id: str, message: str):
+        """
+        Send a message to the model in the given chat and stream the response back as it's generated.
+        The model's message is only added to the chat once the whole response has been received. If the stream
+        is closed early (e.g. the client disconnected) or the model fails mid-stream, the user's message is removed
+        from the chat and the live session is dropped, so the history is left as it was before the message was sent.
+        
+        Args:
+            session_id (str): Session ID of the chat to send the message in. The chat is created if it doesn't exist yet.
+            message (str): The user's message.
+        
+        Returns: 
+            - (Iterator[str] | str) generator of response text chunks, or an error message
+            - (int) status code
+        """
+        if not message: 
+            return "Message cannot be empty", 400
+        
+        if not is_valid_session_id(session_id):
+            return "Invalid session ID", 400
+        
+        # the slot is taken before answering, so a full server responds with a 429 instead of a stream that fails
+        try:
+            slot = self.admission.acquire()
+        except AdmissionRejected as e:
+            return str(e), 429
+        
+        try:
+            chat = self.__get_or_add_chat(session_id)
+        except Exception as e:
+            # the stream that would release the slot was never made, e.g. the chat's history couldn't be loaded
+            slot.release()
+            return str(e), self.__error_status(e)
+        stream = self.__stream_reply(chat, message, slot)
+        # closing a stream that was never started doesn't run its body, so the slot is also released when it's collected
+        weakref.finalize(stream, slot.release)
+        return stream, 200
+    
+    
+    def __stream_reply(self, chat: Chat, message: str, slot):
+        """Generator that sends a message through the chat's live session and yields the response text as it arrives"""
+        # the model slot taken for the stream is held until the stream ends or is closed
+        with slot:
+            live = self.sessions.get(chat)
+        
+            with live.lock:
+                cold_start = not chat.history
+                chat.add_message(self.__new_message("user", message))
+            
+                cached_text = self.__get_cached_reply(chat, live, message) if cold_start else None
+                if cached_text is not None:
+                    yield cached_text
+                    return
+            
+                chunks = []
+                completed = False
+            
+                try:
+                    # streams can't be hedged, since chunks from one attempt may already have been sent
+                    with self.metrics.time("model", "stream_start"):
+                        live.chat_session, response = self.model_calls.call(self.__send_attempt(chat, live, message, stream=True), hedge=False)
+                    for chunk in response:
+                        chunks.append(chunk.text)
+                        yield chunk.text
+                    completed = True
+                
+                finally:
+                    if completed:
+                        cleaned_text = "".join(chunks).rstrip() # remove white space at the end, since gemini seems to add extra newlines
+                        self.__record_reply(chat, live, message, cleaned_text, response, cold_start)
+                    else:
+                        # the live session is left holding a half-read response, so drop it along with the unanswered message
+                        self.__drop_unanswered(chat)
+            
+    
+    async def start_new_chat_async(self, session_id: str = "") -> tuple[str, int]:
+        """Same as start_new_chat, but checks the chat off the event loop, since getting it may load its history from the store"""
+        return await asyncio.to_thread(self.start_new_chat, session_id)
+        
+    
+    async def delete_chats_async(self, session_ids: List[str], older_than: str = "", delete_all: bool = False):
+        """Same as delete_chats. Deleting doesn't wait on storage, so this doesn't need to leave the event loop"""
+        return self.delete_chats(session_ids, older_than, delete_all)
+    
+    
+    async def send_message_async(self, session_id: str, message: str) -> tuple[str, int]:
+        """Same as send_message, but awaits the model instead of blocking on it"""
+        if not message: 
+            return "Message cannot be empty", 400
+        
+        if not is_valid_session_id(session_id):
+            return "Invalid session ID", 400
+        
+        try:
+            # wait for a model slot before starting the live session too, since starting it may summarize a long history
+            with await self.admission.acquire_async():
+                # getting the chat may load its history from the store
+                chat = await asyncio.to_thread(self.__get_or_add_chat, session_id)
+                # starting the live session may summarize a long history with a blocking model call
+                live = await asyncio.to_thread(self.sessions.get, chat)
             
-            # add model response
-            model_message = Message(role="model", parts=[cleaned_text])
-            chat.add_message(model_message)
+                # only one message can be in flight per chat, but different chats don't wait on each other
+                async with live.async_lock:
+                    cold_start = not chat.history
+                
+                    # add user message
+                    user_message = self.__new_message("user", message)
+                    chat.add_message(user_message)
+                
+                    cleaned_text = self.__get_cached_reply(chat, live, message) if cold_start else None
+                    if cleaned_text is None:
+                        # send message to model
+                        try:
+                            with self.metrics.time("model", "send"):
+                                live.chat_session, response = await self.model_calls.call_async(self.__send_attempt_async(chat, live, message))
+                        except Exception:
+                            self.__drop_unanswered(chat)
+                            raise
+                        cleaned_text = response.text.rstrip() # remove white space at the end, since gemini seems to add extra newlines
+                    
+                        # add model response
+                        self.__record_reply(chat, live, message, cleaned_text, response, cold_start)
             
             return cleaned_text, 200
         
         except Exception as e:
-            return str(e), 500
+            return str(e), self.__error_status(e)
         
     
-    def save_chats_to_file(self, filename: str=CHAT_HISTORY_FILE):
-        """Write all_chats to the provided filename"""
+    async def stream_message_async(self, session_id: str, message: str):
+        """Same as stream_message, but returns an async generator of response text chunks, and waits for a model slot off the event loop"""
+        if not message: 
+            return "Message cannot be empty", 400
+        
+        if not is_valid_session_id(session_id):
+            return "Invalid session ID", 400
         
-        # explicitly specify UTF-8 encoding since python on some systems might use a different encoding that doesn't support emojis
-        with open(filename, "w", encoding="utf-8") as file:
-            data = self.all_chats.model_dump()
+        try:
+            slot = await self.admission.acquire_async()
+        except AdmissionRejected as e:
+            return str(e), 429
+        
+        try:
+            # getting the chat may load its history from the store
+            chat = await asyncio.to_thread(self.__get_or_add_chat, session_id)
+        except Exception as e:
+            slot.release()
+            return str(e), self.__error_status(e)
+        except BaseException:
+            # e.g. the request was cancelled while the history was loading
+            slot.release()
+            raise
+        stream = self.__stream_reply_async(chat, message, slot)
+        weakref.finalize(stream, slot.release)
+        return stream, 200
+    
+    
+    async def __stream_reply_async(self, chat: Chat, message: str, slot):
+        """Async generator version of __stream_reply"""
+        # the model slot taken for the stream is held until the stream ends or is closed
+        with slot:
+            live = await asyncio.to_thread(self.sessions.get, chat)
+        
+            async with live.async_lock:
+                cold_start = not chat.history
+                chat.add_message(self.__new_message("user", message))
+            
+                cached_text = self.__get_cached_reply(chat, live, message) if cold_start else None
+                if cached_text is not None:
+                    yield cached_text
+                    return
             
-            # ensure_ascii ensures emojis and other non-ASCII characters are written directly in JSON, instead of being escaped
-            json_data = json.dumps(data, indent=4, ensure_ascii=False) 
-            file.write(json_data)
+                chunks = []
+                completed = False
             
+                try:
+                    with self.metrics.time("model", "stream_start"):
+                        live.chat_session, response = await self.model_calls.call_async(self.__send_attempt_async(chat, live, message, stream=True), hedge=False)
+                    async for chunk in response:
+                        chunks.append(chunk.text)
+                        yield chunk.text
+                    completed = True
+                
+                finally:
+                    if completed:
+                        cleaned_text = "".join(chunks).rstrip() # remove white space at the end, since gemini seems to add extra newlines
+                        self.__record_reply(chat, live, message, cleaned_text, response, cold_start)
+                    else:
+                        # the live session is left holding a half-read response, so drop it along with the unanswered message
+                        self.__drop_unanswered(chat)
             
-    def get_current_session_id(self) -> str:
-        """gets the session id for the current chat"""
-        return self.current_chat.sessionId
+    
+    def __send_attempt(self, chat: Chat, live, message: str, stream: bool = False):
+        """
+        Returns an attempt function for model_calls that sends the message and returns (session, response).
+        Attempt 0 uses the live session. Retries and hedges each get a fresh session started from the chat's history, since an
+        attempt that timed out may still finish later and add its reply to the session it was sent on.
+        """
+        def attempt(number: int):
+            session = live.chat_session if number == 0 else self.__fresh_session(chat)
+            return session, session.send_message(message, stream=stream, request_options={"timeout": TIMEOUT_DURATION})
+        return attempt
+    
+    
+    def __send_attempt_async(self, chat: Chat, live, message: str, stream: bool = False):
+        """Async version of __send_attempt"""
+        async def attempt(number: int):
+            session = live.chat_session if number == 0 else self.__fresh_session(chat)
+            return session, await session.send_message_async(message, stream=stream, request_options={"timeout": TIMEOUT_DURATION})
+        return attempt
+    
+    
+    def __fresh_session(self, chat: Chat):
+        """Starts a model session with the chat's history, leaving out the message that's being sent"""
+        return self.sessions.start_session(self.sessions.build_history(chat)[:-1])
+    
+    
+    def __new_message(self, role: str, text: str) -> Message:
+        """Creates a validated message, timing the validation"""
+        with self.metrics.time("validation", "message"):
+            return Message(role=role, parts=[text])
+    
+    
+    def __drop_unanswered(self, chat: Chat):
+        """Removes the user's message that the model didn't answer, and drops the live session it may have been sent on"""
+        chat.pop_message()
+        self.sessions.evict(chat.sessionId)
+    
+    
+    @staticmethod
+    def __error_status(error: Exception) -> int:
+        """Status code for an error raised while handling a message"""
+        if isinstance(error, AdmissionRejected):
+            return 429
+        if isinstance(error, CircuitOpenError):
+            return 503
+        if isinstance(error, ModelTimeoutError):
+            return 504
+        return 500
+    
+    
+    def __get_cached_reply(self, chat: Chat, live, message: str) -> Optional[str]:
+        """
+        Gets a cached reply to the first message of a chat, and adds it to the chat. Must hold the live session's lock.
+        
+        Returns:
+            (str) the cached reply, or None if the model should be asked
+        """
+        cached_text = self.responses.get(normalize_prompt(message))
+        if cached_text is None:
+            return None
+        
+        chat.add_message(self.__new_message("model", cached_text))
+        self.all_chats.mark_dirty(chat.sessionId)
+        
+        # the model never saw this exchange, so hand it to the live session as if it had
+        live.chat_session.history = chat.get_history()
+        self.sessions.track_message(chat.sessionId, message + cached_text)
+        self.writer.notify()
+        return cached_text
+    
+    
+    def __record_reply(self, chat: Chat, live, message: str, cleaned_text: str, response, cold_start: bool = False):
+        """Adds the model's reply to the chat, and records its size and token usage. Must hold the live session's lock"""
+        if cold_start:
+            self.responses.put(normalize_prompt(message), cleaned_text)
+        
+        chat.add_message(self.__new_message("model", cleaned_text))
+        self.all_chats.mark_dirty(chat.sessionId)
+        self.sessions.track_message(chat.sessionId, message + cleaned_text)
+        self.token_stats.record(response, chat.get_history())
+        
+        # the live session keeps growing with every message, so restart it from a compacted history once it's too long
+        if self.context.is_over_budget(live.history_bytes):
+            self.sessions.evict(chat.sessionId)
+        
+        self.writer.notify()
+    
+    
+    def __get_or_add_chat(self, session_id: str) -> Chat:
+        """Gets the chat with the given session ID, adding a new chat to all_chats if it's not there already"""
+        chat = self.all_chats.get_chat(session_id)
+        if not chat:
+            chat = Chat(sessionId=session_id)
+            self.all_chats.add_chat(chat)
+        return chat
+    
+    
+    @staticmethod
+    def create_session_id() -> str:
+        """Creates a session id for a client that doesn't have a chat yet"""
+        return Chat().sessionId
+    
+    
+    def get_storage_stats(self) -> dict:
+        """Gets the background writer's flush metrics, and how many changes were shared with other workers"""
+        stats = self.writer.stats()
+        if self.journal:
+            stats["workers"] = self.journal.stats()
+        return stats
+    
+    
+    def check_rate_limit(self, forwarded_for: str, remote_addr: str) -> int:
+        """
+        Counts a message against its client's rate limit.
+        
+        Args:
+            forwarded_for (str): X-Forwarded-For header of the request.
+            remote_addr (str): Address the request came from.
+        
+        Returns:
+            (int) 0 if the message is allowed, or the number of seconds the client should wait before sending another one
+        """
+        wait = self.rate_limits.acquire(self.rate_limits.client_key(forwarded_for, remote_addr))
+        return math.ceil(wait)
+    
+    
+    def get_retry_after(self) -> int:
+        """Estimated number of seconds until a message turned away for lack of a model slot could get one"""
+        return self.admission.retry_after()
+    
+    
+    def get_admission_stats(self) -> dict:
+        """Gets the rate limit counts, and how many model calls are in flight, waiting for a slot, or were turned away"""
+        return {"rateLimits": self.rate_limits.stats(), "modelSlots": self.admission.stats()}
+    
+    
+    def get_token_stats(self) -> dict:
+        """Gets the number of tokens sent to and received from the model, and how many the full histories would have cost"""
+        return self.token_stats.stats()
+    
+    
+    def get_metrics(self) -> str:
+        """Gets every metric in the Prometheus text format"""
+        model_stats = self.model_calls.stats()
+        storage_stats = self.writer.stats()
+        token_stats = self.token_stats.stats()
+        cache_stats = self.responses.stats()
+        rate_stats = self.rate_limits.stats()
+        admission_stats = self.admission.stats()
+        summary_stats = self.summaries.stats()
+        
+        samples = [
+            ("live_sessions", "gauge", "Chats with a live model session.", len(self.sessions)),
+            ("live_history_bytes", "gauge", "Approximate size of the history held by live model sessions.", self.sessions.history_bytes),
+            ("ready", "gauge", "1 once the server has loaded the chats and built the models.", int(self.ready.is_set())),
+            ("startup_seconds", "gauge", "Time from creating the handler to being ready.", self.startup_seconds),
+            ("chats", "gauge", "Chats known to the server.", len(self.all_chats.chats)),
+            ("resident_histories", "gauge", "Chats with their history in memory.", self.all_chats.resident_count()),
+            ("summary_queue", "gauge", "Chats waiting to have their summary generated.", summary_stats["pending"]),
+            ("summaries_total", "counter", "Chat summaries generated.", summary_stats["summarized"]),
+            ("summaries_unchanged_total", "counter", "Stale summaries kept without a model call, since the chat's messages hashed the same.", summary_stats["unchanged"]),
+            ("summary_batches_total", "counter", "Model requests that summarized several chats at once.", summary_stats["batches"]),
+            ("summary_batched_chats_total", "counter", "Chats summarized in a batched model request.", summary_stats["batchedChats"]),
+            ("storage_pending_seconds", "gauge", "Age of the oldest change that isn't saved yet.", storage_stats["oldestPendingAge"]),
+            ("storage_flushes_total", "counter", "Successful saves by the background writer.", storage_stats["flushes"]),
+            ("storage_failed_flushes_total", "counter", "Failed saves by the background writer.", storage_stats["failedFlushes"]),
+            ("circuit_open", "gauge", "1 while the model circuit breaker isn't closed.", int(model_stats["circuit"]["state"] != CircuitBreaker.CLOSED)),
+            ("model_calls_total", "counter", "Model calls, not counting retries and hedges.", model_stats["calls"]),
+            ("model_retries_total", "counter", "Retried model calls.", model_stats["retries"]),
+            ("model_hedges_total", "counter", "Hedged model calls.", model_stats["hedges"]),
+            ("model_timeouts_total", "counter", "Model call attempts that timed out.", model_stats["timeouts"]),
+            ("model_rejected_total", "counter", "Model calls rejected by the open circuit breaker.", model_stats["rejected"]),
+            ("model_slots_in_use", "gauge", "Model calls holding an admission slot.", sum(admission_stats["inFlight"].values())),
+            ("model_slot_queue", "gauge", "Messages waiting for a model slot.", admission_stats["waiting"][AdmissionController.INTERACTIVE]),
+            ("admission_rejected_total", "counter", "Messages turned away with a 429 because no model slot was free in time.", admission_stats["rejected"]),
+            ("rate_limited_total", "counter", "Messages turned away with a 429 by their client's rate limit.", rate_stats["limited"]),
+            ("prompt_tokens_total", "counter", "Tokens sent to the model.", token_stats["promptTokens"]),
+            ("output_tokens_total", "counter", "Tokens received from the model.", token_stats["outputTokens"]),
+            ("response_cache_hits_total", "counter", "Replies served from the response cache.", cache_stats["hits"]),
+            ("response_cache_misses_total", "counter", "Response cache lookups that went to the model.", cache_stats["misses"]),
+        ]
+        return self.metrics.render(samples)
+    
+    
+    def get_model_stats(self) -> dict:
+        """Gets the retry, hedging and timeout counts of model calls, and the state of the circuit breaker"""
+        return self.model_calls.stats()
+    
+    
+    def get_cache_stats(self) -> dict:
+        """Gets the hit and miss counts of the response and summary caches"""
+        return {"responses": self.responses.stats(), "summaries": self.summary_cache.stats()}
+    
+    
+    def get_chat_summaries(self, limit: int = None, cursor: str = ""):
+        """
+        Gets the sessionId, summary and timestamp of chats, most recent first, without copying any chat history.
+        
+        Args:
+            limit (int): Maximum number of summaries to return. Returns every summary if None.
+            cursor (str): Cursor returned with the previous page.
+        
+        Returns: 
+            - (List[Dict[str, str]]) summaries
+            - (str) cursor for the next page, or an empty string if this is the last page
+        """
+        return self.all_chats.get_summaries(limit, cursor)
+    
+    
+    def get_chat_summaries_etag(self) -> str:
+        """Gets an ETag that changes whenever any chat summary changes"""
+        return self.all_chats.get_summaries_etag()
     
     
     def get_all_chats(self) -> ChatManager:
         """Gets all chats and returns a ChatManager object"""
         return self.all_chats
     
-    # TODO: Is this needed?
-    def close_handler(self):
+    def search(self, query: str, limit: int = 10):
         """
-        Looks at self.all_chats and compares each chat's timestamp. If the timestamp is more recent than the one in the file and the summary is the same,
-        then update the summary of that chat. Lastly, save self.all_chats to the file.
+        Searches the messages and summaries of every chat.
+
+        Args:
+            query (str): Words to search for.
+            limit (int): Maximum number of results, up to MAX_SEARCH_RESULTS.
+
+        Returns:
+            - (List[dict]) sessionId, summary, timestamp, score and snippet of the matching chats, best match first
+            - (int) status code
         """
-        # read the history in the file
-        stored_data = ChatManager()
-        stored_data.load_chats(BUCKET_NAME, CHAT_HISTORY_FILE, SERVICE_ACCOUNT_KEY_FILE)
+        if not query.strip():
+            return "Query cannot be empty", 400
         
-        for session_id, chat in self.all_chats.chats.items():
-            stored_chat = stored_data.get_chat(session_id) # TODO: what happens when it's a new chat that has history but isn't in the file?
-            
-            # Define the format for ISO 8601 with microseconds and 'Z'
-            format = "%Y-%m-%dT%H:%M:%S.%fZ"
-            
-            # convert strings to datetime objects
-            current_time = datetime.strptime(chat.timestamp, format)
-            stored_time = datetime.strptime(stored_chat.timestamp, format)
-            
-            # generate a new summary if the current timestamp is more recent and the summaries are the same
-            same_summary = chat.summary == stored_chat.summary
-            if (current_time > stored_time) and same_summary:
-                print(f"genertae summary: {chat.summary}")
-                
-        return "", 200 #TODO: delete
-            
-            
+        try:
+            return self.all_chats.search(query, max(1, min(limit, MAX_SEARCH_RESULTS))), 200
+        except Exception as e:
+            return str(e), 500
+    
+    
+    def close_handler(self):
+        """
+        Queues every chat whose history changed since its summary was generated to have its summary regenerated.
+        The summaries are generated in the background by the summary workers, several short chats to a model request,
+        and saved by the background writer. Chats whose messages hash the same as when they were summarized keep their summary.
+        
+        Returns: 
+            - (List[str]) session IDs of the chats that were queued
+            - (int) status code
+        """
+        stale_chats = [chat.sessionId for chat in list(self.all_chats.chats.values()) if chat.is_summary_stale()]
+        for session_id in stale_chats:
+            self.summaries.submit(session_id)
             
-                
\ No newline at end of file
+        return stale_chats, 200
+    
+    
+    def __warm_up(self):
+        """Loads the chats and builds the models on a background thread, then marks the server as ready"""
+        try:
+            # only load the chats' metadata now, and each chat's history the first time it's used
+            self.all_chats.load_chats(self.store, lazy=True, max_resident=MAX_RESIDENT_HISTORIES, min_idle=HISTORY_IDLE_EVICTION)
+            self.__build_models()
+        except Exception as e:
+            self.startup_error = str(e)
+            print("Error starting up: ", e)
+            self.warmed_up.set()
+            return
+        
+        self.startup_seconds = time.perf_counter() - self.started
+        self.ready.set()
+        self.warmed_up.set()
+        print(f"Ready after {self.startup_seconds:.2f}s.")
+        
+        # chats that changed since the search index was saved are indexed after the server is ready
+        self.__refresh_search_index()
+    
+    
+    def __build_models(self):
+        with self.model_lock:
+            if self._model is None:
+                self.config_api_key()
+                self._summary_model = self.init_summary_model()
+                self._model = self.init_model()
+    
+    
+    def __save_chats(self) -> bool:
+        """
+        Flushes the changed chats for the background writer, tells the other workers which chats it saved, and
+        schedules saving the search index they changed
+        """
+        with self.save_lock:
+            saved = self.all_chats.save_chats(self.store, on_replaced=self.sessions.evict, on_saved=self.journal.publish if self.journal else None)
+        self.index_writer.notify()
+        return saved
+    
+    
+    def __refresh_search_index(self):
+        self.all_chats.refresh_search_index()
+        self.index_writer.notify()
+    
+    
+    def __on_summary(self, chat: Chat):
+        """Called by the summary worker after it sets a chat's summary"""
+        self.all_chats.mark_dirty(chat.sessionId)
+        self.writer.notify()
@@ -1,130 +1,506 @@
-from pydantic import BaseModel, Field, ValidationError
-from typing import List, Any, Dict
+from pydantic import BaseModel, Field, PrivateAttr, ValidationError
+from typing import List, Any, Dict, Set, Tuple, Optional
+from dataclasses import dataclass, field
 from datetime import datetime
-from google.cloud import storage
-from google.oauth2.service_account import Credentials
+from collections import OrderedDict
+from summary_index import SummaryIndex
+from search_index import SearchIndex, tokenize, make_snippet
+import hashlib
+import json
+import threading
+import time
 import uuid
 
-class Message(BaseModel):
+EMPTY_CHAT_TIMESTAMP = datetime(1,1,1,0,0).isoformat() + "Z" # timestamp of a chat that never had a message
+
+@dataclass(frozen=True, slots=True)
+class Message:
+    """
+    A single message. It's a plain slotted record instead of a pydantic model, since chats hold thousands of them and
+    most are only ever read. Chat still validates and serializes them like before.
+    """
     role: str
-    parts: List[str] = Field(default_factory=list)
+    parts: List[str] = field(default_factory=list)
     
+    def to_dict(self) -> Dict[str, Any]:
+        return {"role": self.role, "parts": list(self.parts)}
+
+
+@dataclass(frozen=True, slots=True)
+class Tombstone:
+    """Marks a deleted chat in stores shared by several instances, so an instance holding an old copy doesn't save it again"""
+    sessionId: str
+    timestamp: str # when the chat was deleted
+    generation: int = 0 # generation of the stored chat the delete was based on. See Chat.get_generation
+
+
+def hash_history(history: List[Dict[str, Any]]) -> str:
+    """Hashes the content of a chat history, as returned by Chat.get_history"""
+    data = json.dumps(history, ensure_ascii=False, separators=(",", ":"))
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+
+def is_valid_session_id(session_id: Any) -> bool:
+    """
+    Checks that a session ID is a UUID in the form Chat gives them. IDs sent by clients are checked before they name a
+    chat, since they end up in store paths and keys, and any other string would let a client make up chats at will.
+    """
+    if not isinstance(session_id, str) or len(session_id) != 36:
+        return False
+    try:
+        return str(uuid.UUID(session_id)) == session_id.lower()
+    except ValueError:
+        return False
+
+
 class Chat(BaseModel):
     """Create a Chat object that on init, will create a new session ID"""
     sessionId: str = Field(default_factory=lambda: str(uuid.uuid4()))
-    timestamp: str = Field(default_factory=lambda: datetime(1,1,1,0,0).isoformat() + "Z")
+    timestamp: str = Field(default_factory=lambda: EMPTY_CHAT_TIMESTAMP)
     history: List[Message] = Field(default_factory=list)
     summary: str = ""
+    summaryTimestamp: str = "" # timestamp of the chat when its summary was generated
+    summaryHash: str = "" # hash of the history the summary was generated from. See hash_history
+    contextSummary: str = "" # rolling summary of older messages, handed to the model instead of those messages
+    contextSummaryUpto: int = 0 # number of messages at the start of the history covered by contextSummary
+    _history_loaded: bool = PrivateAttr(default=True)
+    _generation: int = PrivateAttr(default=0) # version of the stored copy this chat is based on, 0 if it was never stored
+    _history_view: Tuple[List[Dict[str, Any]], Optional[Message]] = PrivateAttr(default=([], None)) # (dicts of the history, last message they cover)
     
     def get_history(self) -> List[Dict[str, Any]]:
         """
         Retrieve the chat history as a list of JSON objects.
+        The objects are built once and reused, and only new messages are converted on later calls, so don't modify them.
         
         Returns:
             List[Dict[str, Any]]: A list of JSON objects representing each message in the history.
         """
-        return [message.model_dump() for message in self.history]
+        history = self.history
+        view, last = self._history_view
+        
+        # start over if the history was cut short or replaced since the view was built
+        if len(view) > len(history) or (view and history[len(view) - 1] is not last):
+            view = []
+        
+        if len(view) < len(history):
+            view = view + [message.to_dict() for message in history[len(view):]]
+            # set both at once, so threads reading the view never see one without the other
+            self._history_view = (view, history[len(view) - 1])
+            
+        return list(view)
     
-    def set_summary(self, summary: str):
-        """Set the summary in the chat"""
+    def set_summary(self, summary: str, timestamp: str = "", history_hash: str = ""):
+        """
+        Set the summary in the chat.
+        
+        Args:
+            summary (str): The summary.
+            timestamp (str): The chat's timestamp when the history the summary was generated from was taken. Defaults to the current timestamp.
+            history_hash (str): Hash of the history the summary was generated from. See hash_history.
+        """
         self.summary = summary
+        self.summaryTimestamp = timestamp or self.timestamp
+        self.summaryHash = history_hash
+        
+    def is_summary_stale(self) -> bool:
+        """Checks if the chat has history that was added after its summary was generated"""
+        return self.timestamp != EMPTY_CHAT_TIMESTAMP and self.summaryTimestamp != self.timestamp
+    
+    def set_context_summary(self, summary: str, upto: int):
+        """Set the rolling summary of the first `upto` messages in the history"""
+        self.contextSummary = summary
+        self.contextSummaryUpto = upto
+    
+    def is_history_loaded(self) -> bool:
+        """Checks if the chat's history is in memory. Chats loaded with only their metadata have an empty history until it's loaded"""
+        return self._history_loaded
+    
+    def load_history(self, stored_chat: "Chat"):
+        """Sets the history of a chat that was loaded with only its metadata, from the stored copy of the chat"""
+        self.history = stored_chat.history
+        self.contextSummary = stored_chat.contextSummary
+        self.contextSummaryUpto = stored_chat.contextSummaryUpto
+        self._generation = stored_chat._generation or self._generation
+        self._history_loaded = True
+        
+    def replace_with(self, stored_chat: "Chat"):
+        """Replaces everything in the chat with a newer stored copy, e.g. one saved by another instance"""
+        for name in type(self).model_fields:
+            setattr(self, name, getattr(stored_chat, name))
+        self._generation = stored_chat._generation
+        self._history_loaded = True
+        
+    def get_generation(self) -> int:
+        """
+        Gets the version of the stored copy this chat is based on. Stores that are shared by several instances only save
+        the chat if the stored copy is still at this version, so changes made by other instances aren't overwritten.
+        """
+        return self._generation
+    
+    def set_generation(self, generation: int):
+        self._generation = generation
+        
+    def unload_history(self):
+        """Drops the chat's history from memory, keeping only its metadata"""
+        self.history = []
+        self._history_loaded = False
         
     def add_message(self, message: Message):
         """Adds a message to the chat by appending to the history and updating the timestamp"""
         self.history.append(message)
         self.timestamp = datetime.now().isoformat() + "Z"
+        
+    def pop_message(self) -> Message:
+        """Removes the last message, e.g. a user message that the model never answered. The timestamp is left as it is"""
+        message = self.history.pop()
+        view, last = self._history_view
+        if last is message:
+            # trim the cached view too, instead of rebuilding it on the next get_history
+            self._history_view = (view[:-1], self.history[-1] if self.history else None)
+        return message
     
 
 class ChatManager(BaseModel):
     chats: Dict[str, Chat] = Field(default_factory=dict)
+    _dirty: Set[str] = PrivateAttr(default_factory=set)
+    _deleted: Dict[str, Tombstone] = PrivateAttr(default_factory=dict)
+    _lock: threading.Lock = PrivateAttr(default_factory=threading.Lock)
+    _summaries: SummaryIndex = PrivateAttr(default_factory=SummaryIndex)
+    _store: Any = PrivateAttr(default=None) # set when chats are loaded lazily, so histories can be loaded on demand
+    _resident: "OrderedDict[str, float]" = PrivateAttr(default_factory=OrderedDict) # session ID -> last access, for chats with a loaded history
+    _max_resident: int = PrivateAttr(default=0)
+    _min_idle: float = PrivateAttr(default=0.0)
+    _search: SearchIndex = PrivateAttr(default_factory=SearchIndex)
+    _search_saved: int = PrivateAttr(default=0) # version of the search index when it was last saved
+    _unindexed: List[str] = PrivateAttr(default_factory=list) # session IDs of chats that changed since the saved search index
+    
+    def model_post_init(self, __context: Any):
+        """Builds the summaries and search indexes for the chats the manager was created with"""
+        self._summaries.rebuild(self.chats.values())
+        for chat in self.chats.values():
+            self._search.update(chat)
     
     def add_chat(self, chat: Chat):
         """Adds a new chat to the chat manager"""
         self.chats[chat.sessionId] = chat
+        self.mark_dirty(chat.sessionId)
         
     def get_chat(self, session_id: str) -> Chat:
-        """Retrieves a chat by its session ID"""
-        return self.chats.get(session_id)
-        
-    def delete_chats(self, session_ids: List[str]):
-        """Deletes chats for the given session IDs. Returns a list of successfully deleted chats"""
-        chats_deleted = []
-        for session_id in session_ids:
-            try:
-                self.chats.pop(session_id)
-                chats_deleted.append(session_id)
-            except KeyError:
-                return chats_deleted
+        """Retrieves a chat by its session ID. If the chat was loaded lazily, its history is loaded from the store first"""
+        chat = self.chats.get(session_id)
+        if not chat or not self._store:
+            return chat
+        
+        if not chat.is_history_loaded():
+            # load outside the lock, so other chats aren't held up by the download
+            stored_chat = self._store.load_chat(session_id)
+            with self._lock:
+                if not chat.is_history_loaded():
+                    chat.load_history(stored_chat or Chat(sessionId=session_id))
+                    
+        with self._lock:
+            self.__touch(session_id)
+            
+        return chat
+    
+    def mark_dirty(self, session_id: str):
+        """
+        Marks a chat as changed, so it gets uploaded on the next save and its entry in the summaries index is updated.
+        Chats that were deleted are ignored.
+        """
+        chat = self.chats.get(session_id)
+        if not chat:
+            return
+        with self._lock:
+            self._dirty.add(session_id)
+            self._deleted.pop(session_id, None)
+        self._summaries.update(chat)
+        self._search.update(chat)
+    
+    def resident_count(self) -> int:
+        """Number of chats with their history in memory. Only tracked when chats are loaded lazily"""
+        with self._lock:
+            return len(self._resident)
+    
+    def get_summaries(self, limit: int = None, cursor: str = ""):
+        """Gets a page of chat summaries, most recent first. See SummaryIndex.page"""
+        return self._summaries.page(limit, cursor)
+    
+    def get_summaries_etag(self) -> str:
+        """Gets an ETag that changes whenever any chat summary changes"""
+        return self._summaries.etag()
+        
+    def delete_chats(self, session_ids: List[str]) -> List[str]:
+        """
+        Deletes the chats with the given session IDs in one pass. IDs of chats that don't exist are skipped.
+        The deletes are saved together on the next save.
+
+        Returns:
+            List[str]: Session IDs of the chats that were deleted.
+        """
+        deleted_at = datetime.now().isoformat() + "Z"
+        tombstones = []
+        for session_id in dict.fromkeys(session_ids):
+            chat = self.chats.pop(session_id, None)
+            if chat:
+                tombstones.append(Tombstone(session_id, deleted_at, chat.get_generation()))
+                
+        with self._lock:
+            for tombstone in tombstones:
+                self._dirty.discard(tombstone.sessionId)
+                self._deleted[tombstone.sessionId] = tombstone
+        for tombstone in tombstones:
+            self._summaries.remove(tombstone.sessionId)
+            self._search.remove(tombstone.sessionId)
             
-        return chats_deleted
+        return [tombstone.sessionId for tombstone in tombstones]
     
-    def load_chats(self, bucket_name: str, file_path: str, service_account_key_path: str):
+    def find_chats(self, older_than: Optional[datetime] = None) -> List[str]:
         """
-        Load the chats from a file stored in Google Cloud Storage.
+        Finds the session IDs of chats, e.g. to delete them in bulk.
 
         Args:
-            bucket_name (str): The name of the GCS bucket.
-            file_path (str): The path to the file in the GCS bucket.
-            service_account_key_path (str): Path to the service account key file for authentication.
+            older_than (datetime): Only find chats whose last message is before this time. Finds every chat if not given.
+        """
+        if older_than is None:
+            return list(self.chats)
+        
+        # timestamps are naive local times, so compare against the cutoff in local time too
+        if older_than.tzinfo:
+            older_than = older_than.astimezone().replace(tzinfo=None)
+        return [session_id for session_id, chat in list(self.chats.items()) if datetime.fromisoformat(chat.timestamp.rstrip("Z")) < older_than]
+    
+    def load_chats(self, store: "ChatStore", lazy: bool = False, max_resident: int = 0, min_idle: float = 0.0):
+        """
+        Load the chats from the given chat store.
+
+        Args:
+            store (ChatStore): The store to load the chats from.
+            lazy (bool): Only load the chats' metadata, and load each chat's history from the store the first time it's retrieved.
+            max_resident (int): When loading lazily, the number of chat histories to keep in memory before the least recently used are dropped.
+                0 keeps every history that was loaded.
+            min_idle (float): When loading lazily, the number of seconds a chat must go unused before its history can be dropped.
         """
         try:
-            blob = self.__get_gc_blob(bucket_name, file_path, service_account_key_path)
-            
-            # download the file content as a string
-            raw_data = blob.download_as_text(encoding="utf-8")
-            
-            parsed_manager = ChatManager.model_validate_json(raw_data)
-            self.chats = parsed_manager.chats
+            if lazy:
+                self._store, self._max_resident, self._min_idle = store, max_resident, min_idle
+                self.chats = store.load_metadata()
+            else:
+                self.chats = store.load_chats()
             
         except ValidationError as e:
             self.chats = {}
             print("Validation Error: ", e)
         except Exception as e:
             self.chats = {}
-            print("Error loading chats from GCS: ", e)
+            print("Error loading chats: ", e)
+            
+        self._summaries.rebuild(self.chats.values())
+        self.__load_search_index(store)
             
-    def save_chats(self, bucket_name: str, file_path: str, service_account_key_path: str):
+    def save_chats(self, store: "ChatStore", on_replaced=None, on_saved=None):
         """
-        Save the current chats to a file in Google Cloud Storage.
+        Save the chats that changed since the last save to the given chat store, and delete the chats that were deleted.
+        If saving fails, the changes stay pending and are retried on the next save.
+        
+        When the store is shared with other instances, a chat that was changed by another instance since it was loaded is
+        merged per chat: the copy with the newest timestamp wins. If the stored copy wins, it replaces the chat in memory.
 
         Args:
-            bucket_name (str): The name of the GCS bucket.
-            file_path (str): The path to the file in the GCS bucket.
-            service_account_key_path (str): Path to the service account key file for authentication.
-        """
-        try:
-            blob = self.__get_gc_blob(bucket_name, file_path, service_account_key_path)
-            data = self.model_dump_json(indent=4)
+            store (ChatStore): The store to save the chats to.
+            on_replaced (Callable[[str], None]): Called with the session ID of each chat that was replaced by its stored
+                copy, or removed because another instance deleted it, e.g. to drop the chat's live session.
+            on_saved (Callable[[Dict[str, int], List[str]], None]): Called after a successful save with the generation of each
+                chat that was saved, keyed by session ID, and the session IDs that were deleted.
             
-            blob.upload_from_string(data, content_type="application/json")
+        Returns:
+            bool: True if every change was saved.
+        """
+        # take the pending changes, so chats that change during the save are saved again next time
+        with self._lock:
+            dirty, self._dirty = self._dirty, set()
+            deleted, self._deleted = self._deleted, {}
             
-            print(f"Chats saved successfully to {file_path} in bucket {bucket_name}.")
+        if not dirty and not deleted:
+            return True
+        
+        try:
+            # never save a chat whose history isn't loaded, since that would overwrite its stored history
+            chats = [self.chats.get(session_id) for session_id in dirty]
+            chats = [chat for chat in chats if chat and chat.is_history_loaded()]
+            stale = store.save_chats(chats)
+            stale.update(store.delete_chats(list(deleted.values())))
             
         except Exception as e:
-            self.chats = {}
-            print("Error saving chats to GCS: ", e)
-    
+            # put the changes back, unless the chat was changed again in the meantime
+            with self._lock:
+                self._dirty |= {session_id for session_id in dirty if session_id not in self._deleted}
+                for session_id, tombstone in deleted.items():
+                    if session_id not in self._dirty:
+                        self._deleted.setdefault(session_id, tombstone)
+            print("Error saving chats: ", e)
+            return False
+        
+        for session_id, stored_chat in stale.items():
+            self.__apply_stored(session_id, stored_chat)
+            if on_replaced:
+                on_replaced(session_id)
+        if on_saved:
+            on_saved({chat.sessionId: chat.get_generation() for chat in chats if chat.sessionId not in stale},
+                     [session_id for session_id in deleted if session_id not in stale])
+                
+        print(f"Saved {len(dirty)} and deleted {len(deleted)} chats. {len(stale)} were replaced by newer stored copies.")
+        return True
     
-    def __get_gc_blob(self, bucket_name: str, file_path: str, service_account_key_path: str):
+    def refresh_chats(self, store: "ChatStore", changed: Dict[str, int], deleted: List[str], on_replaced=None):
         """
-        Helper function that gets and returns the blob at the given bucket, file path, and service account key.
+        Reloads chats that another process changed in the store, and removes the ones it deleted. Chats with unsaved
+        changes are left alone, since saving them merges them with the stored copy.
 
         Args:
-            bucket_name (str): The name of the GCS bucket.
-            file_path (str): The path to the file in the GCS bucket.
-            service_account_key_path (str): Path to the service account key file for authentication.
+            store (ChatStore): The store the chats were changed in.
+            changed (Dict[str, int]): Generation of each changed chat in the store, keyed by session ID. Chats that are
+                already at that generation aren't reloaded. 0 means unknown, so the chat is always reloaded.
+            deleted (List[str]): Session IDs of the deleted chats.
+            on_replaced (Callable[[str], None]): Called with the session ID of each chat that was reloaded or removed.
+        """
+        for session_id, generation in changed.items():
+            chat = self.chats.get(session_id)
+            if chat and generation and chat.get_generation() == generation:
+                continue
+            self.__apply_stored(session_id, store.load_chat(session_id))
+            if on_replaced:
+                on_replaced(session_id)
+                
+        for session_id in deleted:
+            if session_id in self.chats:
+                self.__apply_stored(session_id, None)
+                if on_replaced:
+                    on_replaced(session_id)
+    
+    def search(self, query: str, limit: int = 10) -> List[Dict[str, Any]]:
         """
-        # Create credentials from the service account key file
-        credentials = Credentials.from_service_account_file(service_account_key_path)
+        Finds the chats whose messages or summary best match the query.
 
-        # Create storage client using the provided credentials
-        # client = storage.Client()
-        client = storage.Client(credentials=credentials)
+        Args:
+            query (str): Words to search for.
+            limit (int): Maximum number of results.
+
+        Returns:
+            List[Dict[str, Any]]: sessionId, summary, timestamp, score and a snippet of the best matching message of each chat, best match first.
+        """
+        terms = tokenize(query)
+        results = []
+        for session_id, score in self._search.search(query, limit):
+            chat = self.chats.get(session_id)
+            if not chat:
+                continue
+            
+            # only the results' histories are read, to cut snippets from the message with the most matching words
+            best, best_hits = chat.summary, 0
+            for message in self.__stored_copy(chat).history:
+                text = " ".join(message.parts)
+                hits = len(set(terms) & set(tokenize(text)))
+                if hits >= best_hits and hits:
+                    best, best_hits = text, hits
+                    
+            results.append({
+                "sessionId": session_id, "summary": chat.summary, "timestamp": chat.timestamp,
+                "score": round(score, 4), "snippet": make_snippet(best, terms),
+            })
+        return results
+    
+    def refresh_search_index(self):
+        """Indexes the chats that changed since the saved search index was built. Their histories are read from the store"""
+        while self._unindexed:
+            session_id = self._unindexed.pop()
+            chat = self.chats.get(session_id)
+            if chat:
+                try:
+                    self._search.update(self.__stored_copy(chat))
+                except Exception as e:
+                    print(f"Error indexing chat {session_id}: ", e)
+    
+    def save_search_index(self, store: "ChatStore") -> bool:
+        """Saves the search index to the given store if it changed since it was last saved. Returns True if it's saved"""
+        version = self._search.version
+        if version == self._search_saved:
+            return True
+        try:
+            store.save_index("search", self._search.dump())
+            self._search_saved = version
+            return True
+        except Exception as e:
+            print("Error saving search index: ", e)
+            return False
+    
+    def __load_search_index(self, store: "ChatStore"):
+        """Loads the saved search index, and lists the chats it's missing or has an outdated copy of"""
+        try:
+            loaded = self._search.load(store.load_index("search"))
+        except Exception as e:
+            loaded = False
+            print("Error loading search index: ", e)
         
-        # get bucket with name
-        bucket = client.get_bucket(bucket_name)
+        stale = self._search.stale(self.chats.values())
+        if loaded:
+            self._search_saved = self._search.version
+            
+        # chats with a history in memory are indexed right away, the others by refresh_search_index
+        self._unindexed = [session_id for session_id in stale if not self.chats[session_id].is_history_loaded()]
+        for session_id in stale:
+            if self.chats[session_id].is_history_loaded():
+                self._search.update(self.chats[session_id])
+    
+    def __stored_copy(self, chat: Chat) -> Chat:
+        """Gets the chat if its history is in memory, or else a copy read from the store, so the chat doesn't become resident"""
+        if chat.is_history_loaded() or not self._store:
+            return chat
+        return self._store.load_chat(chat.sessionId) or Chat(sessionId=chat.sessionId)
+    
+    def __apply_stored(self, session_id: str, stored_chat: Optional[Chat]):
+        """Replaces a chat with the newer copy in the store, or removes it if it was deleted from the store"""
+        with self._lock:
+            if session_id in self._dirty or session_id in self._deleted:
+                return # changed again during the save. The next save merges it again
+            
+            chat = self.chats.get(session_id)
+            if stored_chat is None:
+                self.chats.pop(session_id, None)
+                self._resident.pop(session_id, None)
+            elif chat:
+                chat.replace_with(stored_chat)
+                self.__touch(session_id)
+            else:
+                self.chats[session_id] = stored_chat
+                self.__touch(session_id)
+                
+        if stored_chat is None:
+            self._summaries.remove(session_id)
+            self._search.remove(session_id)
+        else:
+            self._summaries.update(self.chats.get(session_id, stored_chat))
+            self._search.update(self.chats.get(session_id, stored_chat))
+    
+    def __touch(self, session_id: str):
+        """
+        Marks a chat's history as recently used, and drops the least recently used histories that are over the limit.
+        Only histories that are saved and have been idle for a while are dropped, so no request is still using them. Must hold self._lock
+        """
+        now = time.monotonic()
+        self._resident[session_id] = now
+        self._resident.move_to_end(session_id)
         
-        # get the blob
-        blob = bucket.get_blob(file_path)
+        if not self._max_resident:
+            return
         
-        return blob
+        for resident_id, last_used in list(self._resident.items()):
+            if len(self._resident) <= self._max_resident or now - last_used < self._min_idle:
+                break
+            
+            chat = self.chats.get(resident_id)
+            if resident_id in self._dirty or resident_id in self._deleted:
+                continue
+            if chat:
+                chat.unload_history()
+            del self._resident[resident_id]
@@ -0,0 +1,712 @@
+from abc import ABC, abstractmethod
+from typing import List, Dict, Optional, Callable, ContextManager, Tuple, Union
+from concurrent.futures import ThreadPoolExecutor
+from chat_schema import Chat, ChatManager, Message, Tombstone
+from chat_codec import encode_chat, decode_chat, encode_tombstone, decode_tombstone, check_format, CONTENT_TYPES
+import json
+import os
+import sqlite3
+import threading
+import time
+
+MAX_STORAGE_WORKERS = 16
+MAX_WRITE_ATTEMPTS = 3 # conditional writes of a chat that keeps changing on other instances give up after this many conflicts
+GCS_SCOPES = ["https://www.googleapis.com/auth/devstorage.read_write"]
+
+
+class ChatStore(ABC):
+    """Interface for the storage backends that ChatManager loads chats from and saves chats to"""
+
+    @abstractmethod
+    def load_chats(self) -> Dict[str, Chat]:
+        """Loads every stored chat, keyed by session ID"""
+
+    @abstractmethod
+    def load_chat(self, session_id: str) -> Optional[Chat]:
+        """Loads a single chat, or returns None if it isn't stored"""
+
+    @abstractmethod
+    def save_chats(self, chats: List[Chat]) -> Dict[str, Optional[Chat]]:
+        """
+        Saves the given chats, replacing their stored copies. Raises an exception if any chat fails to save.
+
+        Stores shared by several instances only replace a stored copy that is still at the chat's generation. If another
+        instance changed it since, the copy with the newest timestamp wins.
+
+        Returns:
+            Dict[str, Optional[Chat]]: The chats that weren't saved because the store has a newer copy, keyed by session ID.
+                The value is the stored copy, or None if the chat was deleted by another instance.
+        """
+
+    @abstractmethod
+    def delete_chats(self, tombstones: List[Tombstone]) -> Dict[str, Optional[Chat]]:
+        """
+        Deletes the stored chats the given tombstones are for. Missing chats are ignored.
+
+        Returns:
+            Dict[str, Optional[Chat]]: The chats that weren't deleted because another instance saved them after they were deleted here,
+                keyed by session ID. See save_chats.
+        """
+
+    def load_metadata(self) -> Dict[str, Chat]:
+        """Loads every stored chat without its history, keyed by session ID. Histories are loaded on demand with load_chat"""
+        chats = self.load_chats()
+        for chat in chats.values():
+            chat.unload_history()
+        return chats
+
+    def load_index(self, name: str) -> Optional[bytes]:
+        """Loads an index saved with save_index, e.g. the search index, or returns None if it isn't stored"""
+        return None
+
+    def save_index(self, name: str, data: bytes):
+        """Saves an index built over the chats, so it doesn't need to be rebuilt from every history on startup. Stores that can't keep one ignore it"""
+
+
+class GCSChatStore(ChatStore):
+    """Stores each chat as its own object under a prefix in a Google Cloud Storage bucket"""
+    def __init__(self, bucket_name: str, prefix: str, service_account_key_path: str, legacy_file_path: str = "", format: str = "json", migrate_legacy: bool = True):
+        """
+        Args:
+            bucket_name (str): The name of the GCS bucket.
+            prefix (str): The path prefix of the chat objects in the GCS bucket.
+            service_account_key_path (str): Path to the service account key file for authentication.
+            legacy_file_path (str): The path to the legacy file that holds all chats in the GCS bucket. If there are no chat objects yet,
+                chats are loaded from this file and written back as chat objects.
+            format (str): Format chats are saved in. See chat_codec.FORMATS. Chats in any format can be loaded.
+            migrate_legacy (bool): Write the chats loaded from the legacy file back as chat objects. Turn it off to only read
+                the bucket, e.g. for a dry run.
+        """
+        check_format(format)
+        self.format = format
+        self.migrate_legacy = migrate_legacy
+        self.bucket_name = bucket_name
+        self.prefix = prefix
+        self.service_account_key_path = service_account_key_path
+        self.legacy_file_path = legacy_file_path
+        self.bucket = None
+        self.bucket_lock = threading.Lock()
+
+
+    def load_chats(self) -> Dict[str, Chat]:
+        bucket = self.__get_gc_bucket()
+        blobs = list(bucket.client.list_blobs(bucket, prefix=self.prefix))
+
+        if not blobs and self.legacy_file_path:
+            return self.__migrate_legacy_file(bucket)
+
+        # download the chats in parallel, since each one is a separate round trip
+        with ThreadPoolExecutor(max_workers=MAX_STORAGE_WORKERS) as pool:
+            chats = pool.map(self.__download, [blob for blob in blobs if not self.__is_tombstone(blob)])
+            return {chat.sessionId: chat for chat in chats}
+
+
+    def load_metadata(self) -> Dict[str, Chat]:
+        bucket = self.__get_gc_bucket()
+        blobs = list(bucket.client.list_blobs(bucket, prefix=self.prefix))
+
+        if not blobs and self.legacy_file_path:
+            chats = self.__migrate_legacy_file(bucket)
+            for chat in chats.values():
+                chat.unload_history()
+            return chats
+
+        # the listing already has each object's metadata, so only objects saved before metadata was added need to be downloaded
+        chats = {}
+        for blob in blobs:
+            metadata = blob.metadata or {}
+            if self.__is_tombstone(blob):
+                continue
+            if "timestamp" in metadata:
+                chat = Chat(**metadata)
+                chat.set_generation(blob.generation)
+            else:
+                chat = self.__download(blob)
+            chat.unload_history()
+            chats[chat.sessionId] = chat
+        return chats
+
+
+    def load_chat(self, session_id: str) -> Optional[Chat]:
+        stored, _ = self.__load_stored(self.__get_gc_bucket(), session_id)
+        return stored if isinstance(stored, Chat) else None
+
+
+    def save_chats(self, chats: List[Chat]) -> Dict[str, Optional[Chat]]:
+        bucket = self.__get_gc_bucket()
+
+        def upload(chat: Chat):
+            # keep the chat's metadata on the object too, so it can be listed without downloading the history
+            metadata = {"sessionId": chat.sessionId, "summary": chat.summary, "timestamp": chat.timestamp, "summaryTimestamp": chat.summaryTimestamp, "summaryHash": chat.summaryHash}
+            return self.__write(bucket, chat, chat.get_generation(), encode_chat(chat, self.format), CONTENT_TYPES[self.format], metadata)
+
+        return self.__run_all(upload, chats)
+
+
+    def delete_chats(self, tombstones: List[Tombstone]) -> Dict[str, Optional[Chat]]:
+        bucket = self.__get_gc_bucket()
+
+        def delete(tombstone: Tombstone):
+            # replace the chat with a tombstone instead of deleting it, so instances holding an old copy don't save it again
+            metadata = {"sessionId": tombstone.sessionId, "deleted": tombstone.timestamp}
+            return self.__write(bucket, tombstone, tombstone.generation, encode_tombstone(tombstone), CONTENT_TYPES["json"], metadata)
+
+        return self.__run_all(delete, tombstones)
+
+
+    def load_index(self, name: str) -> Optional[bytes]:
+        from google.api_core.exceptions import NotFound
+        try:
+            return self.__get_gc_bucket().blob(self.index_path(name)).download_as_bytes()
+        except NotFound:
+            return None
+
+
+    def save_index(self, name: str, data: bytes):
+        self.__get_gc_bucket().blob(self.index_path(name)).upload_from_string(data, content_type="application/gzip")
+
+
+    def chat_path(self, session_id: str) -> str:
+        """Path of a chat's object in the GCS bucket. It keeps the .json name in every format, so chats saved before compression was added are still found"""
+        return f"{self.prefix}{session_id}.json"
+
+
+    def index_path(self, name: str) -> str:
+        """Path of an index's object in the GCS bucket. It's outside the prefix, so listing the chats doesn't include it"""
+        return f"{self.prefix.rstrip('/')}-indexes/{name}"
+
+
+    def __migrate_legacy_file(self, bucket) -> Dict[str, Chat]:
+        """Loads the chats from the legacy file and saves them as chat objects, unless migrate_legacy is off"""
+        from google.api_core.exceptions import NotFound
+        try:
+            # download the file content as a string
+            raw_data = bucket.blob(self.legacy_file_path).download_as_text(encoding="utf-8")
+        except NotFound:
+            return {}
+        chats = ChatManager.model_validate_json(raw_data).chats
+        if not self.migrate_legacy:
+            return chats
+
+        self.save_chats(list(chats.values()))
+        print(f"Migrated {len(chats)} chats from {self.legacy_file_path} to {self.prefix} in bucket {self.bucket_name}.")
+        return chats
+
+
+    def __write(self, bucket, item: Union[Chat, Tombstone], generation: int, data: bytes, content_type: str, metadata: Dict[str, str]) -> Dict[str, Optional[Chat]]:
+        """
+        Uploads a chat or a tombstone if its object is still at the given generation, 0 meaning it doesn't exist yet.
+        On a conflict the stored object is downloaded, and the upload is retried on top of it if the item is newer.
+
+        Returns:
+            Dict[str, Optional[Chat]]: The stored copy keyed by session ID if it's newer than the item, otherwise an empty dict.
+        """
+        from google.api_core.exceptions import PreconditionFailed
+        blob = bucket.blob(self.chat_path(item.sessionId))
+        blob.metadata = metadata
+        for _ in range(MAX_WRITE_ATTEMPTS):
+            try:
+                blob.upload_from_string(data, content_type=content_type, if_generation_match=generation)
+                if isinstance(item, Chat):
+                    item.set_generation(blob.generation)
+                return {}
+            except PreconditionFailed:
+                stored, generation = self.__load_stored(bucket, item.sessionId)
+                if isinstance(item, Tombstone) and isinstance(stored, Tombstone):
+                    return {} # deleted by another instance too
+                if not _is_newer(item, stored):
+                    return {item.sessionId: stored if isinstance(stored, Chat) else None}
+
+        raise RuntimeError(f"Chat {item.sessionId} was changed by other instances on every attempt to save it.")
+
+
+    def __load_stored(self, bucket, session_id: str) -> Tuple[Union[Chat, Tombstone, None], int]:
+        """Downloads a chat's object. Returns the chat or tombstone with its generation, or (None, 0) if there's no object"""
+        from google.api_core.exceptions import NotFound
+        blob = bucket.blob(self.chat_path(session_id))
+        try:
+            # download straight away instead of fetching the blob's metadata first. The download sets the generation
+            raw_data = blob.download_as_bytes()
+        except NotFound:
+            return None, 0
+        return decode_tombstone(raw_data) or self.__decode(raw_data, blob.generation), blob.generation
+
+
+    def __download(self, blob) -> Chat:
+        return self.__decode(blob.download_as_bytes(), blob.generation)
+
+
+    @staticmethod
+    def __decode(data: bytes, generation: int) -> Chat:
+        chat = decode_chat(data)
+        chat.set_generation(generation)
+        return chat
+
+
+    @staticmethod
+    def __is_tombstone(blob) -> bool:
+        return "deleted" in (blob.metadata or {})
+
+
+    @staticmethod
+    def __run_all(func, items: list) -> Dict[str, Optional[Chat]]:
+        """Runs func on every item in parallel, merges the dicts it returns, and raises the first error once all of them are done"""
+        with ThreadPoolExecutor(max_workers=MAX_STORAGE_WORKERS) as pool:
+            futures = [pool.submit(func, item) for item in items]
+        errors = [future.exception() for future in futures if future.exception()]
+        if errors:
+            raise errors[0]
+
+        results = {}
+        for future in futures:
+            results.update(future.result() or {})
+        return results
+
+
+    def __get_gc_bucket(self):
+        """
+        Helper function that gets and returns the bucket. The storage client and bucket handle are created on first use and reused,
+        so later calls don't reload the service account key, open new connections, or fetch the bucket's metadata.
+        """
+        if self.bucket:
+            return self.bucket
+
+        with self.bucket_lock:
+            if not self.bucket:
+                from google.auth.transport.requests import AuthorizedSession
+                from google.cloud import storage
+                from google.oauth2.service_account import Credentials
+                from requests.adapters import HTTPAdapter
+
+                # Create credentials from the service account key file. The session refreshes the access token when it expires
+                credentials = Credentials.from_service_account_file(self.service_account_key_path, scopes=GCS_SCOPES)
+                session = AuthorizedSession(credentials)
+
+                # keep enough pooled connections open for every parallel upload or download
+                adapter = HTTPAdapter(pool_connections=MAX_STORAGE_WORKERS, pool_maxsize=MAX_STORAGE_WORKERS)
+                session.mount("https://", adapter)
+
+                # Create storage client using the provided credentials and session
+                client = storage.Client(project=credentials.project_id, credentials=credentials, _http=session)
+
+                # bucket() only builds a handle, unlike get_bucket() which makes a request for the bucket's metadata
+                self.bucket = client.bucket(self.bucket_name)
+
+        return self.bucket
+
+
+class LocalChatStore(ChatStore):
+    """Stores each chat as its own file in a local directory"""
+    def __init__(self, directory: str, format: str = "json"):
+        """
+        Args:
+            directory (str): The directory to store the chat files in. Created if it doesn't exist.
+            format (str): Format chats are saved in. See chat_codec.FORMATS. Chats in any format can be loaded.
+        """
+        check_format(format)
+        self.format = format
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+
+    def load_chats(self) -> Dict[str, Chat]:
+        chats = {}
+        for filename in os.listdir(self.directory):
+            if filename.endswith(".json"):
+                chat = self.load_chat(filename[:-len(".json")])
+                chats[chat.sessionId] = chat
+        return chats
+
+
+    def load_chat(self, session_id: str) -> Optional[Chat]:
+        try:
+            with open(self.chat_path(session_id), "rb") as file:
+                return decode_chat(file.read())
+        except FileNotFoundError:
+            return None
+
+
+    def save_chats(self, chats: List[Chat]) -> Dict[str, Optional[Chat]]:
+        # the directory belongs to a single instance, so chats are always overwritten
+        for chat in chats:
+            # write to a temporary file first, so a crash mid-write never leaves a half written chat behind
+            path = self.chat_path(chat.sessionId)
+            with open(path + ".tmp", "wb") as file:
+                file.write(encode_chat(chat, self.format))
+            os.replace(path + ".tmp", path)
+        return {}
+
+
+    def delete_chats(self, tombstones: List[Tombstone]) -> Dict[str, Optional[Chat]]:
+        for tombstone in tombstones:
+            try:
+                os.remove(self.chat_path(tombstone.sessionId))
+            except FileNotFoundError:
+                pass
+        return {}
+
+
+    def load_index(self, name: str) -> Optional[bytes]:
+        try:
+            with open(self.index_path(name), "rb") as file:
+                return file.read()
+        except FileNotFoundError:
+            return None
+
+
+    def save_index(self, name: str, data: bytes):
+        path = self.index_path(name)
+        with open(path + ".tmp", "wb") as file:
+            file.write(data)
+        os.replace(path + ".tmp", path)
+
+
+    def chat_path(self, session_id: str) -> str:
+        """Path of a chat's file"""
+        return os.path.join(self.directory, f"{self.__file_name(session_id)}.json")
+
+
+    def index_path(self, name: str) -> str:
+        """Path of an index's file. It doesn't end in .json, so it isn't loaded as a chat"""
+        return os.path.join(self.directory, f"{self.__file_name(name)}.index")
+
+
+    @staticmethod
+    def __file_name(name: str) -> str:
+        """Checks that a name can't reach a file outside the directory. Session IDs come from clients"""
+        separators = [sep for sep in ("/", "\\", os.sep, os.altsep) if sep]
+        if not name or ".." in name or any(sep in name for sep in separators):
+            raise ValueError(f"Invalid chat file name {name!r}.")
+        return name
+
+
+class SQLiteChatStore(ChatStore):
+    """
+    Stores chats in a SQLite database, with one table for session metadata and one for messages.
+    Both tables are keyed by session ID, so loading or deleting a chat doesn't need to read every chat. Summaries are
+    listed from ChatManager's in-memory summaries index, which is built from the chats' metadata on load.
+    """
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS sessions (
+            session_id TEXT PRIMARY KEY,
+            summary TEXT NOT NULL,
+            timestamp TEXT NOT NULL,
+            summary_timestamp TEXT NOT NULL DEFAULT '',
+            context_summary TEXT NOT NULL DEFAULT '',
+            context_summary_upto INTEGER NOT NULL DEFAULT 0,
+            summary_hash TEXT NOT NULL DEFAULT ''
+        );
+        CREATE TABLE IF NOT EXISTS messages (
+            session_id TEXT NOT NULL REFERENCES sessions (session_id) ON DELETE CASCADE,
+            seq INTEGER NOT NULL,
+            role TEXT NOT NULL,
+            parts TEXT NOT NULL,
+            PRIMARY KEY (session_id, seq)
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS indexes (
+            name TEXT PRIMARY KEY,
+            data BLOB NOT NULL
+        );
+    """
+
+    ADDED_COLUMNS = {
+        "summary_timestamp": "TEXT NOT NULL DEFAULT ''",
+        "context_summary": "TEXT NOT NULL DEFAULT ''",
+        "context_summary_upto": "INTEGER NOT NULL DEFAULT 0",
+        "summary_hash": "TEXT NOT NULL DEFAULT ''",
+    }
+    SESSION_COLUMNS = "session_id, summary, timestamp, summary_timestamp, context_summary, context_summary_upto, summary_hash"
+
+    def __init__(self, path: str):
+        """
+        Args:
+            path (str): Path to the SQLite database file. Created if it doesn't exist.
+        """
+        self.path = path
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA foreign_keys=ON")
+        self.connection.executescript(self.SCHEMA)
+        self.__migrate()
+
+
+    def load_chats(self) -> Dict[str, Chat]:
+        with self.lock:
+            sessions = self.connection.execute(f"SELECT {self.SESSION_COLUMNS} FROM sessions").fetchall()
+            messages = self.connection.execute("SELECT session_id, role, parts FROM messages ORDER BY session_id, seq").fetchall()
+
+        chats = {row[0]: self.__chat_from_row(row) for row in sessions}
+        for session_id, role, parts in messages:
+            chats[session_id].history.append(Message(role=role, parts=json.loads(parts)))
+        return chats
+
+
+    def load_metadata(self) -> Dict[str, Chat]:
+        with self.lock:
+            sessions = self.connection.execute(f"SELECT {self.SESSION_COLUMNS} FROM sessions").fetchall()
+
+        chats = {}
+        for row in sessions:
+            chat = self.__chat_from_row(row)
+            chat.unload_history()
+            chats[chat.sessionId] = chat
+        return chats
+
+
+    def load_chat(self, session_id: str) -> Optional[Chat]:
+        with self.lock:
+            session = self.connection.execute(f"SELECT {self.SESSION_COLUMNS} FROM sessions WHERE session_id = ?", (session_id,)).fetchone()
+            if not session:
+                return None
+            messages = self.connection.execute("SELECT role, parts FROM messages WHERE session_id = ? ORDER BY seq", (session_id,)).fetchall()
+
+        chat = self.__chat_from_row(session)
+        chat.history = [Message(role=role, parts=json.loads(parts)) for role, parts in messages]
+        return chat
+
+
+    def save_chats(self, chats: List[Chat]) -> Dict[str, Optional[Chat]]:
+        # the database file belongs to a single instance, so chats are always overwritten
+        with self.lock, self.connection:
+            for chat in chats:
+                # upsert instead of INSERT OR REPLACE, since replacing the row would cascade and delete its messages
+                self.connection.execute(
+                    f"INSERT INTO sessions ({self.SESSION_COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?) "
+                    "ON CONFLICT (session_id) DO UPDATE SET summary = excluded.summary, timestamp = excluded.timestamp, summary_timestamp = excluded.summary_timestamp, "
+                    "context_summary = excluded.context_summary, context_summary_upto = excluded.context_summary_upto, summary_hash = excluded.summary_hash",
+                    (chat.sessionId, chat.summary, chat.timestamp, chat.summaryTimestamp, chat.contextSummary, chat.contextSummaryUpto, chat.summaryHash)
+                )
+
+                # history is almost always appended to, so only write the messages past what's stored,
+                # unless the last stored message no longer matches (the history was cut short and then appended to)
+                stored = self.connection.execute("SELECT COUNT(*) FROM messages WHERE session_id = ?", (chat.sessionId,)).fetchone()[0]
+                if stored and not self.__last_message_matches(chat, stored):
+                    stored = 0
+                if stored > len(chat.history) or stored == 0:
+                    self.connection.execute("DELETE FROM messages WHERE session_id = ? AND seq >= ?", (chat.sessionId, stored))
+                self.connection.executemany(
+                    "INSERT INTO messages (session_id, seq, role, parts) VALUES (?, ?, ?, ?)",
+                    [(chat.sessionId, seq, message.role, json.dumps(message.parts, ensure_ascii=False)) for seq, message in enumerate(chat.history) if seq >= stored]
+                )
+        return {}
+
+
+    @staticmethod
+    def __chat_from_row(row) -> Chat:
+        """Creates a chat without history from a row of SESSION_COLUMNS"""
+        session_id, summary, timestamp, summary_timestamp, context_summary, context_summary_upto, summary_hash = row
+        return Chat(
+            sessionId=session_id, summary=summary, timestamp=timestamp, summaryTimestamp=summary_timestamp,
+            contextSummary=context_summary, contextSummaryUpto=context_summary_upto, summaryHash=summary_hash
+        )
+
+
+    def __migrate(self):
+        """Adds columns that were introduced after a database was created"""
+        columns = {row[1] for row in self.connection.execute("PRAGMA table_info(sessions)")}
+        with self.connection:
+            for column, definition in self.ADDED_COLUMNS.items():
+                if column not in columns:
+                    self.connection.execute(f"ALTER TABLE sessions ADD COLUMN {column} {definition}")
+
+
+    def __last_message_matches(self, chat: Chat, stored: int) -> bool:
+        """Checks if the last stored message of the chat is the same as the message at that position in its history"""
+        if stored > len(chat.history):
+            return False
+        row = self.connection.execute("SELECT role, parts FROM messages WHERE session_id = ? AND seq = ?", (chat.sessionId, stored - 1)).fetchone()
+        message = chat.history[stored - 1]
+        return row is not None and row[0] == message.role and json.loads(row[1]) == message.parts
+
+
+    def delete_chats(self, tombstones: List[Tombstone]) -> Dict[str, Optional[Chat]]:
+        with self.lock, self.connection:
+            self.connection.executemany("DELETE FROM sessions WHERE session_id = ?", [(tombstone.sessionId,) for tombstone in tombstones])
+        return {}
+
+
+    def load_index(self, name: str) -> Optional[bytes]:
+        with self.lock:
+            row = self.connection.execute("SELECT data FROM indexes WHERE name = ?", (name,)).fetchone()
+        return row[0] if row else None
+
+
+    def save_index(self, name: str, data: bytes):
+        with self.lock, self.connection:
+            self.connection.execute("INSERT OR REPLACE INTO indexes (name, data) VALUES (?, ?)", (name, data))
+
+
+class MemoryChatStore(ChatStore):
+    """
+    Keeps serialized chats in memory, waiting a fixed latency on every call to stand in for a remote store.
+    Used to benchmark the app without touching GCS or the disk. Nothing survives a restart.
+    Writes are conditional on generations like in GCS, so several handlers sharing one store behave like instances sharing a bucket.
+    """
+    def __init__(self, latency: float = 0.0, format: str = "json"):
+        """
+        Args:
+            latency (float): Number of seconds every load, save and delete waits, like a round trip to a remote store.
+            format (str): Format chats are serialized in. See chat_codec.FORMATS.
+        """
+        check_format(format)
+        self.format = format
+        self.latency = latency
+        self.chats: Dict[str, Tuple[int, bytes]] = {} # session ID -> (generation, serialized chat or tombstone)
+        self.indexes: Dict[str, bytes] = {}
+        self.generation = 0
+        self.lock = threading.Lock()
+
+
+    def load_chats(self) -> Dict[str, Chat]:
+        self.__wait()
+        with self.lock:
+            stored = list(self.chats.values())
+        chats = [self.__decode(generation, data) for generation, data in stored]
+        return {chat.sessionId: chat for chat in chats if isinstance(chat, Chat)}
+
+
+    def load_chat(self, session_id: str) -> Optional[Chat]:
+        self.__wait()
+        with self.lock:
+            stored = self.chats.get(session_id)
+        chat = self.__decode(*stored) if stored else None
+        return chat if isinstance(chat, Chat) else None
+
+
+    def save_chats(self, chats: List[Chat]) -> Dict[str, Optional[Chat]]:
+        self.__wait()
+        # serialize like the other stores do, so benchmarks pay for it
+        serialized = [(chat, chat.get_generation(), encode_chat(chat, self.format)) for chat in chats]
+        with self.lock:
+            return self.__write_all(serialized)
+
+
+    def delete_chats(self, tombstones: List[Tombstone]) -> Dict[str, Optional[Chat]]:
+        self.__wait()
+        serialized = [(tombstone, tombstone.generation, encode_tombstone(tombstone)) for tombstone in tombstones]
+        with self.lock:
+            return self.__write_all(serialized)
+
+
+    def load_index(self, name: str) -> Optional[bytes]:
+        self.__wait()
+        return self.indexes.get(name)
+
+
+    def save_index(self, name: str, data: bytes):
+        self.__wait()
+        self.indexes[name] = data
+
+
+    def __write_all(self, items: List[Tuple[Union[Chat, Tombstone], int, bytes]]) -> Dict[str, Optional[Chat]]:
+        """Writes each chat or tombstone, merging with the stored copy when the generation doesn't match. Must hold self.lock"""
+        stale = {}
+        for item, generation, data in items:
+            stored_generation, stored_data = self.chats.get(item.sessionId, (0, b""))
+            if stored_generation != generation:
+                stored = self.__decode(stored_generation, stored_data) if stored_data else None
+                if isinstance(item, Tombstone) and isinstance(stored, Tombstone):
+                    continue
+                if not _is_newer(item, stored):
+                    stale[item.sessionId] = stored if isinstance(stored, Chat) else None
+                    continue
+
+            self.generation += 1
+            self.chats[item.sessionId] = (self.generation, data)
+            if isinstance(item, Chat):
+                item.set_generation(self.generation)
+        return stale
+
+
+    @staticmethod
+    def __decode(generation: int, data: bytes) -> Union[Chat, Tombstone]:
+        tombstone = decode_tombstone(data)
+        if tombstone:
+            return tombstone
+        chat = decode_chat(data)
+        chat.set_generation(generation)
+        return chat
+
+
+    def __wait(self):
+        if self.latency:
+            time.sleep(self.latency)
+
+
+class TimedChatStore(ChatStore):
+    """Wraps another chat store and times every call to it, including the serialization the store does"""
+    def __init__(self, store: ChatStore, timer: Callable[[str, str], ContextManager]):
+        """
+        Args:
+            store (ChatStore): The store to wrap.
+            timer (Callable): Function that takes a stage and an operation name, and returns a context manager timing its body.
+        """
+        self.store = store
+        self.timer = timer
+
+
+    def load_chats(self) -> Dict[str, Chat]:
+        with self.timer("storage", "load_chats"):
+            return self.store.load_chats()
+
+
+    def load_chat(self, session_id: str) -> Optional[Chat]:
+        with self.timer("storage", "load_chat"):
+            return self.store.load_chat(session_id)
+
+
+    def save_chats(self, chats: List[Chat]) -> Dict[str, Optional[Chat]]:
+        with self.timer("storage", "save_chats"):
+            return self.store.save_chats(chats)
+
+
+    def delete_chats(self, tombstones: List[Tombstone]) -> Dict[str, Optional[Chat]]:
+        with self.timer("storage", "delete_chats"):
+            return self.store.delete_chats(tombstones)
+
+
+    def load_metadata(self) -> Dict[str, Chat]:
+        with self.timer("storage", "load_metadata"):
+            return self.store.load_metadata()
+
+
+    def load_index(self, name: str) -> Optional[bytes]:
+        with self.timer("storage", "load_index"):
+            return self.store.load_index(name)
+
+
+    def save_index(self, name: str, data: bytes):
+        with self.timer("storage", "save_index"):
+            return self.store.save_index(name, data)
+
+
+def _is_newer(item: Union[Chat, Tombstone], stored: Union[Chat, Tombstone, None]) -> bool:
+    """
+    Checks if a chat or tombstone should replace the stored one. The newest timestamp wins, and a chat wins a tie with
+    another chat, since saving it again is harmless. A chat that's missing from the store is always replaced.
+    """
+    if stored is None:
+        return True
+    if isinstance(item, Chat) and isinstance(stored, Chat):
+        return item.timestamp >= stored.timestamp
+    return item.timestamp > stored.timestamp
+
+
+def create_chat_store(backend: str, **options) -> ChatStore:
+    """
+    Creates the chat store for the given backend name.
+
+    Args:
+        backend (str): One of "gcs", "local", "sqlite" or "memory".
+        options: Passed to the store's constructor.
+    """
+    stores = {
+        "gcs": GCSChatStore,
+        "local": LocalChatStore,
+        "sqlite": SQLiteChatStore,
+        "memory": MemoryChatStore,
+    }
+    if backend not in stores:
+        raise ValueError(f"Unknown chat store {backend}. Expected one of {', '.join(stores)}.")
+    return stores[backend](**options)
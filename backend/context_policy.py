@@ -0,0 +1,116 @@
+from typing import Callable, List, Dict, Any
+import threading
+
+CHARS_PER_TOKEN = 4 # rough average for English text, good enough to decide when to compact
+SUMMARY_PREFIX = "Here is a summary of our conversation so far: "
+SUMMARY_ACKNOWLEDGEMENT = "Got it, I'll keep that in mind."
+
+
+def estimate_tokens(history: List[Dict[str, Any]]) -> int:
+    """Estimates the number of tokens in a chat history without calling the model"""
+    return sum(len(part) for message in history for part in message["parts"]) // CHARS_PER_TOKEN + len(history)
+
+
+class ContextPolicy:
+    """
+    Decides which part of a chat's history is handed to the model.
+
+    Histories that fit in the token budget are passed through as they are. Longer histories keep their last few turns,
+    and every older message is replaced by a rolling summary that is cached on the chat. When more messages fall out of
+    the recent turns, the cached summary is extended with just those messages, instead of summarizing the whole history again.
+    The chat's full history is never changed.
+    """
+    def __init__(self, token_budget: int, keep_last_turns: int, summarize: Callable[[str, List[Dict[str, Any]]], str], on_summary: Callable[[Any], None]):
+        """
+        Args:
+            token_budget (int): Estimated number of tokens of history the model is given before older turns are summarized.
+            keep_last_turns (int): Number of recent user/model turns that are always passed to the model as they are.
+            summarize (Callable): Function that takes the previous summary and the messages that come after it, and returns a new summary.
+            on_summary (Callable): Function called with the chat after its cached summary changes.
+        """
+        self.token_budget = token_budget
+        self.keep_last_turns = keep_last_turns
+        self.summarize = summarize
+        self.on_summary = on_summary
+
+
+    def build_history(self, chat) -> List[Dict[str, Any]]:
+        """Builds the history to start a model session with for the given chat"""
+        history = chat.get_history()
+        if estimate_tokens(history) <= self.token_budget:
+            return history
+
+        # keep the last turns, starting on a user message so the model sees whole turns
+        cutoff = max(0, len(history) - 2 * self.keep_last_turns)
+        while cutoff < len(history) and history[cutoff]["role"] != "user":
+            cutoff += 1
+
+        summary, summary_upto = chat.contextSummary, chat.contextSummaryUpto
+        if summary_upto > len(history):
+            # the history was cut short since the summary was made, so it can't be extended
+            summary, summary_upto = "", 0
+
+        if summary_upto < cutoff:
+            summary = self.summarize(summary, history[summary_upto:cutoff])
+            summary_upto = cutoff
+            chat.set_context_summary(summary, summary_upto)
+            self.on_summary(chat)
+
+        if not summary:
+            return history
+
+        return [
+            {"role": "user", "parts": [SUMMARY_PREFIX + summary]},
+            {"role": "model", "parts": [SUMMARY_ACKNOWLEDGEMENT]},
+        ] + history[summary_upto:]
+
+
+    def is_over_budget(self, history_bytes: int) -> bool:
+        """
+        Checks if a live session with this much history should be restarted from a compacted history.
+        Sessions are allowed to grow to twice the budget, so a restarted session isn't summarized again on its next message.
+        """
+        return history_bytes // CHARS_PER_TOKEN > 2 * self.token_budget
+
+
+class TokenStats:
+    """Running totals of the tokens sent to and received from the model, to measure what compaction saves"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.prompt_tokens = 0
+        self.output_tokens = 0
+        self.full_history_tokens = 0 # estimated prompt tokens if the whole history had been sent
+        self.last_request = {}
+
+
+    def record(self, response, full_history: List[Dict[str, Any]]):
+        """
+        Records the token usage of a model response.
+
+        Args:
+            response: The model's response. Responses without usage metadata are counted as 0 tokens.
+            full_history (List[Dict[str, Any]]): The chat's full history, including the message that was sent.
+        """
+        usage = getattr(response, "usage_metadata", None)
+        prompt_tokens = getattr(usage, "prompt_token_count", 0) or 0
+        output_tokens = getattr(usage, "candidates_token_count", 0) or 0
+        full_history_tokens = estimate_tokens(full_history)
+
+        with self.lock:
+            self.requests += 1
+            self.prompt_tokens += prompt_tokens
+            self.output_tokens += output_tokens
+            self.full_history_tokens += full_history_tokens
+            self.last_request = {"promptTokens": prompt_tokens, "outputTokens": output_tokens, "fullHistoryTokens": full_history_tokens}
+
+
+    def stats(self) -> Dict[str, Any]:
+        with self.lock:
+            return {
+                "requests": self.requests,
+                "promptTokens": self.prompt_tokens,
+                "outputTokens": self.output_tokens,
+                "fullHistoryTokens": self.full_history_tokens,
+                "lastRequest": dict(self.last_request),
+            }
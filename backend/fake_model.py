@@ -0,0 +1,186 @@
+from typing import List, Dict, Any, Optional
+import asyncio
+import hashlib
+import json
+import os
+import random
+import re
+import threading
+import time
+
+# Local stand-in for genai.GenerativeModel, selected with MODEL_PROVIDER=fake. It needs no API key or network, and
+# its replies only depend on the prompt and the history before it, so runs can be compared with each other.
+FAKE_MODEL_LATENCY = float(os.getenv("FAKE_MODEL_LATENCY", "0.5")) # seconds before the first token
+FAKE_MODEL_TOKENS_PER_SECOND = float(os.getenv("FAKE_MODEL_TOKENS_PER_SECOND", "100"))
+FAKE_MODEL_OUTPUT_TOKENS = int(os.getenv("FAKE_MODEL_OUTPUT_TOKENS", "40"))
+FAKE_MODEL_FAILURE_RATE = float(os.getenv("FAKE_MODEL_FAILURE_RATE", "0")) # fraction of calls that raise FakeModelError
+FAKE_MODEL_SEED = int(os.getenv("FAKE_MODEL_SEED", "0"))
+CHARS_PER_TOKEN = 4
+WORDS = [
+    "you", "got", "this", "keep", "going", "every", "step", "counts", "believe", "in", "yourself", "progress",
+    "not", "perfection", "small", "wins", "add", "up", "stay", "strong", "today", "is", "your", "day",
+]
+
+
+class FakeModelError(ConnectionError):
+    """Raised by the fake model for the calls picked to fail. It's a ConnectionError so it's retried like an upstream outage"""
+
+
+class FakeUsageMetadata:
+    def __init__(self, prompt_token_count: int, candidates_token_count: int):
+        self.prompt_token_count = prompt_token_count
+        self.candidates_token_count = candidates_token_count
+
+
+class FakeChunk:
+    def __init__(self, text: str):
+        self.text = text
+
+
+class FakeResponse:
+    """Mimics GenerateContentResponse: has text and usage_metadata, and can be iterated for its chunks when streamed"""
+    def __init__(self, model: "FakeGenerativeModel", words: List[str], prompt_tokens: int, fail: bool, on_complete=None, text: Optional[str] = None):
+        self.model = model
+        self.words = words
+        self.text = text if text is not None else " ".join(words) + "\n" # gemini ends its replies with a newline too
+        self.usage_metadata = FakeUsageMetadata(prompt_tokens, len(words))
+        self.fail = fail
+        self.on_complete = on_complete
+
+
+    def __iter__(self):
+        for i, word in enumerate(self.words):
+            time.sleep(self.model.token_delay)
+            if self.fail and i == len(self.words) // 2:
+                raise FakeModelError("Fake model failed mid-stream")
+            yield FakeChunk(word + " ")
+        if self.on_complete:
+            self.on_complete(self.text)
+
+
+    async def __aiter__(self):
+        for i, word in enumerate(self.words):
+            await asyncio.sleep(self.model.token_delay)
+            if self.fail and i == len(self.words) // 2:
+                raise FakeModelError("Fake model failed mid-stream")
+            yield FakeChunk(word + " ")
+        if self.on_complete:
+            self.on_complete(self.text)
+
+
+class FakeChatSession:
+    """Mimics genai.ChatSession. The history is a list of {"role", "parts"} dicts"""
+    def __init__(self, model: "FakeGenerativeModel", history: List[Dict[str, Any]]):
+        self.model = model
+        self.history = list(history)
+
+
+    def send_message(self, content, stream: bool = False, **kwargs) -> FakeResponse:
+        response = self.model.prepare(self.history + [content], kwargs.get("generation_config"), stream, self.__add_reply(content))
+        self.model.wait(response, stream)
+        if not stream:
+            response.on_complete(response.text)
+        return response
+
+
+    async def send_message_async(self, content, stream: bool = False, **kwargs) -> FakeResponse:
+        response = self.model.prepare(self.history + [content], kwargs.get("generation_config"), stream, self.__add_reply(content))
+        await self.model.wait_async(response, stream)
+        if not stream:
+            response.on_complete(response.text)
+        return response
+
+
+    def __add_reply(self, content):
+        """Returns a function that adds the message and the model's reply to the history, like ChatSession does once a reply completes"""
+        def add_reply(text: str):
+            self.history.append({"role": "user", "parts": [_text_of(content)]})
+            self.history.append({"role": "model", "parts": [text]})
+        return add_reply
+
+
+class FakeGenerativeModel:
+    """
+    Mimics genai.GenerativeModel. Replies take a fixed latency before the first token plus a delay per token, and a
+    seeded fraction of calls fail. Streamed calls that fail do so halfway through the reply.
+    """
+    def __init__(self, latency: float = FAKE_MODEL_LATENCY, tokens_per_second: float = FAKE_MODEL_TOKENS_PER_SECOND,
+                 output_tokens: int = FAKE_MODEL_OUTPUT_TOKENS, failure_rate: float = FAKE_MODEL_FAILURE_RATE,
+                 seed: int = FAKE_MODEL_SEED, generation_config: Optional[Dict[str, Any]] = None):
+        """
+        Args:
+            latency (float): Number of seconds before the first token of a reply.
+            tokens_per_second (float): Rate the rest of the reply is generated at. 0 means instantly.
+            output_tokens (int): Number of tokens in a reply, capped by max_output_tokens in the generation config.
+            failure_rate (float): Fraction of calls that raise FakeModelError.
+            seed (int): Seed for picking which calls fail.
+            generation_config (Dict[str, Any]): Same as for genai.GenerativeModel. Only max_output_tokens is used.
+        """
+        self.latency = latency
+        self.token_delay = 1 / tokens_per_second if tokens_per_second else 0.0
+        self.output_tokens = output_tokens
+        self.failure_rate = failure_rate
+        self.generation_config = generation_config or {}
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+
+
+    def start_chat(self, history: Optional[List[Dict[str, Any]]] = None) -> FakeChatSession:
+        return FakeChatSession(self, history or [])
+
+
+    def generate_content(self, contents, stream: bool = False, **kwargs) -> FakeResponse:
+        response = self.prepare(_as_list(contents), kwargs.get("generation_config"), stream)
+        self.wait(response, stream)
+        return response
+
+
+    async def generate_content_async(self, contents, stream: bool = False, **kwargs) -> FakeResponse:
+        response = self.prepare(_as_list(contents), kwargs.get("generation_config"), stream)
+        await self.wait_async(response, stream)
+        return response
+
+
+    def prepare(self, contents: List[Any], generation_config: Optional[Dict[str, Any]], stream: bool, on_complete=None) -> FakeResponse:
+        """Builds the reply to the given contents. on_complete is called with the reply's text once a streamed reply has been read"""
+        with self.lock:
+            fail = self.rng.random() < self.failure_rate
+        if fail and not stream:
+            raise FakeModelError("Fake model failed")
+
+        config = {**self.generation_config, **(generation_config or {})}
+        num_tokens = min(self.output_tokens, config.get("max_output_tokens", self.output_tokens))
+        texts = [_text_of(content) for content in contents]
+
+        # seed the words from the prompt and everything before it, so the same conversation always gets the same reply
+        digest = hashlib.sha256("\0".join(texts).encode("utf-8")).digest()
+        words_rng = random.Random(digest)
+        words = [words_rng.choice(WORDS) for _ in range(max(1, num_tokens))]
+
+        prompt_tokens = sum(len(text) for text in texts) // CHARS_PER_TOKEN
+        if config.get("response_mime_type") == "application/json":
+            # JSON replies answer batched summary requests, with an item for every "id" in the prompt
+            ids = re.findall(r'"id":\s*"([^"]*)"', texts[-1] if texts else "")
+            items = [{"id": id, "summary": " ".join(words_rng.choice(WORDS).title() for _ in range(3))} for id in ids]
+            return FakeResponse(self, words, prompt_tokens, fail, on_complete, text=json.dumps(items))
+        return FakeResponse(self, words, prompt_tokens, fail, on_complete)
+
+
+    def wait(self, response: FakeResponse, stream: bool):
+        """Waits as long as the model would take to start a streamed reply, or to finish a whole reply"""
+        time.sleep(self.latency if stream else self.latency + self.token_delay * len(response.words))
+
+
+    async def wait_async(self, response: FakeResponse, stream: bool):
+        await asyncio.sleep(self.latency if stream else self.latency + self.token_delay * len(response.words))
+
+
+def _as_list(contents) -> List[Any]:
+    return contents if isinstance(contents, list) else [contents]
+
+
+def _text_of(content) -> str:
+    """Gets the text of a message given as a string or a {"role", "parts"} dict"""
+    if isinstance(content, dict):
+        return "".join(str(part) for part in content.get("parts", []))
+    return str(content)
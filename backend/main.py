@@ -1,78 +1,327 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify, make_response, stream_with_context, g
 from chat_handler import GeminiChatHandler
 from chat_schema import *
-import copy
+from response_compression import compress_body, COMPRESSIBLE_TYPES
+import json
+import time
 
 # Initialize flask app
 app = Flask(__name__)
 
 chat_handler = GeminiChatHandler()
-        
+
+# routes that answer while the server is still starting
+STARTUP_ROUTES = {"liveness", "readiness", "get_metrics"}
+# routes that send messages to the model, and count against the client's rate limit
+RATE_LIMITED_ROUTES = {"handle_user_request", "handle_user_request_stream"}
+
+
+@app.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+
+
+@app.before_request
+def wait_for_startup():
+    # the handler loads chats and builds the models in the background, so requests that need them wait until it's done
+    if request.endpoint not in STARTUP_ROUTES and not chat_handler.wait_until_ready():
+        return jsonify("Server is starting, try again shortly"), 503
+    # with several worker processes, pick up the chats other workers changed before handling the request
+    if request.endpoint not in STARTUP_ROUTES:
+        chat_handler.sync_workers()
+
+
+@app.before_request
+def check_rate_limit():
+    # limited clients are turned away before their message is read, so a burst from one client can't use up the model's quota
+    if request.endpoint in RATE_LIMITED_ROUTES:
+        retry_after = chat_handler.check_rate_limit(request.headers.get("X-Forwarded-For", ""), request.remote_addr)
+        if retry_after:
+            return jsonify("Too many messages, slow down"), 429, {"Retry-After": str(retry_after)}
+
+
+@app.after_request
+def record_request_time(response):
+    # streamed responses are timed until their first byte, since the body is sent after this runs
+    route = request.url_rule.rule if request.url_rule else "unmatched"
+    chat_handler.metrics.observe_request(route, request.method, response.status_code, time.perf_counter() - g.request_start)
+    return response
+
+
+@app.after_request
+def flush_for_workers(response):
+    # with several worker processes, save this request's changes before answering, so the next request sees them on any worker
+    chat_handler.flush_for_workers()
+    return response
+
+
+@app.after_request
+def add_retry_after(response):
+    # messages turned away for lack of a model slot get an estimate of when one will be free
+    if response.status_code == 429 and "Retry-After" not in response.headers:
+        response.headers["Retry-After"] = str(chat_handler.get_retry_after())
+    return response
+
+
+@app.after_request
+def compress_response(response):
+    # big JSON responses, like long chats, are compressed for clients that accept it. Server-sent events are left alone
+    if response.is_streamed or response.direct_passthrough or response.mimetype not in COMPRESSIBLE_TYPES or "Content-Encoding" in response.headers:
+        return response
+    response.vary.add("Accept-Encoding")
+    compressed = compress_body(response.get_data(), response.mimetype, request.headers.get("Accept-Encoding", ""))
+    if compressed:
+        response.set_data(compressed[0])
+        response.headers["Content-Encoding"] = compressed[1]
+    return response
+
 
 @app.route("/api/gemini/request", methods=['POST'])
 def handle_user_request():
     data = request.json
     user_input = data.get("prompt", "")
+    session_id = data.get("sessionId", "")
 
     if not user_input:
         return jsonify("Prompt is required"), 400
     
-    response, status_code = chat_handler.send_message(user_input)
+    if not session_id:
+        return jsonify("Session ID is required"), 400
+    
+    if not is_valid_session_id(session_id):
+        return jsonify("Invalid session ID"), 400
+    
+    response, status_code = chat_handler.send_message(session_id, user_input)
     return jsonify(response), status_code
 
 
+@app.route("/api/gemini/request_stream", methods=['POST'])
+def handle_user_request_stream():
+    """
+    Same as /api/gemini/request, but streams the model's response back as server-sent events while it's generated.
+    Each chunk of text is sent as a "data" event, followed by a "done" event once the response is complete,
+    or an "error" event if the model fails mid-stream.
+    """
+    data = request.json
+    user_input = data.get("prompt", "")
+    session_id = data.get("sessionId", "")
+
+    if not user_input:
+        return jsonify("Prompt is required"), 400
+    
+    if not session_id:
+        return jsonify("Session ID is required"), 400
+    
+    if not is_valid_session_id(session_id):
+        return jsonify("Invalid session ID"), 400
+    
+    response, status_code = chat_handler.stream_message(session_id, user_input)
+    if status_code != 200:
+        return jsonify(response), status_code
+    
+    def event_stream():
+        try:
+            for text in response:
+                yield f"data: {json.dumps(text, ensure_ascii=False)}\n\n"
+            yield "event: done\ndata: \"\"\n\n"
+            
+        except Exception as e:
+            yield f"event: error\ndata: {json.dumps(str(e))}\n\n"
+            
+        finally:
+            # closing the reply generator is what rolls back the chat when the client disconnects mid-stream
+            response.close()
+    
+    # disable caching and proxy buffering so every chunk is sent to the client as soon as it's yielded
+    headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    return Response(stream_with_context(event_stream()), mimetype="text/event-stream", headers=headers)
+
+
 @app.route("/api/gemini/new_chat", methods=['POST'])
 def start_new_chat():
-        response, status_code = chat_handler.start_new_chat()
+        data = request.get_json(silent=True) or {}
+        session_id = data.get("sessionId", "")
+        
+        if session_id and not is_valid_session_id(session_id):
+            return jsonify("Invalid session ID"), 400
+        
+        response, status_code = chat_handler.start_new_chat(session_id)
         print("New Session ID: ", response)
         return jsonify(response), status_code
 
 
-@app.route("/api/gemini/load_chat", methods=['POST'])
+@app.route("/api/gemini/load_chat", methods=['GET', 'POST'])
 def load_chat():
-    data = request.json
+    """
+    Returns the chat with the given "sessionId" and starts its model session, so the next message is answered sooner.
+    The arguments are in the body of a POST, or the query string of a GET.
+    Pass "limit" to get only the latest messages, and the "nextCursor" of the response as "cursor" to get the ones before them.
+    GET responses have an ETag, and respond with 304 if the If-None-Match header matches it.
+    """
+    data = request.args if request.method == "GET" else request.json
     session_id = data.get("sessionId", "")
+    limit = data.get("limit")
+    cursor = str(data.get("cursor", ""))
     
     if not session_id:
         return jsonify("Session ID is required"), 400
     
-    response, status_code = chat_handler.load_chat(session_id)
-    return jsonify(response), status_code
+    if not is_valid_session_id(session_id):
+        return jsonify("Invalid session ID"), 400
+    
+    if limit is not None and (not str(limit).isdigit() or int(limit) < 1):
+        return jsonify("Limit must be a positive number"), 400
+    limit = int(limit) if limit is not None else None
+    
+    if request.method == "GET":
+        etag = chat_handler.get_chat_etag(session_id, limit, cursor)
+        if etag and request.if_none_match.contains_weak(etag):
+            # the client already has this page, but it's about to use the chat, so its model session is still started
+            chat_handler.prime_chat(session_id)
+            response = make_response("", 304)
+            response.set_etag(etag, weak=True)
+            return response
+    
+    response, status_code = chat_handler.load_chat(session_id, limit, cursor)
+    response = make_response(jsonify(response), status_code)
+    if request.method == "GET" and status_code == 200:
+        # the tag is weak, since the same chat is sent compressed or not depending on the request
+        response.set_etag(etag, weak=True)
+        response.headers["Cache-Control"] = "private, no-cache"
+    return response
 
 
 
 @app.route("/api/gemini/current_session_id", methods=['GET'])
 def get_current_session_id():
-    session_id = chat_handler.get_current_session_id()
+    """
+    Deprecated. Returns a new session ID on every call, not the client's current one. Clients get the ID of their first
+    chat, and every chat after it, from new_chat.
+    """
+    session_id = chat_handler.create_session_id()
     return jsonify(session_id), 200
 
 
 @app.route("/api/gemini/all_chat_summaries", methods=['GET'])
 def get_all_chat_summaries():
-    all_chats = copy.deepcopy(chat_handler.get_all_chats()) # create a copy of handler's all_chats
-    chat_summaries = [{"sessionId": chat.sessionId, "summary": chat.summary, "timestamp": chat.timestamp} for chat in all_chats.chats.values()]
+    """
+    Returns the sessionId, summary and timestamp of chats, most recent first.
+    Pass "limit" to get a page of summaries, and the X-Next-Cursor header of the response as "cursor" to get the next page.
+    Responds with 304 if the If-None-Match header matches the current ETag.
+    """
+    limit = request.args.get("limit", type=int)
+    cursor = request.args.get("cursor", "")
+    
+    # the ETag is checked before building the page, so unchanged summaries cost nothing to serve
+    etag = chat_handler.get_chat_summaries_etag()
+    if request.if_none_match.contains_weak(etag):
+        response = make_response("", 304)
+        response.set_etag(etag, weak=True)
+        return response
+    
+    chat_summaries, next_cursor = chat_handler.get_chat_summaries(limit, cursor)
+    
+    response = make_response(jsonify(chat_summaries), 200)
+    # weak like load_chat's, since the summaries are sent compressed or not depending on the request
+    response.set_etag(etag, weak=True)
+    if next_cursor:
+        response.headers["X-Next-Cursor"] = next_cursor
+    return response
+
+@app.route("/api/gemini/search", methods=['GET'])
+def search_chats():
+    """
+    Searches the messages and summaries of every chat for the words in "q". Returns up to "limit" chats, best match
+    first, each with a snippet of its best matching message.
+    """
+    query = request.args.get("q", "")
+    limit = request.args.get("limit", 10, type=int)
     
-    return jsonify(chat_summaries), 200
+    response, status_code = chat_handler.search(query, limit)
+    return jsonify(response), status_code
+
+@app.route("/api/gemini/storage_stats", methods=['GET'])
+def get_storage_stats():
+    """Returns how far behind the background writer is in saving chats"""
+    return jsonify(chat_handler.get_storage_stats()), 200
+
+@app.route("/api/gemini/token_stats", methods=['GET'])
+def get_token_stats():
+    """Returns how many tokens were sent to the model, compared to sending every chat's full history"""
+    return jsonify(chat_handler.get_token_stats()), 200
+
+
+@app.route("/api/gemini/cache_stats", methods=['GET'])
+def get_cache_stats():
+    """Returns the hit and miss counts of the response and summary caches"""
+    return jsonify(chat_handler.get_cache_stats()), 200
+
+
+@app.route("/api/gemini/model_stats", methods=['GET'])
+def get_model_stats():
+    """Returns how often model calls were retried, hedged or timed out, and whether the circuit breaker is open"""
+    return jsonify(chat_handler.get_model_stats()), 200
+
+
+@app.route("/api/gemini/admission_stats", methods=['GET'])
+def get_admission_stats():
+    """Returns how many messages were rate limited, and how many model calls are in flight, queued or were turned away"""
+    return jsonify(chat_handler.get_admission_stats()), 200
+
+
+@app.route("/healthz", methods=['GET'])
+def liveness():
+    """Liveness probe. Answers as soon as the server is up, even while it's still starting"""
+    return jsonify("ok"), 200
+
+
+@app.route("/readyz", methods=['GET'])
+def readiness():
+    """Readiness probe. Responds with 503 until the chats are loaded and the models are built"""
+    response, status_code = chat_handler.get_readiness()
+    return jsonify(response), status_code
+
+
+@app.route("/metrics", methods=['GET'])
+def get_metrics():
+    """Returns the server's metrics in the Prometheus text format"""
+    return Response(chat_handler.get_metrics(), mimetype="text/plain; version=0.0.4")
+
 
 @app.route("/api/gemini/delete_chats", methods=['DELETE'])
 def delete_chats():
+    """
+    Deletes chats. The body has "sessionIds", and optionally "olderThan" (an ISO 8601 time) or "all": true to delete
+    chats in bulk. Returns the session IDs that were deleted and the ones that weren't found.
+    """
     data = request.json
-    session_ids = data.get("sessionIds", "")
+    session_ids = data.get("sessionIds", [])
+    older_than = data.get("olderThan", "")
+    delete_all = data.get("all", False) is True
+    
+    if not isinstance(session_ids, list):
+        return jsonify("sessionIds must be a list"), 400
     
-    if not session_ids:
+    if not isinstance(older_than, str):
+        return jsonify("olderThan must be an ISO 8601 time"), 400
+    
+    if not session_ids and not older_than and not delete_all:
         return jsonify("Session ID is required"), 400
     
-    response, status_code = chat_handler.delete_chats(session_ids)
+    if not all(is_valid_session_id(session_id) for session_id in session_ids):
+        return jsonify("Invalid session ID"), 400
+    
+    response, status_code = chat_handler.delete_chats(session_ids, older_than, delete_all)
     return jsonify(response), status_code
 
 # TODO: Is this needed? Or should this be called server-side?
 @app.route("/api/gemini/close", methods=['POST'])
 def close_app():
     """
-    Call this function when mobile app is closed. The server will figure out which chat sessions were updated,
-    generate new summaries, and then save all chats to a file. 
+    Call this function when mobile app is closed. The server will figure out which chat sessions were updated
+    and regenerate their summaries in the background.
     
-    Returns a list of sessions that were updated.
+    Returns a list of sessions that are getting new summaries.
     """
     print("closing handler")
     response, status_code = chat_handler.close_handler()
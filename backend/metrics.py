@@ -0,0 +1,90 @@
+from contextlib import contextmanager
+from typing import Dict, List, Tuple, Iterator
+from bisect import bisect_left
+import threading
+import time
+
+METRIC_PREFIX = "chatbot_"
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+class Histogram:
+    """Prometheus histogram of durations in seconds, with one series per set of label values"""
+    def __init__(self, name: str, help: str, label_names: Tuple[str, ...], buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.label_names = label_names
+        self.buckets = buckets
+        self.series: Dict[Tuple[str, ...], Dict] = {}
+        self.lock = threading.Lock()
+
+
+    def observe(self, seconds: float, *label_values: str):
+        with self.lock:
+            series = self.series.get(label_values)
+            if series is None:
+                series = self.series[label_values] = {"counts": [0] * len(self.buckets), "sum": 0.0, "count": 0}
+            index = bisect_left(self.buckets, seconds)
+            if index < len(self.buckets):
+                series["counts"][index] += 1
+            series["sum"] += seconds
+            series["count"] += 1
+
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            for label_values, series in sorted(self.series.items()):
+                labels = ",".join(f'{name}="{value}"' for name, value in zip(self.label_names, label_values))
+                prefix = labels + "," if labels else ""
+                cumulative = 0
+                for bucket, count in zip(self.buckets, series["counts"]):
+                    cumulative += count
+                    lines.append(f'{self.name}_bucket{{{prefix}le="{bucket}"}} {cumulative}')
+                lines.append(f'{self.name}_bucket{{{prefix}le="+Inf"}} {series["count"]}')
+                suffix = f"{{{labels}}}" if labels else ""
+                lines.append(f"{self.name}_sum{suffix} {series['sum']}")
+                lines.append(f"{self.name}_count{suffix} {series['count']}")
+        return lines
+
+
+class Metrics:
+    """
+    Timers for the stages of handling a request, and the /metrics page in the Prometheus text format.
+
+    Stage timings go to one histogram labelled by stage (model, validation, serialization, storage), so a slow request can
+    be split into time spent waiting on Gemini, on the chat store, or in our own code. Counters and gauges are read from
+    the components that already keep them when the page is rendered, instead of being tracked twice.
+    """
+    def __init__(self):
+        self.stages = Histogram(METRIC_PREFIX + "stage_seconds", "Time spent in each stage of handling requests.", ("stage", "operation"))
+        self.requests = Histogram(METRIC_PREFIX + "request_seconds", "Time to handle each route, until the response starts.", ("route", "method", "status"))
+
+
+    @contextmanager
+    def time(self, stage: str, operation: str = "") -> Iterator[None]:
+        """Times the body of a with statement as the given stage"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages.observe(time.perf_counter() - start, stage, operation)
+
+
+    def observe_request(self, route: str, method: str, status: int, seconds: float):
+        self.requests.observe(seconds, route, method, str(status))
+
+
+    def render(self, samples: List[Tuple[str, str, str, float]]) -> str:
+        """
+        Renders every metric in the Prometheus text format.
+
+        Args:
+            samples (List[Tuple[str, str, str, float]]): (name, type, help, value) of the counters and gauges to include.
+                Names get the chatbot_ prefix.
+        """
+        lines = self.stages.render() + self.requests.render()
+        for name, metric_type, help, value in samples:
+            name = METRIC_PREFIX + name
+            lines += [f"# HELP {name} {help}", f"# TYPE {name} {metric_type}", f"{name} {float(value)}"]
+        return "\n".join(lines) + "\n"
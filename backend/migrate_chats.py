@@ -0,0 +1,62 @@
+"""
+Rewrites every stored chat in a new format, or copies every chat from one store to another.
+
+Stores read chats in every format, so migrating isn't required. It shrinks chats saved before the compact formats were
+added, which otherwise stay in their old format until they next change. The legacy history.json file in GCS is
+migrated too, if there are no per-chat objects yet.
+
+Usage:
+    python migrate_chats.py --store gcs --format gzip
+    python migrate_chats.py --store local --format zstd --dry-run
+    python migrate_chats.py --store gcs --target sqlite
+"""
+import argparse
+import time
+from chat_codec import encode_chat, FORMATS
+from chat_handler import BUCKET_NAME, CHAT_HISTORY_PREFIX, SERVICE_ACCOUNT_KEY_FILE, CHAT_HISTORY_FILE, LOCAL_CHAT_DIR, SQLITE_CHAT_DB
+from chat_store import create_chat_store
+
+STORE_OPTIONS = {
+    "gcs": {"bucket_name": BUCKET_NAME, "prefix": CHAT_HISTORY_PREFIX, "service_account_key_path": SERVICE_ACCOUNT_KEY_FILE, "legacy_file_path": CHAT_HISTORY_FILE},
+    "local": {"directory": LOCAL_CHAT_DIR},
+    "sqlite": {"path": SQLITE_CHAT_DB},
+}
+
+
+def open_store(backend: str, format: str = "", migrate_legacy: bool = True):
+    options = dict(STORE_OPTIONS[backend])
+    if format and backend != "sqlite":
+        options["format"] = format
+    if backend == "gcs":
+        # loading migrates the legacy history.json on its own, which a dry run mustn't do
+        options["migrate_legacy"] = migrate_legacy
+    return create_chat_store(backend, **options)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--store", choices=STORE_OPTIONS, required=True, help="store to read chats from")
+    parser.add_argument("--target", choices=STORE_OPTIONS, help="store to write chats to. Defaults to --store")
+    parser.add_argument("--format", choices=FORMATS, default="gzip", help="format to write chats in. Ignored by sqlite")
+    parser.add_argument("--dry-run", action="store_true", help="only report the size of the chats in each format, without writing anything")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    chats = list(open_store(args.store, migrate_legacy=not args.dry_run).load_chats().values())
+    load_time = time.perf_counter() - start
+
+    json_bytes = sum(len(encode_chat(chat, "json")) for chat in chats)
+    new_bytes = sum(len(encode_chat(chat, args.format)) for chat in chats)
+    print(f"Loaded {len(chats)} chats from {args.store} in {load_time:.2f}s.")
+    print(f"Size as json: {json_bytes} bytes. Size as {args.format}: {new_bytes} bytes ({json_bytes / max(new_bytes, 1):.1f}x smaller).")
+
+    if args.dry_run:
+        return
+
+    target = open_store(args.target or args.store, args.format)
+    target.save_chats(chats)
+    print(f"Saved {len(chats)} chats to {args.target or args.store} as {args.format}.")
+
+
+if __name__ == "__main__":
+    main()
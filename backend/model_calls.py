@@ -0,0 +1,302 @@
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import Callable, Awaitable, TypeVar, Dict, Any, List
+import asyncio
+import itertools
+import random
+import threading
+import time
+
+T = TypeVar("T")
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling the model while the circuit breaker is open"""
+
+
+class ModelTimeoutError(Exception):
+    """Raised when the model doesn't respond before the deadline"""
+
+
+def is_retryable(error: Exception) -> bool:
+    """Checks if an error means the upstream was unavailable or overloaded, so the call is worth retrying"""
+    if isinstance(error, (ModelTimeoutError, TimeoutError, ConnectionError)):
+        return True
+
+    try:
+        from google.api_core import exceptions
+    except ImportError:
+        return False
+    return isinstance(error, (exceptions.TooManyRequests, exceptions.InternalServerError, exceptions.ServiceUnavailable, exceptions.GatewayTimeout))
+
+
+class CircuitBreaker:
+    """
+    Stops calls to an upstream that keeps failing.
+
+    After `failure_threshold` failures in a row the circuit opens, and calls are rejected right away instead of waiting on
+    the upstream. Once `reset_timeout` seconds have passed, a single call is let through to probe the upstream. If it
+    succeeds the circuit closes again, and if it fails the circuit stays open for another `reset_timeout`.
+    """
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    def __init__(self, failure_threshold: int, reset_timeout: float):
+        """
+        Args:
+            failure_threshold (int): Number of failures in a row that opens the circuit.
+            reset_timeout (float): Number of seconds the circuit stays open before a probe call is let through.
+        """
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.times_opened = 0
+        self.lock = threading.Lock()
+
+
+    def allow(self) -> bool:
+        """Checks if a call may go through. While half-open, only the probe call is allowed"""
+        with self.lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and time.monotonic() - self.opened_at >= self.reset_timeout:
+                self.state = self.HALF_OPEN
+                return True
+            return False
+
+
+    def is_closed(self) -> bool:
+        with self.lock:
+            return self.state == self.CLOSED
+
+
+    def record_success(self):
+        with self.lock:
+            self.state = self.CLOSED
+            self.failures = 0
+
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                if self.state != self.OPEN:
+                    self.times_opened += 1
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+
+
+    def stats(self) -> Dict[str, Any]:
+        with self.lock:
+            return {"state": self.state, "consecutiveFailures": self.failures, "timesOpened": self.times_opened}
+
+
+class ModelCaller:
+    """
+    Calls the model with a deadline on every attempt, jittered retries for retryable errors, a circuit breaker, and
+    hedging: if the first attempt hasn't answered after `hedge_delay` seconds, a second one is started and whichever
+    answers first is used.
+
+    Calls are given as attempt functions that take the attempt's number, starting at 0. Every retry and hedge gets a new
+    number, so callers can keep stateful objects (like a chat session) for attempt 0 and use fresh ones for the rest.
+    Attempts that time out can't be interrupted on the sync path, so they're left to finish on the worker pool and their results are dropped.
+    """
+    def __init__(self, breaker: CircuitBreaker, timeout: float, max_retries: int, backoff: float, hedge_delay: float, max_workers: int):
+        """
+        Args:
+            breaker (CircuitBreaker): Circuit breaker shared by every call to the same upstream.
+            timeout (float): Number of seconds each attempt (including its hedge) gets before it counts as timed out.
+            max_retries (int): Number of times a call is retried after a retryable error.
+            backoff (float): Base number of seconds to wait before a retry. Doubled on every retry, with full jitter.
+            hedge_delay (float): Number of seconds to wait for the first attempt before hedging it. 0 disables hedging.
+            max_workers (int): Number of threads running sync attempts.
+        """
+        self.breaker = breaker
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.hedge_delay = hedge_delay
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="model-call")
+        self.lock = threading.Lock()
+
+        # metrics
+        self.calls = 0
+        self.retries = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.timeouts = 0
+        self.rejected = 0
+        self.failures = 0
+
+
+    def call(self, attempt: Callable[[int], T], hedge: bool = True) -> T:
+        """
+        Calls the model on the calling thread's behalf, and waits for the result.
+
+        Args:
+            attempt (Callable): Function that takes the attempt number and makes one model call.
+            hedge (bool): Whether the first attempt may be hedged. Should be False for calls that can't be repeated.
+
+        Returns:
+            The result of the first attempt that succeeded.
+
+        Raises:
+            CircuitOpenError: The circuit breaker is open.
+            ModelTimeoutError: The last attempt timed out.
+            Exception: The error of the last attempt, if it failed.
+        """
+        numbers = itertools.count()
+        self.__count("calls")
+        for retry in range(self.max_retries + 1):
+            if retry:
+                self.__count("retries")
+                time.sleep(self.__backoff_delay(retry))
+            self.__check_breaker()
+
+            try:
+                result = self.__attempt(attempt, numbers, hedge and retry == 0)
+            except Exception as e:
+                if self.__handle_error(e, retry):
+                    continue
+                raise
+
+            self.breaker.record_success()
+            return result
+
+
+    async def call_async(self, attempt: Callable[[int], Awaitable[T]], hedge: bool = True) -> T:
+        """Same as call, but for attempt functions that return awaitables. Attempts that time out or lose to a hedge are cancelled"""
+        numbers = itertools.count()
+        self.__count("calls")
+        for retry in range(self.max_retries + 1):
+            if retry:
+                self.__count("retries")
+                await asyncio.sleep(self.__backoff_delay(retry))
+            self.__check_breaker()
+
+            try:
+                result = await self.__attempt_async(attempt, numbers, hedge and retry == 0)
+            except Exception as e:
+                if self.__handle_error(e, retry):
+                    continue
+                raise
+
+            self.breaker.record_success()
+            return result
+
+
+    def stats(self) -> Dict[str, Any]:
+        with self.lock:
+            stats = {
+                "calls": self.calls,
+                "retries": self.retries,
+                "hedges": self.hedges,
+                "hedgeWins": self.hedge_wins,
+                "timeouts": self.timeouts,
+                "rejected": self.rejected,
+                "failures": self.failures,
+            }
+        stats["circuit"] = self.breaker.stats()
+        return stats
+
+
+    def __attempt(self, attempt: Callable[[int], T], numbers, hedge: bool) -> T:
+        """Runs one attempt on the worker pool, hedging it if it's slow. Raises the attempt's error or ModelTimeoutError"""
+        deadline = time.monotonic() + self.timeout
+        futures = [self.executor.submit(attempt, next(numbers))]
+
+        if hedge and 0 < self.hedge_delay < self.timeout:
+            done, _ = wait(futures, timeout=self.hedge_delay)
+            # don't add load to an upstream that's already struggling
+            if not done and self.breaker.is_closed():
+                self.__count("hedges")
+                futures.append(self.executor.submit(attempt, next(numbers)))
+
+        pending = set(futures)
+        errors: List[Exception] = []
+        while pending:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            done, pending = wait(pending, timeout=remaining, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    if future is not futures[0]:
+                        self.__count("hedge_wins")
+                    return future.result()
+                errors.append(future.exception())
+
+        if errors and not pending:
+            raise errors[0]
+        raise ModelTimeoutError(f"The model didn't respond within {self.timeout} seconds")
+
+
+    async def __attempt_async(self, attempt: Callable[[int], Awaitable[T]], numbers, hedge: bool) -> T:
+        """Async version of __attempt"""
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.timeout
+        tasks = [asyncio.ensure_future(attempt(next(numbers)))]
+
+        try:
+            if hedge and 0 < self.hedge_delay < self.timeout:
+                done, _ = await asyncio.wait(tasks, timeout=self.hedge_delay)
+                if not done and self.breaker.is_closed():
+                    self.__count("hedges")
+                    tasks.append(asyncio.ensure_future(attempt(next(numbers))))
+
+            pending = set(tasks)
+            errors: List[BaseException] = []
+            while pending:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                done, pending = await asyncio.wait(pending, timeout=remaining, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is not tasks[0]:
+                            self.__count("hedge_wins")
+                        return task.result()
+                    errors.append(task.exception())
+
+            if errors and not pending:
+                raise errors[0]
+            raise ModelTimeoutError(f"The model didn't respond within {self.timeout} seconds")
+
+        finally:
+            for task in tasks:
+                task.cancel()
+
+
+    def __check_breaker(self):
+        if not self.breaker.allow():
+            self.__count("rejected")
+            raise CircuitOpenError("The model is unavailable right now. Try again shortly.")
+
+
+    def __handle_error(self, error: Exception, retry: int) -> bool:
+        """Records a failed attempt. Returns True if the call should be retried"""
+        if isinstance(error, ModelTimeoutError):
+            self.__count("timeouts")
+
+        if not is_retryable(error):
+            # the upstream answered, it just didn't like the request
+            self.breaker.record_success()
+            self.__count("failures")
+            return False
+
+        self.breaker.record_failure()
+        if retry == self.max_retries:
+            self.__count("failures")
+            return False
+        return True
+
+
+    def __backoff_delay(self, retry: int) -> float:
+        return random.uniform(0, self.backoff * 2 ** (retry - 1))
+
+
+    def __count(self, metric: str):
+        with self.lock:
+            setattr(self, metric, getattr(self, metric) + 1)
@@ -0,0 +1,112 @@
+from typing import Callable, Dict, Any
+import threading
+import time
+
+
+class WriteBehindQueue:
+    """
+    Background writer that saves changed chats outside of the request that changed them.
+
+    Requests call notify() after changing a chat, which only wakes the writer thread. The writer waits for the flush interval
+    so a burst of changes goes out in a single flush, then calls the flush function. Failed flushes are retried on the next
+    interval, and close() does a final flush so nothing is lost on shutdown.
+    """
+    def __init__(self, flush: Callable[[], bool], interval: float):
+        """
+        Args:
+            flush (Callable): Function that saves every pending change. Returns True if the save succeeded.
+            interval (float): Number of seconds to wait after a change before flushing.
+        """
+        self.flush_func = flush
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.stopped = threading.Event()
+
+        # metrics
+        self.pending_since = None # monotonic time of the oldest change that hasn't been flushed yet
+        self.notifications = 0
+        self.flushes = 0
+        self.failed_flushes = 0
+        self.last_flush_lag = 0.0
+        self.max_flush_lag = 0.0
+        self.last_flush_duration = 0.0
+
+        self.thread = threading.Thread(target=self.__run, name="write-behind", daemon=True)
+        self.thread.start()
+
+
+    def notify(self):
+        """Tells the writer there are changes to save. Returns immediately"""
+        with self.lock:
+            self.notifications += 1
+            if self.pending_since is None:
+                self.pending_since = time.monotonic()
+        self.wakeup.set()
+
+
+    def flush(self) -> bool:
+        """Saves every pending change right away, on the calling thread. Returns True if the save succeeded"""
+        with self.lock:
+            pending_since, self.pending_since = self.pending_since, None
+
+        start = time.monotonic()
+        try:
+            succeeded = self.flush_func()
+        except Exception as e:
+            print("Error flushing chats: ", e)
+            succeeded = False
+        end = time.monotonic()
+
+        with self.lock:
+            self.last_flush_duration = end - start
+            if succeeded:
+                self.flushes += 1
+                if pending_since is not None:
+                    self.last_flush_lag = end - pending_since
+                    self.max_flush_lag = max(self.max_flush_lag, self.last_flush_lag)
+            else:
+                # the changes are still pending, so keep counting their lag from when they were first made
+                self.failed_flushes += 1
+                if pending_since is not None:
+                    self.pending_since = min(pending_since, self.pending_since or pending_since)
+
+        return succeeded
+
+
+    def close(self):
+        """Stops the writer thread and flushes anything that's still pending"""
+        self.stopped.set()
+        self.wakeup.set()
+        self.thread.join()
+        self.flush()
+
+
+    def stats(self) -> Dict[str, Any]:
+        """Returns the writer's metrics. Lag is the time from a change being made to it being saved, in seconds"""
+        with self.lock:
+            return {
+                "pending": self.pending_since is not None,
+                "oldestPendingAge": time.monotonic() - self.pending_since if self.pending_since is not None else 0.0,
+                "notifications": self.notifications,
+                "flushes": self.flushes,
+                "failedFlushes": self.failed_flushes,
+                "lastFlushLag": self.last_flush_lag,
+                "maxFlushLag": self.max_flush_lag,
+                "lastFlushDuration": self.last_flush_duration,
+            }
+
+
+    def __run(self):
+        """Writer thread loop"""
+        while not self.stopped.is_set():
+            self.wakeup.wait()
+
+            # wait for more changes to pile up, unless we're shutting down
+            if self.stopped.wait(self.interval):
+                break
+
+            # clear before flushing, so changes made during the flush wake the writer up again
+            self.wakeup.clear()
+            if not self.flush():
+                self.wakeup.set()
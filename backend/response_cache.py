@@ -0,0 +1,102 @@
+from collections import OrderedDict
+from typing import Dict, Any, List, Optional
+import hashlib
+import random
+import re
+import threading
+import time
+
+
+def normalize_prompt(prompt: str) -> str:
+    """Normalizes a prompt so that prompts differing only in case, spacing or trailing punctuation share a cache entry"""
+    return re.sub(r"\s+", " ", prompt).strip().strip(".!?,;:").strip().lower()
+
+
+def context_key(*parts: Any) -> str:
+    """Hashes everything besides the prompt that affects the model's response, e.g. model name, system instruction and generation config"""
+    return hashlib.sha256("\0".join(repr(part) for part in parts).encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """
+    LRU cache of model responses with a time to live.
+
+    Each entry can hold several responses to the same prompt. Until an entry has collected the configured number of
+    variants every lookup is a miss, so the caller asks the model and adds its response. Once it's full, lookups return
+    a random pick from the variants, so users sending the same prompt to a high temperature model still get different answers.
+    """
+    def __init__(self, context: str, max_entries: int, ttl_seconds: float, variants: int = 1):
+        """
+        Args:
+            context (str): Hash of the model setup the responses came from. See context_key.
+            max_entries (int): Maximum number of cached prompts. The least recently used prompt is dropped first.
+            ttl_seconds (float): Number of seconds an entry is kept after its first response was added.
+            variants (int): Number of responses collected for a prompt before it's served from the cache.
+        """
+        self.context = context
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.variants = variants
+        self.entries: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self.lock = threading.Lock()
+
+        # metrics
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+
+    def get(self, key: str) -> Optional[str]:
+        """Gets a cached response for the given key, or None if the model should be asked"""
+        cache_key = self.__hash(key)
+        with self.lock:
+            entry = self.entries.get(cache_key)
+            if entry and time.monotonic() - entry["created"] > self.ttl_seconds:
+                del self.entries[cache_key]
+                self.evictions += 1
+                entry = None
+
+            if not entry or len(entry["responses"]) < self.variants:
+                self.misses += 1
+                return None
+
+            self.entries.move_to_end(cache_key)
+            self.hits += 1
+            return random.choice(entry["responses"])
+
+
+    def put(self, key: str, response: str):
+        """Adds a model response for the given key, unless the key already has every variant it needs"""
+        if not response:
+            return
+
+        cache_key = self.__hash(key)
+        with self.lock:
+            entry = self.entries.get(cache_key)
+            if not entry:
+                entry = self.entries[cache_key] = {"created": time.monotonic(), "responses": []}
+            responses: List[str] = entry["responses"]
+            if len(responses) < self.variants:
+                responses.append(response)
+            self.entries.move_to_end(cache_key)
+
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+
+    def stats(self) -> Dict[str, Any]:
+        """Returns the cache's hit and miss counts"""
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self.entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hitRate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+            }
+
+
+    def __hash(self, key: str) -> str:
+        return hashlib.sha256(f"{self.context}\0{key}".encode("utf-8")).hexdigest()
@@ -0,0 +1,75 @@
+from functools import lru_cache
+from typing import Optional, Tuple
+import gzip
+
+# Responses are compressed when the client accepts it and they're big enough for it to pay off. Brotli is preferred when
+# the brotli package is installed, since it makes smaller JSON than gzip at a similar speed. Server-sent events aren't in
+# COMPRESSIBLE_TYPES, since compressing a stream would hold its chunks back until enough of them were buffered.
+COMPRESSION_MIN_BYTES = 1024
+COMPRESSIBLE_TYPES = ("application/json", "text/plain")
+GZIP_LEVEL = 5
+BROTLI_QUALITY = 5
+
+
+@lru_cache(maxsize=None)
+def _import_brotli():
+    """Returns the brotli module, or None if it isn't installed. Brotli is optional, so gzip is used without it"""
+    try:
+        import brotli
+    except ImportError:
+        return None
+    return brotli
+
+
+def choose_encoding(accept_encoding: str) -> Optional[str]:
+    """
+    Picks the encoding to compress a response with from the request's Accept-Encoding header.
+
+    Returns:
+        (str) "br" or "gzip", or None if the client accepts neither
+    """
+    accepted = {}
+    for item in (accept_encoding or "").split(","):
+        name, _, params = item.strip().partition(";")
+        quality = 1.0
+        for param in params.split(";"):
+            key, _, value = param.strip().partition("=")
+            if key == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        if name:
+            accepted[name.strip().lower()] = quality
+
+    def allows(encoding: str) -> bool:
+        return accepted.get(encoding, accepted.get("*", 0.0)) > 0
+
+    if allows("br") and _import_brotli():
+        return "br"
+    if allows("gzip"):
+        return "gzip"
+    return None
+
+
+def compress_body(data: bytes, mimetype: str, accept_encoding: str) -> Optional[Tuple[bytes, str]]:
+    """
+    Compresses a response body, if its type is worth compressing, it's big enough, and the client accepts an encoding.
+
+    Args:
+        data (bytes): The response body.
+        mimetype (str): The response's mimetype, without parameters.
+        accept_encoding (str): The request's Accept-Encoding header.
+
+    Returns:
+        (Tuple[bytes, str]) compressed body and its Content-Encoding, or None to send the body as it is
+    """
+    if mimetype not in COMPRESSIBLE_TYPES or len(data) < COMPRESSION_MIN_BYTES:
+        return None
+
+    encoding = choose_encoding(accept_encoding)
+    if encoding == "br":
+        return _import_brotli().compress(data, quality=BROTLI_QUALITY), encoding
+    if encoding == "gzip":
+        return gzip.compress(data, compresslevel=GZIP_LEVEL, mtime=0), encoding
+    return None
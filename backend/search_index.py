@@ -0,0 +1,188 @@
+from collections import Counter
+from typing import List, Dict, Optional, Tuple
+import gzip
+import json
+import math
+import re
+import threading
+
+TOKEN_PATTERN = re.compile(r"\w+")
+BM25_K1 = 1.2
+BM25_B = 0.75
+SNIPPET_CHARS = 160
+INDEX_FORMAT_VERSION = 1
+
+
+def tokenize(text: str) -> List[str]:
+    """Splits text into lowercase words"""
+    return TOKEN_PATTERN.findall(text.lower())
+
+
+def make_snippet(text: str, terms: List[str], length: int = SNIPPET_CHARS) -> str:
+    """Cuts the part of the text around the first of the given terms, or its start if none of them appear"""
+    lowered = text.lower()
+    matches = [re.search(rf"\b{re.escape(term)}\b", lowered) for term in terms]
+    hits = [match.start() for match in matches if match]
+    start = max(0, min(hits) - length // 4) if hits else 0
+    end = min(len(text), start + length)
+    snippet = text[start:end].strip()
+    return ("…" if start > 0 else "") + snippet + ("…" if end < len(text) else "")
+
+
+class SearchIndex:
+    """
+    Inverted index over the messages and summary of every chat, ranked with BM25.
+
+    Chats are indexed incrementally: messages appended since the chat was last indexed are added to its term counts, and
+    the chat is only re-indexed from scratch if its history was changed in some other way. Each chat keeps its own term
+    counts too, so it can be removed from the postings without reading its history. The index can be dumped and loaded,
+    so it survives restarts without reading every history again.
+    """
+    def __init__(self):
+        self.postings: Dict[str, Dict[str, int]] = {} # term -> session ID -> number of occurrences
+        self.docs: Dict[str, Dict] = {} # session ID -> terms, length, indexed messages, summary and timestamp of the chat
+        self.total_length = 0
+        self.version = 0
+        self.lock = threading.Lock()
+
+
+    def update(self, chat):
+        """Indexes the messages added to a chat since it was last indexed, and its summary if it changed"""
+        if not chat.is_history_loaded():
+            return
+        history = chat.history
+
+        with self.lock:
+            doc = self.docs.get(chat.sessionId)
+            if doc and self.__is_appended(doc, history):
+                if len(history) == doc["messages"] and chat.summary == doc["summary"]:
+                    doc["timestamp"] = chat.timestamp
+                    return
+                added = Counter(term for message in history[doc["messages"]:] for part in message.parts for term in tokenize(part))
+                if chat.summary != doc["summary"]:
+                    added.update(tokenize(chat.summary))
+                    added.subtract(tokenize(doc["summary"]))
+                self.__add_terms(chat.sessionId, doc, added)
+            else:
+                if doc:
+                    self.__remove(chat.sessionId)
+                doc = {"terms": {}, "length": 0}
+                self.docs[chat.sessionId] = doc
+                terms = Counter(term for message in history for part in message.parts for term in tokenize(part))
+                terms.update(tokenize(chat.summary))
+                self.__add_terms(chat.sessionId, doc, terms)
+
+            doc.update(messages=len(history), last=history[-1] if history else None, summary=chat.summary, timestamp=chat.timestamp)
+            self.version += 1
+
+
+    def remove(self, session_id: str):
+        """Removes a chat from the index, if it's in it"""
+        with self.lock:
+            if session_id in self.docs:
+                self.__remove(session_id)
+                self.version += 1
+
+
+    def stale(self, chats) -> List[str]:
+        """
+        Drops the chats that no longer exist from the index, and returns the session IDs of the given chats that changed
+        since they were indexed, e.g. by another instance. Those need to be indexed again with their history.
+        """
+        timestamps = {chat.sessionId: chat.timestamp for chat in chats}
+        with self.lock:
+            for session_id in [session_id for session_id in self.docs if session_id not in timestamps]:
+                self.__remove(session_id)
+                self.version += 1
+            return [session_id for session_id, timestamp in timestamps.items()
+                    if session_id not in self.docs or self.docs[session_id]["timestamp"] != timestamp]
+
+
+    def search(self, query: str, limit: int) -> List[Tuple[str, float]]:
+        """
+        Finds the chats that best match the query.
+
+        Returns:
+            List[Tuple[str, float]]: (session ID, score) of up to limit chats, best match first.
+        """
+        terms = set(tokenize(query))
+        scores: Dict[str, float] = {}
+        with self.lock:
+            num_docs = len(self.docs)
+            average_length = self.total_length / num_docs if num_docs else 0
+            for term in terms:
+                postings = self.postings.get(term)
+                if not postings:
+                    continue
+                idf = math.log(1 + (num_docs - len(postings) + 0.5) / (len(postings) + 0.5))
+                for session_id, count in postings.items():
+                    length_norm = 1 - BM25_B + BM25_B * self.docs[session_id]["length"] / average_length
+                    scores[session_id] = scores.get(session_id, 0.0) + idf * count * (BM25_K1 + 1) / (count + BM25_K1 * length_norm)
+
+        return sorted(scores.items(), key=lambda item: item[1], reverse=True)[:limit]
+
+
+    def dump(self) -> bytes:
+        """Serializes the index. The postings aren't included, since load rebuilds them from each chat's terms"""
+        with self.lock:
+            docs = {session_id: {key: value for key, value in doc.items() if key != "last"} for session_id, doc in self.docs.items()}
+            data = json.dumps({"version": INDEX_FORMAT_VERSION, "docs": docs}, separators=(",", ":"))
+        return gzip.compress(data.encode("utf-8"), compresslevel=3, mtime=0)
+
+
+    def load(self, data: Optional[bytes]) -> bool:
+        """Replaces the index with a dumped one. Returns False if there's nothing to load or it's in an older format"""
+        if not data:
+            return False
+        fields = json.loads(gzip.decompress(data))
+        if fields.get("version") != INDEX_FORMAT_VERSION:
+            return False
+
+        with self.lock:
+            self.docs, self.postings, self.total_length = fields["docs"], {}, 0
+            for session_id, doc in self.docs.items():
+                # the last message isn't stored, so the next update trusts that the indexed messages are still the first ones
+                doc["last"] = None
+                self.total_length += doc["length"]
+                for term, count in doc["terms"].items():
+                    self.postings.setdefault(term, {})[session_id] = count
+            self.version += 1
+        return True
+
+
+    def __is_appended(self, doc: Dict, history: List) -> bool:
+        """Checks if the history still starts with the messages that were indexed. Must hold self.lock"""
+        indexed = doc["messages"]
+        if len(history) < indexed:
+            return False
+        return indexed == 0 or doc["last"] is None or history[indexed - 1] == doc["last"]
+
+
+    def __add_terms(self, session_id: str, doc: Dict, terms: Counter):
+        """Adds term counts to a chat and the postings. Negative counts remove terms. Must hold self.lock"""
+        for term, count in terms.items():
+            if not count:
+                continue
+            total = doc["terms"].get(term, 0) + count
+            doc["length"] += count
+            self.total_length += count
+            if total > 0:
+                doc["terms"][term] = total
+                self.postings.setdefault(term, {})[session_id] = total
+            else:
+                doc["terms"].pop(term, None)
+                postings = self.postings.get(term, {})
+                postings.pop(session_id, None)
+                if not postings:
+                    self.postings.pop(term, None)
+
+
+    def __remove(self, session_id: str):
+        """Removes a chat from the postings. Must hold self.lock"""
+        doc = self.docs.pop(session_id)
+        self.total_length -= doc["length"]
+        for term in doc["terms"]:
+            postings = self.postings.get(term, {})
+            postings.pop(session_id, None)
+            if not postings:
+                self.postings.pop(term, None)
@@ -0,0 +1,125 @@
+from collections import OrderedDict
+from typing import Callable, List, Dict, Any
+import asyncio
+import threading
+import time
+
+
+class LiveSession:
+    """A model chat session that is currently held in memory, along with its bookkeeping"""
+    def __init__(self, chat_session, history_bytes: int):
+        self.chat_session = chat_session
+        self.history_bytes = history_bytes
+        self.last_used = time.monotonic()
+        self.lock = threading.Lock()
+        self.async_lock = asyncio.Lock() # used instead of lock when serving from an event loop
+
+
+class SessionPool:
+    """
+    Registry of live model chat sessions keyed by session ID.
+
+    Sessions are created lazily from a chat's stored history on a miss, and evicted in least recently used order
+    when they sit idle for longer than the TTL, or when the pool goes over its session count or history size cap.
+    """
+    def __init__(self, start_session: Callable[[List[Dict[str, Any]]], Any], max_sessions: int, ttl_seconds: float, max_history_bytes: int, build_history: Callable[[Any], List[Dict[str, Any]]] = None):
+        """
+        Args:
+            start_session (Callable): Function that takes a chat history and returns a new model chat session.
+            max_sessions (int): Maximum number of live sessions kept in memory.
+            ttl_seconds (float): Number of seconds a session can sit idle before it is evicted.
+            max_history_bytes (int): Approximate cap on the total size of the history held by live sessions.
+            build_history (Callable): Function that takes a chat and returns the history to start its session with. Defaults to the chat's full history.
+        """
+        self.start_session = start_session
+        self.build_history = build_history or (lambda chat: chat.get_history())
+        self.max_sessions = max_sessions
+        self.ttl_seconds = ttl_seconds
+        self.max_history_bytes = max_history_bytes
+        self.sessions: "OrderedDict[str, LiveSession]" = OrderedDict()
+        self.history_bytes = 0
+        self.lock = threading.Lock()
+
+
+    def get(self, chat) -> LiveSession:
+        """
+        Gets the live session for the given chat, starting one from the chat's history if it isn't in the pool.
+
+        Args:
+            chat (Chat): The chat to get the live session for.
+        """
+        with self.lock:
+            live = self.sessions.get(chat.sessionId)
+            if live:
+                live.last_used = time.monotonic()
+                self.sessions.move_to_end(chat.sessionId)
+                return live
+
+        # start the session outside the lock so a slow start doesn't block every other session
+        history = self.build_history(chat)
+        live = LiveSession(self.start_session(history), self.__history_size(history))
+
+        with self.lock:
+            # another request may have started the same session while we weren't holding the lock
+            existing = self.sessions.get(chat.sessionId)
+            if existing:
+                existing.last_used = time.monotonic()
+                self.sessions.move_to_end(chat.sessionId)
+                return existing
+
+            self.sessions[chat.sessionId] = live
+            self.history_bytes += live.history_bytes
+            self.__evict_expired()
+
+        return live
+
+
+    def track_message(self, session_id: str, text: str):
+        """Adds the size of a message sent or received by a live session to the pool's history size"""
+        with self.lock:
+            live = self.sessions.get(session_id)
+            if live:
+                size = len(text.encode("utf-8"))
+                live.history_bytes += size
+                self.history_bytes += size
+                self.__evict_expired()
+
+
+    def evict(self, session_id: str):
+        """Removes the live session for the given session ID, if there is one"""
+        with self.lock:
+            live = self.sessions.pop(session_id, None)
+            if live:
+                self.history_bytes -= live.history_bytes
+
+
+    def __len__(self) -> int:
+        return len(self.sessions)
+
+
+    def __contains__(self, session_id: str) -> bool:
+        return session_id in self.sessions
+
+
+    def __evict_expired(self):
+        """Evicts idle sessions, then evicts least recently used sessions until the pool is under its caps. Must hold self.lock"""
+        now = time.monotonic()
+
+        # sessions are kept in least recently used order, so stop at the first one that hasn't expired
+        while self.sessions:
+            session_id, live = next(iter(self.sessions.items()))
+            if now - live.last_used < self.ttl_seconds:
+                break
+            self.sessions.popitem(last=False)
+            self.history_bytes -= live.history_bytes
+
+        # always keep the most recently used session, even if it's over the history cap by itself
+        while len(self.sessions) > 1 and (len(self.sessions) > self.max_sessions or self.history_bytes > self.max_history_bytes):
+            _, live = self.sessions.popitem(last=False)
+            self.history_bytes -= live.history_bytes
+
+
+    @staticmethod
+    def __history_size(history: List[Dict[str, Any]]) -> int:
+        """Approximate size of a chat history in bytes"""
+        return sum(len(part.encode("utf-8")) for message in history for part in message["parts"])
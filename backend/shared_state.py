@@ -0,0 +1,95 @@
+from typing import Dict, List, Optional, Tuple
+import os
+import sqlite3
+import threading
+
+JOURNAL_RETENTION = 10000 # journal entries kept for workers that fall behind
+
+
+class SharedJournal:
+    """
+    Journal of chat changes shared by the worker processes of one server, in a SQLite database in WAL mode.
+
+    Every worker keeps its own chats in memory. After a worker saves chats to the chat store, it records their session
+    IDs here, and the other workers poll the journal before serving a request and reload those chats from the store.
+    A request can land on any worker, so this keeps each worker's copy of a chat as fresh as the store.
+    """
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS changes (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            worker TEXT NOT NULL,
+            session_id TEXT NOT NULL,
+            generation INTEGER NOT NULL,
+            deleted INTEGER NOT NULL
+        );
+    """
+
+    def __init__(self, path: str, worker: Optional[str] = None):
+        """
+        Args:
+            path (str): Path to the journal database. Every worker of the server must use the same one.
+            worker (str): Name of this worker. Defaults to the process ID.
+        """
+        self.path = path
+        self.worker = worker or str(os.getpid())
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False, timeout=10, isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.executescript(self.SCHEMA)
+        # only changes made after this worker started matter, since it loads the chats from the store itself
+        self.cursor = self.connection.execute("SELECT COALESCE(MAX(seq), 0) FROM changes").fetchone()[0]
+        self.published = 0
+        self.received = 0
+
+
+    def publish(self, saved: Dict[str, int], deleted: List[str]):
+        """
+        Records chats this worker saved or deleted.
+
+        Args:
+            saved (Dict[str, int]): Generation of each saved chat in the store, keyed by session ID. 0 if the store doesn't track generations.
+            deleted (List[str]): Session IDs of the deleted chats.
+        """
+        rows = [(self.worker, session_id, generation, 0) for session_id, generation in saved.items()]
+        rows += [(self.worker, session_id, 0, 1) for session_id in deleted]
+        if not rows:
+            return
+
+        with self.lock:
+            self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                self.connection.executemany("INSERT INTO changes (worker, session_id, generation, deleted) VALUES (?, ?, ?, ?)", rows)
+                self.connection.execute("DELETE FROM changes WHERE seq <= (SELECT MAX(seq) FROM changes) - ?", (JOURNAL_RETENTION,))
+                self.connection.execute("COMMIT")
+            except Exception:
+                self.connection.execute("ROLLBACK")
+                raise
+            self.published += len(rows)
+
+
+    def poll(self) -> Tuple[Dict[str, int], List[str]]:
+        """
+        Gets the changes other workers made since the last poll. A chat that changed several times is only listed once.
+
+        Returns:
+            - (Dict[str, int]) generation of each chat saved by another worker, keyed by session ID
+            - (List[str]) session IDs of the chats deleted by another worker
+        """
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT seq, worker, session_id, generation, deleted FROM changes WHERE seq > ? ORDER BY seq", (self.cursor,)
+            ).fetchall()
+            if rows:
+                self.cursor = rows[-1][0]
+
+        # later changes to the same chat override earlier ones, and chats this worker changed last are already up to date
+        latest = {session_id: (worker, generation, deleted) for _, worker, session_id, generation, deleted in rows}
+        latest = {session_id: change for session_id, change in latest.items() if change[0] != self.worker}
+        self.received += len(latest)
+        saved = {session_id: generation for session_id, (_, generation, deleted) in latest.items() if not deleted}
+        return saved, [session_id for session_id, (_, _, deleted) in latest.items() if deleted]
+
+
+    def stats(self) -> Dict[str, int]:
+        with self.lock:
+            return {"cursor": self.cursor, "published": self.published, "received": self.received}
@@ -0,0 +1,90 @@
+from bisect import bisect_left, insort
+from typing import List, Dict, Optional, Tuple
+import threading
+import uuid
+
+
+class SummaryIndex:
+    """
+    Index of the sessionId, summary and timestamp of every chat, kept sorted by timestamp.
+
+    It's updated whenever a chat is added, changed or deleted, so listing summaries never touches message histories.
+    Every update bumps a version number, which is used as the ETag of the summary listing.
+    """
+    def __init__(self):
+        self.entries: Dict[str, Dict[str, str]] = {}
+        self.keys: List[Tuple[str, str]] = [] # (timestamp, sessionId), oldest first
+        self.version = 0
+        self.instance = uuid.uuid4().hex[:8] # keeps ETags from different processes or restarts apart
+        self.lock = threading.Lock()
+
+
+    def update(self, chat):
+        """Adds or updates the entry for the given chat"""
+        entry = {"sessionId": chat.sessionId, "summary": chat.summary, "timestamp": chat.timestamp}
+        with self.lock:
+            old = self.entries.get(chat.sessionId)
+            if old == entry:
+                return
+            if old:
+                self.__remove_key(old)
+            self.entries[chat.sessionId] = entry
+            insort(self.keys, (entry["timestamp"], entry["sessionId"]))
+            self.version += 1
+
+
+    def remove(self, session_id: str):
+        """Removes the entry for the given session ID, if there is one"""
+        with self.lock:
+            old = self.entries.pop(session_id, None)
+            if old:
+                self.__remove_key(old)
+                self.version += 1
+
+
+    def rebuild(self, chats):
+        """Replaces every entry with the given chats"""
+        with self.lock:
+            self.entries = {chat.sessionId: {"sessionId": chat.sessionId, "summary": chat.summary, "timestamp": chat.timestamp} for chat in chats}
+            self.keys = sorted((entry["timestamp"], entry["sessionId"]) for entry in self.entries.values())
+            self.version += 1
+
+
+    def page(self, limit: Optional[int] = None, cursor: str = "") -> Tuple[List[Dict[str, str]], str]:
+        """
+        Gets summaries, most recent first.
+
+        Args:
+            limit (int): Maximum number of summaries to return. Returns every summary if None.
+            cursor (str): Cursor returned with the previous page. Starts from the most recent summary if empty.
+
+        Returns:
+            - (List[Dict[str, str]]) summaries
+            - (str) cursor for the next page, or an empty string if this is the last page
+        """
+        with self.lock:
+            end = len(self.keys)
+            if cursor:
+                timestamp, _, session_id = cursor.partition("|")
+                end = bisect_left(self.keys, (timestamp, session_id))
+
+            start = 0 if limit is None else max(0, end - limit)
+            keys = self.keys[start:end]
+            summaries = [dict(self.entries[session_id]) for _, session_id in reversed(keys)]
+
+        next_cursor = f"{keys[0][0]}|{keys[0][1]}" if start > 0 and keys else ""
+        return summaries, next_cursor
+
+
+    def etag(self) -> str:
+        """ETag that changes whenever any summary changes"""
+        with self.lock:
+            return f"{self.instance}-{self.version}"
+
+
+    def __remove_key(self, entry: Dict[str, str]):
+        """Removes the sort key of an entry. Must hold self.lock"""
+        key = (entry["timestamp"], entry["sessionId"])
+        index = bisect_left(self.keys, key)
+        if index < len(self.keys) and self.keys[index] == key:
+            self.keys.pop(index)
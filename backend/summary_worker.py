@@ -0,0 +1,149 @@
+from typing import Callable, List, Dict, Any, Optional
+from chat_schema import hash_history
+import queue
+import threading
+
+
+class SummaryWorker:
+    """
+    Background job queue that generates chat summaries outside of the request that asked for them.
+
+    Jobs are keyed by session ID, so submitting a chat that is already waiting to be summarized does nothing. Each job
+    summarizes a snapshot of the chat's history. If the chat changes while the summary is generated, the summary is
+    still saved, but the chat stays stale and gets picked up again by the next stale summary pass.
+
+    A worker takes up to `batch_size` queued chats at a time. Chats whose history hashes to the same value as when their
+    summary was generated keep their summary without a model call, and short histories share one model request through
+    `summarize_batch`, so a stale summary pass over many chats doesn't cost a round trip per chat.
+    """
+    def __init__(self, get_chat: Callable[[str], Optional[Any]], summarize: Callable[[List[Dict[str, Any]]], str], on_summary: Callable[[Any], None], num_workers: int = 1,
+                 summarize_batch: Optional[Callable[[List[List[Dict[str, Any]]]], List[str]]] = None, batch_size: int = 1, max_batch_chars: int = 0):
+        """
+        Args:
+            get_chat (Callable): Function that returns the chat with the given session ID, or None if it was deleted.
+            summarize (Callable): Function that generates a summary from a chat history.
+            on_summary (Callable): Function called with the chat after its summary is set.
+            num_workers (int): Number of threads generating summaries.
+            summarize_batch (Callable): Function that generates the summaries of several chat histories in one model request, in order.
+            batch_size (int): Maximum number of chats a worker takes from the queue at a time.
+            max_batch_chars (int): Histories with more characters than this are summarized on their own.
+        """
+        self.get_chat = get_chat
+        self.summarize = summarize
+        self.on_summary = on_summary
+        self.summarize_batch = summarize_batch
+        self.batch_size = max(1, batch_size)
+        self.max_batch_chars = max_batch_chars
+        self.jobs = queue.Queue()
+        self.queued = set()
+        self.lock = threading.Lock()
+
+        # metrics
+        self.summarized = 0
+        self.unchanged = 0
+        self.batches = 0
+        self.batched_chats = 0
+
+        for i in range(num_workers):
+            threading.Thread(target=self.__run, name=f"summary-worker-{i}", daemon=True).start()
+
+
+    def submit(self, session_id: str) -> bool:
+        """Queues a chat to be summarized. Returns False if it's already queued"""
+        with self.lock:
+            if session_id in self.queued:
+                return False
+            self.queued.add(session_id)
+        self.jobs.put(session_id)
+        return True
+
+
+    def pending(self) -> int:
+        """Number of chats waiting to be summarized"""
+        with self.lock:
+            return len(self.queued)
+
+
+    def stats(self) -> Dict[str, int]:
+        with self.lock:
+            return {"pending": len(self.queued), "summarized": self.summarized, "unchanged": self.unchanged,
+                    "batches": self.batches, "batchedChats": self.batched_chats}
+
+
+    def __run(self):
+        """Worker thread loop"""
+        while True:
+            session_ids = [self.jobs.get()]
+            while len(session_ids) < self.batch_size:
+                try:
+                    session_ids.append(self.jobs.get_nowait())
+                except queue.Empty:
+                    break
+
+            # allow the chats to be queued again once we've started on them, since they may change while we work
+            with self.lock:
+                self.queued.difference_update(session_ids)
+
+            try:
+                self.__summarize_chats(session_ids)
+            except Exception as e:
+                print(f"Error generating summaries for chats {', '.join(session_ids)}: ", e)
+
+
+    def __summarize_chats(self, session_ids: List[str]):
+        snapshots = []
+        for session_id in session_ids:
+            chat = self.get_chat(session_id)
+            if not chat or not chat.history:
+                continue
+
+            # snapshot the history, so messages added while the model is working aren't counted as summarized
+            timestamp = chat.timestamp
+            history = chat.get_history()
+            history_hash = hash_history(history)
+
+            # the history is the same as when the summary was generated, e.g. a message was added and then dropped
+            if chat.summary and chat.summaryHash == history_hash:
+                chat.set_summary(chat.summary, timestamp, history_hash)
+                self.on_summary(chat)
+                with self.lock:
+                    self.unchanged += 1
+                continue
+            snapshots.append((chat, timestamp, history, history_hash))
+
+        # short histories share a model request, and long ones (or a lone short one) get their own
+        batch, single = [], []
+        for snapshot in snapshots:
+            (batch if self.__is_batchable(snapshot[2]) else single).append(snapshot)
+        if len(batch) == 1:
+            batch, single = [], batch + single
+
+        if batch:
+            try:
+                summaries = self.summarize_batch([history for _, _, history, _ in batch])
+                for snapshot, summary in zip(batch, summaries):
+                    self.__set_summary(*snapshot, summary)
+                with self.lock:
+                    self.batches += 1
+                    self.batched_chats += len(batch)
+            except Exception as e:
+                print(f"Error generating summaries for chats {', '.join(chat.sessionId for chat, *_ in batch)}: ", e)
+
+        for snapshot in single:
+            try:
+                self.__set_summary(*snapshot, self.summarize(snapshot[2]))
+            except Exception as e:
+                print(f"Error generating summary for chat {snapshot[0].sessionId}: ", e)
+
+
+    def __set_summary(self, chat, timestamp: str, history: List[Dict[str, Any]], history_hash: str, summary: str):
+        chat.set_summary(summary, timestamp, history_hash)
+        self.on_summary(chat)
+        with self.lock:
+            self.summarized += 1
+
+
+    def __is_batchable(self, history: List[Dict[str, Any]]) -> bool:
+        if not self.summarize_batch or self.batch_size < 2:
+            return False
+        return sum(len(part) for message in history for part in message["parts"]) <= self.max_batch_chars
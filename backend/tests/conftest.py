@@ -0,0 +1,32 @@
+"""
+Runs the app against the fake model and the in-memory chat store. The app modules read their configuration from the
+environment on import, so it's set here before any test imports them.
+"""
+import os
+import sys
+
+import pytest
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+
+os.environ["MODEL_PROVIDER"] = "fake"
+os.environ["CHAT_STORE"] = "memory"
+os.environ["FAKE_MODEL_LATENCY"] = "0"
+os.environ["FAKE_MODEL_TOKENS_PER_SECOND"] = "0"
+os.environ["MEMORY_STORE_LATENCY"] = "0"
+os.environ["RATE_LIMIT_PER_MINUTE"] = "0"
+# the handler reads model_config.txt relative to the working directory
+os.chdir(BACKEND_DIR)
+
+
+@pytest.fixture(scope="session")
+def flask_client():
+    import main
+    return main.app.test_client()
+
+
+@pytest.fixture(scope="session")
+def asgi_app():
+    import asgi_app
+    return asgi_app.app
@@ -0,0 +1,36 @@
+import asyncio
+import uuid
+
+import pytest
+
+from chat_schema import Chat
+
+
+class FailingStore:
+    """Stands in for a store whose reads fail"""
+    def load_chat(self, session_id):
+        raise RuntimeError("store is down")
+
+
+@pytest.fixture
+def handler_with_failing_store(monkeypatch):
+    import main
+    handler = main.chat_handler
+    handler.wait_until_ready()
+    # a chat whose history is loaded from the store on first use
+    session_id = str(uuid.uuid4())
+    chat = Chat(sessionId=session_id)
+    chat.unload_history()
+    handler.all_chats.chats[session_id] = chat
+    monkeypatch.setattr(handler.all_chats, "_store", FailingStore())
+    yield handler, session_id
+    handler.all_chats.chats.pop(session_id, None)
+
+
+def test_stream_releases_its_slot_when_the_chat_fails_to_load(handler_with_failing_store):
+    handler, session_id = handler_with_failing_store
+    in_flight = handler.admission.stats()["inFlight"]["interactive"]
+
+    assert handler.stream_message(session_id, "motivate me") == ("store is down", 500)
+    assert asyncio.run(handler.stream_message_async(session_id, "motivate me")) == ("store is down", 500)
+    assert handler.admission.stats()["inFlight"]["interactive"] == in_flight
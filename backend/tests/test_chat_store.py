@@ -0,0 +1,41 @@
+import os
+import uuid
+
+import pytest
+
+from chat_schema import Chat, Message, Tombstone
+from chat_store import LocalChatStore
+
+ESCAPING_NAMES = ["../../escaped", "../credentials/service-account-key", "..", "nested/chat", "nested\\chat", ""]
+
+
+@pytest.mark.parametrize("name", ESCAPING_NAMES)
+def test_local_store_rejects_paths_outside_its_directory(tmp_path, name):
+    store = LocalChatStore(str(tmp_path / "chats"))
+    with pytest.raises(ValueError):
+        store.chat_path(name)
+    with pytest.raises(ValueError):
+        store.index_path(name)
+
+    with pytest.raises(ValueError):
+        store.save_chats([Chat(sessionId=name)])
+    with pytest.raises(ValueError):
+        store.load_chat(name)
+    with pytest.raises(ValueError):
+        store.delete_chats([Tombstone(sessionId=name, timestamp="")])
+    with pytest.raises(ValueError):
+        store.save_index(name, b"index")
+
+    # nothing was written anywhere, inside the directory or out of it
+    assert sorted(os.listdir(tmp_path)) == ["chats"]
+    assert os.listdir(tmp_path / "chats") == []
+
+
+def test_local_store_round_trip(tmp_path):
+    store = LocalChatStore(str(tmp_path / "chats"))
+    chat = Chat(sessionId=str(uuid.uuid4()))
+    chat.add_message(Message(role="user", parts=["motivate me"]))
+    store.save_chats([chat])
+
+    assert store.chat_path(chat.sessionId) == os.path.join(str(tmp_path / "chats"), f"{chat.sessionId}.json")
+    assert store.load_chat(chat.sessionId).get_history() == chat.get_history()
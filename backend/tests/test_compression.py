@@ -0,0 +1,48 @@
+import asyncio
+import gzip
+import json
+
+
+def big_json() -> bytes:
+    return json.dumps(["You got this! Every small step counts, so keep going."] * 100).encode("utf-8")
+
+
+def test_asgi_compresses_big_json(asgi_app):
+    import asgi_app as module
+
+    async def run():
+        async with asgi_app.test_request_context("/", headers={"Accept-Encoding": "gzip"}):
+            response = await module.compress_response(module.Response(big_json(), mimetype="application/json"))
+            assert response.headers["Content-Encoding"] == "gzip"
+            assert gzip.decompress(await response.get_data()) == big_json()
+
+    asyncio.run(run())
+
+
+def test_asgi_leaves_streamed_responses_alone(asgi_app):
+    import asgi_app as module
+    read = []
+
+    async def chunks():
+        for chunk in (big_json()[:100], big_json()[100:]):
+            read.append(chunk)
+            yield chunk
+
+    async def run():
+        async with asgi_app.test_request_context("/", headers={"Accept-Encoding": "gzip"}):
+            response = await module.compress_response(module.Response(chunks(), mimetype="application/json"))
+            assert "Content-Encoding" not in response.headers
+            # the stream wasn't read ahead of being sent
+            assert read == []
+            assert await response.get_data() == big_json()
+
+    asyncio.run(run())
+
+
+def test_flask_leaves_streamed_responses_alone(flask_client):
+    import main
+
+    with main.app.test_request_context("/", headers={"Accept-Encoding": "gzip"}):
+        response = main.compress_response(main.Response(iter([big_json()]), mimetype="application/json"))
+        assert "Content-Encoding" not in response.headers
+        assert response.get_data() == big_json()
@@ -0,0 +1,44 @@
+import asyncio
+import uuid
+
+import pytest
+
+
+def test_summaries_etag_is_weak(flask_client):
+    response = flask_client.get("/api/gemini/all_chat_summaries", headers={"Accept-Encoding": "gzip"})
+    assert response.status_code == 200
+    etag = response.headers["ETag"]
+    assert etag.startswith("W/")
+
+    # the tag matches whether or not the body was compressed
+    for encoding in ("gzip", "identity"):
+        response = flask_client.get("/api/gemini/all_chat_summaries", headers={"If-None-Match": etag, "Accept-Encoding": encoding})
+        assert response.status_code == 304
+        assert response.headers["ETag"] == etag
+
+
+def test_asgi_summaries_etag_is_weak(asgi_app):
+    async def run():
+        client = asgi_app.test_client()
+        response = await client.get("/api/gemini/all_chat_summaries")
+        etag = response.headers["ETag"]
+        assert etag.startswith("W/")
+        response = await client.get("/api/gemini/all_chat_summaries", headers={"If-None-Match": etag})
+        assert response.status_code == 304
+
+    asyncio.run(run())
+
+
+@pytest.mark.parametrize("limit", ["0", "-1", "ten"])
+def test_load_chat_rejects_limits_below_one(flask_client, asgi_app, limit):
+    session_id = str(uuid.uuid4())
+    response = flask_client.get("/api/gemini/load_chat", query_string={"sessionId": session_id, "limit": limit})
+    assert response.status_code == 400
+    response = flask_client.post("/api/gemini/load_chat", json={"sessionId": session_id, "limit": limit})
+    assert response.status_code == 400
+
+    async def run():
+        response = await asgi_app.test_client().get("/api/gemini/load_chat", query_string={"sessionId": session_id, "limit": limit})
+        assert response.status_code == 400
+
+    asyncio.run(run())
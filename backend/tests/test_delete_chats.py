@@ -0,0 +1,37 @@
+import asyncio
+import uuid
+
+import pytest
+
+INVALID_BODIES = [
+    {"olderThan": 1700000000},
+    {"olderThan": {"days": 30}},
+    {"olderThan": ["2024-01-01"], "all": True},
+    {"sessionIds": {"id": "x"}, "all": True},
+    {"sessionIds": "not-a-list", "all": True},
+    {"sessionIds": str(uuid.uuid4())},
+]
+
+
+@pytest.mark.parametrize("body", INVALID_BODIES)
+def test_delete_chats_rejects_wrong_types(flask_client, asgi_app, body):
+    response = flask_client.delete("/api/gemini/delete_chats", json=body)
+    assert response.status_code == 400
+
+    async def run():
+        response = await asgi_app.test_client().delete("/api/gemini/delete_chats", json=body)
+        assert response.status_code == 400
+
+    asyncio.run(run())
+
+
+def test_delete_chats_older_than(flask_client):
+    session_id = str(uuid.uuid4())
+    flask_client.post("/api/gemini/request", json={"prompt": "motivate me", "sessionId": session_id})
+
+    response = flask_client.delete("/api/gemini/delete_chats", json={"olderThan": "2000-01-01T00:00:00"})
+    assert response.status_code == 200
+    assert session_id not in response.get_json()["deleted"]
+
+    response = flask_client.delete("/api/gemini/delete_chats", json={"olderThan": "not a time"})
+    assert response.status_code == 400
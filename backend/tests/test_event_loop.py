@@ -0,0 +1,52 @@
+import asyncio
+import time
+import uuid
+
+from chat_schema import Chat, Message
+
+STORE_LATENCY = 1.0 # seconds every call to the in-memory store takes during these tests
+MAX_HEALTHZ_TIME = 0.3 # seconds /healthz may take while another request waits on the store
+
+
+def add_lazy_chat(handler) -> str:
+    """Saves a chat to the handler's store and keeps only its metadata in memory, so its history is loaded on first use"""
+    chat = Chat(sessionId=str(uuid.uuid4()))
+    chat.add_message(Message(role="user", parts=["I need some motivation"]))
+    chat.add_message(Message(role="model", parts=["You got this!"]))
+    handler.store.save_chats([chat])
+    chat.unload_history()
+    handler.all_chats.add_chat(chat)
+    return chat.sessionId
+
+
+def test_healthz_responds_while_lazy_load_is_in_flight(asgi_app):
+    import asgi_app as module
+    handler = module.chat_handler
+    memory_store = handler.store.store
+
+    async def run():
+        client = asgi_app.test_client()
+        await asyncio.to_thread(handler.wait_until_ready)
+        session_id = add_lazy_chat(handler)
+
+        memory_store.latency = STORE_LATENCY
+        try:
+            send = asyncio.create_task(client.post("/api/gemini/request", json={"prompt": "motivate me", "sessionId": session_id}))
+            # the clock starts before the message's request gets to run, so blocking the loop in it is counted
+            start = time.perf_counter()
+            await asyncio.sleep(STORE_LATENCY / 4)
+            response = await client.get("/healthz")
+            elapsed = time.perf_counter() - start - STORE_LATENCY / 4
+            assert response.status_code == 200
+            assert elapsed < MAX_HEALTHZ_TIME
+            assert not send.done()
+
+            response = await send
+            assert response.status_code == 200
+        finally:
+            memory_store.latency = 0.0
+
+        # the reply was added to the stored history, which was loaded before the message was sent
+        assert len(handler.all_chats.get_chat(session_id).history) == 4
+
+    asyncio.run(run())
@@ -0,0 +1,68 @@
+import sys
+
+import pytest
+
+import migrate_chats
+from chat_schema import Chat, ChatManager, Message
+from chat_store import GCSChatStore
+
+
+class FakeBlob:
+    def __init__(self, bucket, name: str):
+        self.bucket = bucket
+        self.name = name
+        self.metadata = None
+        self.generation = 0
+
+    def download_as_text(self, encoding: str = "utf-8") -> str:
+        return self.download_as_bytes().decode(encoding)
+
+    def download_as_bytes(self) -> bytes:
+        from google.api_core.exceptions import NotFound
+        if self.name not in self.bucket.objects:
+            raise NotFound(self.name)
+        return self.bucket.objects[self.name]
+
+    def upload_from_string(self, data, **options):
+        self.bucket.writes.append(self.name)
+        self.bucket.objects[self.name] = data
+        self.generation = len(self.bucket.writes)
+
+
+class FakeBucket:
+    """Bucket holding only the legacy history.json, which records every object written to it"""
+    def __init__(self, legacy_file_path: str, legacy_chats: ChatManager):
+        self.objects = {legacy_file_path: legacy_chats.model_dump_json().encode("utf-8")}
+        self.writes = []
+        self.client = self
+
+    def list_blobs(self, bucket, prefix: str):
+        return [FakeBlob(self, name) for name in self.objects if name.startswith(prefix)]
+
+    def blob(self, name: str) -> FakeBlob:
+        return FakeBlob(self, name)
+
+
+@pytest.fixture
+def legacy_bucket(monkeypatch):
+    chat = Chat()
+    chat.add_message(Message(role="user", parts=["I need some motivation"]))
+    bucket = FakeBucket(migrate_chats.CHAT_HISTORY_FILE, ChatManager(chats={chat.sessionId: chat}))
+    monkeypatch.setattr(GCSChatStore, "_GCSChatStore__get_gc_bucket", lambda self: bucket)
+    return bucket
+
+
+def test_dry_run_doesnt_write_to_the_bucket(legacy_bucket, monkeypatch, capsys):
+    monkeypatch.setattr(sys, "argv", ["migrate_chats.py", "--store", "gcs", "--dry-run"])
+    migrate_chats.main()
+
+    assert "Loaded 1 chats from gcs" in capsys.readouterr().out
+    assert legacy_bucket.writes == []
+
+
+def test_migration_writes_the_legacy_chats(legacy_bucket, monkeypatch):
+    monkeypatch.setattr(sys, "argv", ["migrate_chats.py", "--store", "gcs"])
+    migrate_chats.main()
+
+    assert legacy_bucket.writes
+    assert all(name.startswith(migrate_chats.CHAT_HISTORY_PREFIX) for name in legacy_bucket.writes)
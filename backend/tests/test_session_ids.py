@@ -0,0 +1,91 @@
+import asyncio
+import uuid
+
+import pytest
+
+from chat_schema import is_valid_session_id
+
+INVALID_SESSION_IDS = ["../../escaped", "../credentials/service-account-key", "not-a-uuid", str(uuid.uuid4()) + "x", "{" + str(uuid.uuid4()) + "}"]
+
+
+def test_is_valid_session_id():
+    assert is_valid_session_id(str(uuid.uuid4()))
+    assert is_valid_session_id(str(uuid.uuid4()).upper())
+    assert not is_valid_session_id(uuid.uuid4().hex)
+    assert not is_valid_session_id(None)
+    for session_id in INVALID_SESSION_IDS:
+        assert not is_valid_session_id(session_id)
+
+
+def invalid_id_requests(session_id):
+    """(method, path, json body, query string) of every route that takes a session ID"""
+    return [
+        ("POST", "/api/gemini/request", {"prompt": "motivate me", "sessionId": session_id}, None),
+        ("POST", "/api/gemini/request_stream", {"prompt": "motivate me", "sessionId": session_id}, None),
+        ("POST", "/api/gemini/new_chat", {"sessionId": session_id}, None),
+        ("POST", "/api/gemini/load_chat", {"sessionId": session_id}, None),
+        ("GET", "/api/gemini/load_chat", None, {"sessionId": session_id}),
+        ("DELETE", "/api/gemini/delete_chats", {"sessionIds": [str(uuid.uuid4()), session_id]}, None),
+    ]
+
+
+@pytest.mark.parametrize("session_id", INVALID_SESSION_IDS)
+def test_flask_rejects_invalid_session_ids(flask_client, session_id):
+    import main
+    chats_before = len(main.chat_handler.all_chats.chats)
+    for method, path, body, query in invalid_id_requests(session_id):
+        response = flask_client.open(path, method=method, json=body, query_string=query)
+        assert response.status_code == 400, path
+        assert response.get_json() == "Invalid session ID"
+    assert len(main.chat_handler.all_chats.chats) == chats_before
+
+
+@pytest.mark.parametrize("session_id", INVALID_SESSION_IDS)
+def test_asgi_rejects_invalid_session_ids(asgi_app, session_id):
+    import asgi_app as module
+
+    async def run():
+        client = asgi_app.test_client()
+        for method, path, body, query in invalid_id_requests(session_id):
+            response = await client.open(path, method=method, json=body, query_string=query)
+            assert response.status_code == 400, path
+            assert await response.get_json() == "Invalid session ID"
+
+    chats_before = len(module.chat_handler.all_chats.chats)
+    asyncio.run(run())
+    assert len(module.chat_handler.all_chats.chats) == chats_before
+
+
+def test_handler_rejects_invalid_session_ids():
+    import main
+    handler = main.chat_handler
+    assert handler.send_message("../../escaped", "motivate me") == ("Invalid session ID", 400)
+    assert handler.stream_message("../../escaped", "motivate me") == ("Invalid session ID", 400)
+    assert handler.start_new_chat("../../escaped") == ("Invalid session ID", 400)
+    assert asyncio.run(handler.send_message_async("../../escaped", "motivate me")) == ("Invalid session ID", 400)
+    assert asyncio.run(handler.stream_message_async("../../escaped", "motivate me")) == ("Invalid session ID", 400)
+
+
+def test_valid_session_id_is_accepted(flask_client):
+    session_id = str(uuid.uuid4())
+    response = flask_client.post("/api/gemini/request", json={"prompt": "motivate me", "sessionId": session_id})
+    assert response.status_code == 200
+    response = flask_client.post("/api/gemini/load_chat", json={"sessionId": session_id})
+    assert response.status_code == 200
+    assert response.get_json()["sessionId"] == session_id
+
+
+def test_new_chat_makes_the_first_session_id(flask_client):
+    # what the app does on startup: it has no session ID yet, so new_chat makes one
+    response = flask_client.post("/api/gemini/new_chat", json={"sessionId": ""})
+    session_id = response.get_json()
+    assert response.status_code == 200
+    assert is_valid_session_id(session_id)
+
+    # the chat has no messages yet, so asking for a new chat again keeps the same ID
+    response = flask_client.post("/api/gemini/new_chat", json={"sessionId": session_id})
+    assert response.get_json() == session_id
+
+    # messages sent with the ID go to the chat the client shows
+    flask_client.post("/api/gemini/request", json={"prompt": "motivate me", "sessionId": session_id})
+    assert flask_client.post("/api/gemini/load_chat", json={"sessionId": session_id}).status_code == 200
@@ -0,0 +1,11 @@
+import pytest
+
+import chat_handler
+
+
+@pytest.mark.parametrize("store", ["local", "sqlite", "memory"])
+def test_several_workers_refuse_unshareable_stores(monkeypatch, store):
+    monkeypatch.setattr(chat_handler, "WEB_WORKERS", 2)
+    monkeypatch.setattr(chat_handler, "CHAT_STORE", store)
+    with pytest.raises(ValueError, match=store):
+        chat_handler.GeminiChatHandler()
@@ -15,7 +15,7 @@ enum HttpMethod {
 
 final Map<String, String> _headers = {'Content-Type': 'application/json'};
 
-Future<GeminiResponse> apiSendMessage(String prompt) async {
+Future<GeminiResponse> apiSendMessage(String prompt, String sessionId) async {
   return _makeRequest(
     url: kBuildDebug
         ? "$kLocalHostUrl$kApiRequestRoute"
@@ -23,16 +23,20 @@ Future<GeminiResponse> apiSendMessage(String prompt) async {
     method: HttpMethod.POST,
     body: {
       "prompt": prompt,
+      "sessionId": sessionId,
     },
   );
 }
 
-Future<GeminiResponse> apiStartNewChat() async {
+Future<GeminiResponse> apiStartNewChat(String sessionId) async {
   return _makeRequest(
     url: kBuildDebug
         ? "$kLocalHostUrl$kApiNewChatRoute"
         : "$kGCloudUrl$kApiNewChatRoute",
     method: HttpMethod.POST,
+    body: {
+      "sessionId": sessionId,
+    },
   );
 }
 
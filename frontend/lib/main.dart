@@ -74,23 +74,20 @@ class _HomePageState extends State<HomePage>{
   @override
   void initState() {
     super.initState();
+    // the session ID starts empty, so new_chat makes the first chat's ID
     WidgetsBinding.instance.addPostFrameCallback((_) async {
-      await _getSessionId();
       await _getNewChatSession();
     });
   }
 
-  Future<void> _getSessionId() async {
+  Future<void> _getNewChatSession() async {
     final sessionProvider =
         Provider.of<SessionProvider>(context, listen: false);
-    await sessionProvider.loadSessionId();
-  }
-
-  Future<void> _getNewChatSession() async {
     final chatSessionsProvider =
         Provider.of<ChatSessionsProvider>(context, listen: false);
-    final response = await apiStartNewChat();
+    final response = await apiStartNewChat(sessionProvider.sessionId);
     final newSessionId = response.data;
+    sessionProvider.setSessionId(newSessionId: newSessionId);
     await chatSessionsProvider.loadChatSessions();
 
     String currentTimestamp = DateTime.now().toUtc().toIso8601String();
@@ -116,7 +113,6 @@ class _HomePageState extends State<HomePage>{
               onPressed: () async {
                 _userInputKey.currentState?.clearMessages();
                 await _getNewChatSession(); // reload chat sessions
-                await _getSessionId();
               },
               icon: SizedBox(
                 width: kIconSize,
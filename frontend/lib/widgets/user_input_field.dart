@@ -1,4 +1,6 @@
 import 'package:flutter/material.dart';
+import 'package:provider/provider.dart';
+import '../providers/session_provider.dart';
 import '../api/api_service.dart';
 import '../api/gemini_response.dart';
 import '../widgets/message_bubble.dart';
@@ -67,8 +69,10 @@ class UserInputFieldState extends State<UserInputField> {
       );
 
       if (role == Roles.user) {
+        final sessionId =
+            Provider.of<SessionProvider>(context, listen: false).sessionId;
         setState(() {
-          _apiResponseFuture = apiSendMessage(text).then((reply) {
+          _apiResponseFuture = apiSendMessage(text, sessionId).then((reply) {
             // print(reply.text);
             setState(() {
               _messages.insert(